@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 import argparse
+import bz2
 import gzip
+import hashlib
+import heapq
 import json
+import math
+import os
 import re
+import shutil
+import signal
+import socket
+import subprocess
 import sys
-from collections import defaultdict
-from dataclasses import dataclass, asdict
-from datetime import datetime
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timedelta
 from pathlib import Path
 import csv
-from typing import Dict, Optional, Iterable, TextIO, List
+from typing import Dict, Optional, Iterable, Iterator, TextIO, List, Set, Tuple
+
+from sql_fingerprint import sql_digest
 
 # ----------------------------
 # Regex patterns (tune to your log format)
@@ -21,34 +37,60 @@ from typing import Dict, Optional, Iterable, TextIO, List
 #
 # Adjust these if your format differs.
 
-TIMESTAMP_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3})")
-
+# The "ompiling command(" part is matched case-sensitively ((?-i:...)), exactly
+# like the EVENT_MARKER prefilter below, so the two agree on which lines count.
 COMPILE_START_RE = re.compile(
-    r"Compiling command\(queryId=(?P<queryId>[^)]+)\).*?"
+    r"C(?-i:ompiling command\()queryId=(?P<queryId>[^)]+)\).*?"
     r"user=(?P<user>[^;]+);.*?"
     r"query=(?P<query>.*)$",
     re.IGNORECASE,
 )
 
 COMPILE_END_RE = re.compile(
-    r"Completed compiling command\(queryId=(?P<queryId>[^)]+)\).*?"
+    r"Completed c(?-i:ompiling command\()queryId=(?P<queryId>[^)]+)\).*?"
     r"compileTime=(?P<compileTime>\d+)ms",
     re.IGNORECASE,
 )
 
 UNION_ALL_RE = re.compile(r"\bUNION\s+ALL\b", re.IGNORECASE)
 
+# Literal common to both "Compiling command(" and "Completed compiling command(".
+# Lines without it are rejected before any regex or timestamp parsing runs;
+# it uses the casing HS2 writes, which the regexes above require for this part.
+EVENT_MARKER = b"ompiling command("
+
 
 # ----------------------------
 # Data structures
 # ----------------------------
 
-@dataclass
 class InFlightQuery:
-    query_id: str
-    user: str
-    query: str
-    start_ts: Optional[datetime]  # may be None if no timestamp parsed
+    # One per open "Compiling command"; __slots__ keeps a busy inflight table
+    # from paying for a per-instance __dict__.
+    __slots__ = ("query_id", "user", "query", "start_ts", "seen_ts", "fingerprint", "union_count", "host")
+
+    def __init__(
+        self,
+        query_id: str,
+        user: str,
+        query: str,
+        start_ts: Optional[datetime],   # may be None if no timestamp parsed
+        seen_ts: Optional[datetime] = None,  # log clock when stored (TTL)
+        fingerprint: str = "",
+        union_count: int = 0,
+        host: str = "",                 # HS2 instance, set when merging hosts
+    ):
+        self.query_id = query_id
+        self.user = user
+        self.query = query              # "" when only fingerprints are kept
+        self.start_ts = start_ts
+        self.seen_ts = seen_ts
+        self.fingerprint = fingerprint
+        self.union_count = union_count
+        self.host = host
+
+    def __repr__(self) -> str:
+        return f"InFlightQuery(query_id={self.query_id!r}, user={self.user!r}, start_ts={self.start_ts!r})"
 
 
 @dataclass
@@ -61,28 +103,626 @@ class QueryRecord:
     excessive_unions: bool
     start_ts: Optional[str]  # ISO string
     end_ts: Optional[str]    # ISO string
+    host: str                # HS2 instance ("" unless --host-logs)
     source_log: str          # which file
+    fingerprint: str         # normalised query shape (see fingerprint_query)
     query: str               # (can be truncated)
 
 
+class QuantileSketch:
+    """
+    DDSketch-style quantile sketch for non-negative values (compile ms).
+
+    Values are counted in logarithmic buckets of relative width 2*alpha, so
+    any quantile is returned within alpha relative error, memory is bounded
+    by max_bins per sketch, and two sketches merge exactly by adding bucket
+    counts (partials from workers, files or previous runs combine correctly).
+    """
+
+    __slots__ = ("alpha", "gamma", "log_gamma", "max_bins", "bins", "zero_count", "count")
+
+    def __init__(self, alpha: float = 0.01, max_bins: int = 2048):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for key, n in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + n
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        # Fold the lowest buckets together; upper quantiles keep their accuracy
+        keys = sorted(self.bins)
+        excess = keys[: len(keys) - self.max_bins + 1]
+        folded = sum(self.bins.pop(k) for k in excess)
+        self.bins[excess[-1]] = folded
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def percentiles(self, suffix: str = "_compile_ms", pcts: Tuple[int, ...] = (50, 90, 99)) -> dict:
+        return {f"p{p}{suffix}": round(self.quantile(p / 100.0), 1) for p in pcts}
+
+    def to_state(self) -> dict:
+        return {
+            "alpha": self.alpha,
+            "zero": self.zero_count,
+            "bins": {str(k): n for k, n in self.bins.items()},
+        }
+
+    @classmethod
+    def from_state(cls, d: dict) -> "QuantileSketch":
+        sketch = cls(alpha=d["alpha"])
+        sketch.zero_count = d["zero"]
+        sketch.bins = {int(k): n for k, n in d["bins"].items()}
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        return sketch
+
+
+class QueryShape:
+    """
+    Aggregates for one query fingerprint. The normalised text is stored once
+    per shape; compile times go into a QuantileSketch for percentiles.
+    """
+
+    __slots__ = (
+        "fingerprint", "normalized", "union_count", "executions",
+        "slow_queries", "total_compile_ms", "max_compile_ms", "sketch",
+    )
+
+    def __init__(self, fingerprint: str, normalized: str, union_count: int):
+        self.fingerprint = fingerprint
+        self.normalized = normalized
+        self.union_count = union_count
+        self.executions = 0
+        self.slow_queries = 0
+        self.total_compile_ms = 0
+        self.max_compile_ms = 0
+        self.sketch = QuantileSketch()
+
+    def add(self, compile_time_ms: int, slow: bool) -> None:
+        self.executions += 1
+        self.total_compile_ms += compile_time_ms
+        if compile_time_ms > self.max_compile_ms:
+            self.max_compile_ms = compile_time_ms
+        if slow:
+            self.slow_queries += 1
+        self.sketch.add(compile_time_ms)
+
+    def merge(self, other: "QueryShape") -> None:
+        self.executions += other.executions
+        self.slow_queries += other.slow_queries
+        self.total_compile_ms += other.total_compile_ms
+        self.max_compile_ms = max(self.max_compile_ms, other.max_compile_ms)
+        self.sketch.merge(other.sketch)
+
+    def to_row(self) -> dict:
+        return {
+            "fingerprint": self.fingerprint,
+            "executions": self.executions,
+            "slow_queries": self.slow_queries,
+            "total_compile_ms": self.total_compile_ms,
+            "avg_compile_ms": round(self.total_compile_ms / self.executions, 1) if self.executions else 0.0,
+            "p50_compile_ms": round(self.sketch.quantile(0.50)),
+            "p95_compile_ms": round(self.sketch.quantile(0.95)),
+            "max_compile_ms": self.max_compile_ms,
+            "union_count": self.union_count,
+            "normalized_query": self.normalized,
+        }
+
+    def to_state(self) -> dict:
+        return {
+            "normalized": self.normalized,
+            "union_count": self.union_count,
+            "executions": self.executions,
+            "slow_queries": self.slow_queries,
+            "total_compile_ms": self.total_compile_ms,
+            "max_compile_ms": self.max_compile_ms,
+            "sketch": self.sketch.to_state(),
+        }
+
+    @classmethod
+    def from_state(cls, fingerprint: str, d: dict) -> "QueryShape":
+        shape = cls(fingerprint, d["normalized"], d["union_count"])
+        shape.executions = d["executions"]
+        shape.slow_queries = d["slow_queries"]
+        shape.total_compile_ms = d["total_compile_ms"]
+        shape.max_compile_ms = d["max_compile_ms"]
+        shape.sketch = QuantileSketch.from_state(d["sketch"])
+        return shape
+
+
+# Columns of the per-fingerprint CSV, written in descending total compile time
+FINGERPRINT_FIELDNAMES = [
+    "fingerprint",
+    "executions",
+    "slow_queries",
+    "total_compile_ms",
+    "avg_compile_ms",
+    "p50_compile_ms",
+    "p95_compile_ms",
+    "max_compile_ms",
+    "union_count",
+    "normalized_query",
+]
+
+
+# Column order of the per-query CSV (matches QueryRecord field order)
+CSV_FIELDNAMES = [
+    "query_id",
+    "user",
+    "compile_time_ms",
+    "union_count",
+    "slow_compile",
+    "excessive_unions",
+    "start_ts",
+    "end_ts",
+    "host",
+    "source_log",
+    "fingerprint",
+    "query",
+]
+
+
+# Columns of the optional CSV of queries that never produced a QueryRecord
+INCOMPLETE_FIELDNAMES = [
+    "query_id",
+    "user",
+    "reason",            # capacity | ttl | open_at_end | end_without_start
+    "start_ts",
+    "end_ts",
+    "compile_time_ms",
+    "query",
+]
+
+
+@dataclass
+class OrphanEnd:
+    # "Completed compiling command" seen in a file before any start for the
+    # same queryId in that file; the start may live in an earlier rotated file.
+    position: int            # number of part rows written before this event
+    query_id: str
+    compile_time_ms: int
+    end_ts: Optional[datetime]
+
+
+@dataclass
+class FilePartial:
+    # Result of parsing a single log file in a worker process
+    path: str
+    part_path: str           # headerless CSV with records resolved inside the file
+    orphan_ends: List[OrphanEnd] = field(default_factory=list)
+    open_starts: Dict[str, InFlightQuery] = field(default_factory=dict)
+    started_ids: Set[str] = field(default_factory=set)
+    per_user_stats: Dict[str, dict] = field(default_factory=dict)
+    per_hour_stats: Dict[str, dict] = field(default_factory=dict)
+    user_sketches: Dict[str, QuantileSketch] = field(default_factory=dict)
+    hour_sketches: Dict[str, QuantileSketch] = field(default_factory=dict)
+    global_sketch: Optional[QuantileSketch] = None
+    shapes: Dict[str, QueryShape] = field(default_factory=dict)
+    parse_errors: int = 0
+    start_offset: int = 0
+    end_offset: int = 0
+    incomplete_rows: List[dict] = field(default_factory=list)
+    evicted: Dict[str, int] = field(default_factory=dict)
+    ends_without_start: int = 0
+    peak_inflight: int = 0
+
+
+class InflightStore:
+    """
+    Open compile starts keyed by queryId, bounded by entry count and by age
+    on the log clock (the newest timestamp seen, not wall time). The oldest
+    entries are evicted first and handed to on_evict(entry, reason).
+    max_entries / ttl_seconds of 0 mean unbounded.
+    """
+
+    def __init__(self, max_entries: int = 0, ttl_seconds: float = 0, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = timedelta(seconds=ttl_seconds) if ttl_seconds else None
+        self.on_evict = on_evict
+        self.entries: "OrderedDict[str, InFlightQuery]" = OrderedDict()
+        self.clock: Optional[datetime] = None
+        self.evicted = {"capacity": 0, "ttl": 0}
+        self.peak_entries = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, query_id: str) -> bool:
+        return query_id in self.entries
+
+    def items(self):
+        return self.entries.items()
+
+    def values(self):
+        return self.entries.values()
+
+    def pop(self, query_id: str, default=None):
+        return self.entries.pop(query_id, default)
+
+    def advance(self, ts: Optional[datetime]) -> None:
+        if ts is not None and (self.clock is None or ts > self.clock):
+            self.clock = ts
+            self._expire()
+
+    def put(self, entry: InFlightQuery) -> None:
+        self.advance(entry.start_ts)
+        entry.seen_ts = entry.start_ts or self.clock
+        # A repeated queryId replaces the old start and becomes the newest entry
+        self.entries.pop(entry.query_id, None)
+        self.entries[entry.query_id] = entry
+        if self.max_entries and len(self.entries) > self.max_entries:
+            self._evict_oldest("capacity")
+        if len(self.entries) > self.peak_entries:
+            self.peak_entries = len(self.entries)
+
+    def update(self, entries: Dict[str, InFlightQuery]) -> None:
+        for entry in entries.values():
+            self.put(entry)
+
+    def _expire(self) -> None:
+        if self.ttl is None or not self.entries:
+            return
+        cutoff = self.clock - self.ttl
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if oldest.seen_ts is not None and oldest.seen_ts >= cutoff:
+                break
+            self._evict_oldest("ttl")
+
+    def _evict_oldest(self, reason: str) -> None:
+        _, entry = self.entries.popitem(last=False)
+        self.evicted[reason] += 1
+        if self.on_evict is not None:
+            self.on_evict(entry, reason)
+
+
 # ----------------------------
 # Utility functions
 # ----------------------------
 
+def fingerprint_query(query: str) -> Tuple[str, str]:
+    """Return (fingerprint, normalised text) for a SQL statement (see sql_fingerprint.py)."""
+    digest, normalized = sql_digest(query)
+    return digest.hex(), normalized
+
+
+def incomplete_row(entry: InFlightQuery, reason: str) -> dict:
+    return {
+        "query_id": entry.query_id,
+        "user": entry.user,
+        "reason": reason,
+        "start_ts": entry.start_ts.isoformat() if entry.start_ts else None,
+        "end_ts": None,
+        "compile_time_ms": None,
+        "query": entry.query,
+    }
+
+
+def orphan_end_row(query_id: str, compile_time_ms: int, end_ts: Optional[datetime]) -> dict:
+    return {
+        "query_id": query_id,
+        "user": None,
+        "reason": "end_without_start",
+        "start_ts": None,
+        "end_ts": end_ts.isoformat() if end_ts else None,
+        "compile_time_ms": compile_time_ms,
+        "query": None,
+    }
+
+
+# Compressed log suffixes and their openers; offsets into these files count
+# decompressed bytes, so they cannot be compared with the on-disk size
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open}
+
+
+def compressed_suffix(path) -> Optional[str]:
+    """".gz" / ".bz2" for a compressed log, None for a plain one."""
+    name = str(path)
+    for suffix in COMPRESSED_OPENERS:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
 def open_maybe_gzip(path: Path) -> TextIO:
-    if str(path).endswith(".gz"):
-        return gzip.open(path, "rt", errors="ignore")
+    suffix = compressed_suffix(path)
+    if suffix:
+        return COMPRESSED_OPENERS[suffix](path, "rt", errors="ignore")
     return open(path, "r", errors="ignore")
 
 
+def open_maybe_gzip_binary(path: Path):
+    # Binary streams: tell()/seek() are byte offsets into the (decompressed) log
+    suffix = compressed_suffix(path)
+    if suffix:
+        return COMPRESSED_OPENERS[suffix](path, "rb")
+    return open(path, "rb")
+
+
+# ----------------------------
+# Block readers
+# ----------------------------
+
+# Decompressed bytes handed to the line scanner per read()
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+GZIP_BACKENDS = ("auto", "gzip", "zlib", "isal", "pigz")
+
+
+class ZlibGzipReader:
+    """
+    Minimal .gz reader on zlib.decompressobj: decompresses large compressed
+    chunks per call instead of going through GzipFile's buffered layers.
+    Handles multi-member (concatenated) gzip files.
+    """
+
+    def __init__(self, path: Path, chunk_size: int = 1024 * 1024):
+        self.f = open(path, "rb")
+        self.chunk_size = chunk_size
+        self.d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            chunk = self.f.read(self.chunk_size)
+            if not chunk:
+                return self.d.flush()
+            out = self.d.decompress(chunk)
+            while self.d.eof and self.d.unused_data:
+                # Next gzip member
+                rest = self.d.unused_data
+                self.d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                out += self.d.decompress(rest)
+            if out:
+                return out
+
+    def close(self) -> None:
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PipeReader:
+    """Decompress through an external process (e.g. `pigz -dc`) and read its stdout."""
+
+    def __init__(self, argv: List[str]):
+        self.argv = argv
+        self.proc = subprocess.Popen(argv, stdout=subprocess.PIPE, bufsize=READ_BLOCK_SIZE)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.proc.stdout.read(size)
+
+    def close(self) -> None:
+        self.proc.stdout.close()
+        rc = self.proc.wait()
+        if rc not in (0, -signal.SIGPIPE):
+            raise OSError(f"{' '.join(self.argv)} exited with status {rc}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def resolve_gzip_backend(backend: str) -> str:
+    if backend != "auto":
+        return backend
+    try:
+        import isal.igzip  # noqa: F401
+        return "isal"
+    except ImportError:
+        return "zlib"
+
+
+def open_log_stream(path: Path, backend: str = "auto"):
+    """
+    Open a log for block reads. .gz files go through the chosen backend:
+    gzip (stdlib GzipFile), zlib (ZlibGzipReader), isal (python-isal, if
+    installed) or pigz (external `pigz -dc` process, decompressing in
+    parallel with parsing). auto picks isal when available, else zlib.
+    """
+    name = str(path)
+    suffix = compressed_suffix(path)
+    if suffix == ".gz":
+        backend = resolve_gzip_backend(backend)
+        if backend == "gzip":
+            return gzip.open(path, "rb")
+        if backend == "zlib":
+            return ZlibGzipReader(path)
+        if backend == "isal":
+            from isal import igzip
+            return igzip.open(path, "rb")
+        if backend == "pigz":
+            if shutil.which("pigz") is None:
+                raise FileNotFoundError("pigz not found on PATH")
+            return PipeReader(["pigz", "-dc", name])
+        raise ValueError(f"Unknown gzip backend: {backend}")
+    if suffix == ".bz2":
+        return bz2.open(path, "rb")
+    return open(path, "rb", buffering=0)
+
+
+def _skip_bytes(f, count: int) -> bytes:
+    """Read and discard count bytes from a non-seekable stream; returns any overshoot."""
+    while count > 0:
+        block = f.read(READ_BLOCK_SIZE)
+        if not block:
+            return b""
+        if len(block) > count:
+            # Block readers may return more than one block's worth
+            return block[count:]
+        count -= len(block)
+    return b""
+
+
+def scan_marked_lines(
+    f,
+    marker: bytes,
+    start_offset: int = 0,
+    complete_lines_only: bool = False,
+    progress: Optional[dict] = None,
+) -> Iterator[bytes]:
+    """
+    Yield only the raw lines containing marker, scanning decompressed blocks
+    with bytes.find instead of iterating every line in Python.
+
+    Reading begins start_offset bytes into the decompressed stream (seek on
+    plain files, read-and-discard otherwise). On exhaustion progress["offset"]
+    holds the offset after the last consumed line; with complete_lines_only a
+    trailing line without newline is not consumed.
+    """
+    offset = start_offset
+    carry = b""
+    leftover = b""
+    if start_offset:
+        if isinstance(f, (ZlibGzipReader, PipeReader)):
+            leftover = _skip_bytes(f, start_offset)
+        else:
+            f.seek(start_offset)
+
+    while True:
+        if leftover:
+            block, leftover = leftover, b""
+        else:
+            block = f.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        buf = carry + block if carry else block
+        last_nl = buf.rfind(b"\n")
+        if last_nl == -1:
+            carry = buf
+            continue
+        end = last_nl + 1
+        pos = buf.find(marker, 0, end)
+        while pos != -1:
+            line_start = buf.rfind(b"\n", 0, pos) + 1
+            line_end = buf.find(b"\n", pos) + 1
+            yield buf[line_start:line_end]
+            pos = buf.find(marker, line_end, end)
+        offset += end
+        carry = buf[end:]
+
+    if carry and not complete_lines_only:
+        if marker in carry:
+            yield carry
+        offset += len(carry)
+
+    if progress is not None:
+        progress["offset"] = offset
+
+
+def follow_lines(path: Path, poll_interval: float = 1.0, from_start: bool = False) -> Iterator[Optional[bytes]]:
+    """
+    Follow a growing log like `tail -F`, yielding complete raw lines.
+
+    Yields None whenever it is idle at end of file so the caller can do
+    periodic work. When the path is replaced (rotation: new inode) the old
+    file is drained first and the new one is read from the beginning; when
+    the file shrinks (copytruncate) reading restarts at offset 0.
+    """
+    f = None
+    inode = None
+    pending = b""
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    yield None
+                    time.sleep(poll_interval)
+                    continue
+                inode = os.fstat(f.fileno()).st_ino
+                if not from_start:
+                    f.seek(0, os.SEEK_END)
+                # Files appearing after a rotation are read in full
+                from_start = True
+
+            chunk = f.readline()
+            if chunk:
+                if chunk.endswith(b"\n"):
+                    yield pending + chunk
+                    pending = b""
+                else:
+                    pending += chunk
+                continue
+
+            # At EOF: look for rotation or truncation
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and st.st_ino != inode:
+                if pending:
+                    yield pending
+                    pending = b""
+                f.close()
+                f = None
+                continue
+            if st is not None and st.st_size < f.tell():
+                f.seek(0)
+                pending = b""
+                continue
+
+            yield None
+            time.sleep(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
+
+
 def parse_timestamp(line: str) -> Optional[datetime]:
-    m = TIMESTAMP_RE.match(line)
-    if not m:
+    # Hand-rolled parser for the fixed-offset layout "YYYY-MM-DD HH:MM:SS,mmm"
+    # (e.g. 2024-11-14 10:12:34,567); ~10x cheaper than regex + strptime.
+    if (
+        len(line) < 23
+        or line[4] != "-" or line[7] != "-" or line[10] != " "
+        or line[13] != ":" or line[16] != ":" or line[19] != ","
+    ):
+        return None
+    digits = line[0:4] + line[5:7] + line[8:10] + line[11:13] + line[14:16] + line[17:19] + line[20:23]
+    if not digits.isdigit():
         return None
-    ts_str = m.group(1)
     try:
-        # Example: 2024-11-14 10:12:34,567
-        return datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S,%f")
+        return datetime(
+            int(line[0:4]), int(line[5:7]), int(line[8:10]),
+            int(line[11:13]), int(line[14:16]), int(line[17:19]),
+            int(line[20:23]) * 1000,
+        )
     except ValueError:
         return None
 
@@ -97,10 +737,20 @@ class HiveServer2LogAnalyzer:
         compile_threshold_ms: int = 10000,
         union_threshold: int = 3,
         max_query_len: int = 20000,
+        max_inflight: int = 0,
+        inflight_ttl_s: float = 0,
+        keep_query_text: bool = True,
+        gzip_backend: str = "auto",
     ):
         self.compile_threshold_ms = compile_threshold_ms
         self.union_threshold = union_threshold
         self.max_query_len = max_query_len
+        self.max_inflight = max_inflight
+        self.inflight_ttl_s = inflight_ttl_s
+        # False: per-query records carry only the fingerprint; the normalised
+        # text is stored once per shape in self.shapes
+        self.keep_query_text = keep_query_text
+        self.gzip_backend = gzip_backend
 
         # aggregates
         self.per_user_stats = defaultdict(lambda: {
@@ -118,80 +768,379 @@ class HiveServer2LogAnalyzer:
             "sum_compile_ms": 0,
         })
 
+        # compile-time quantile sketches per user, per hour and overall
+        self.user_sketches: Dict[str, QuantileSketch] = defaultdict(QuantileSketch)
+        self.hour_sketches: Dict[str, QuantileSketch] = defaultdict(QuantileSketch)
+        self.global_sketch = QuantileSketch()
+
+        # fingerprint -> QueryShape
+        self.shapes: Dict[str, QueryShape] = {}
+
+        # host -> "YYYY-MM-DD HH" -> stats (only filled by process_logs_merged)
+        self.per_host_hour_stats = defaultdict(lambda: defaultdict(lambda: {
+            "compile_starts": 0,
+            "total_queries": 0,
+            "slow_queries": 0,
+            "sum_compile_ms": 0,
+            "peak_concurrent_compiles": 0,
+        }))
+        # host -> compiles currently open (started, not completed or evicted)
+        self.host_open: Dict[str, int] = defaultdict(int)
+
         self.parse_errors = 0
 
-    def process_logs(self, log_paths: List[Path], csv_writer: csv.DictWriter) -> None:
-        inflight: Dict[str, InFlightQuery] = {}
+        # queryId -> start event still waiting for its "Completed compiling command"
+        self.inflight = InflightStore(max_inflight, inflight_ttl_s, on_evict=self._on_evict)
+        self.ends_without_start = 0
+        # Optional csv.DictWriter(INCOMPLETE_FIELDNAMES) for evicted/orphaned queries
+        self.incomplete_writer: Optional[csv.DictWriter] = None
+        # path -> byte offset to start reading from / offset reached (incremental mode)
+        self.file_offsets: Dict[str, int] = {}
+
+    def parse_line(self, raw: bytes) -> Optional[Tuple]:
+        """Turn one raw log line into a start/end event tuple, or None."""
+        # Cheap prefilter: >99% of HS2 lines are neither event
+        if EVENT_MARKER not in raw:
+            return None
+        line = raw.decode("utf-8", errors="ignore")
+
+        # START: Compiling command
+        start_match = COMPILE_START_RE.search(line)
+        if start_match:
+            try:
+                query_id = start_match.group("queryId").strip()
+                user = sys.intern(start_match.group("user").strip())
+                query = start_match.group("query").strip()
+
+                # Avoid unbounded memory for extremely long queries
+                if len(query) > self.max_query_len:
+                    query = query[: self.max_query_len] + " --[TRUNCATED]"
+            except Exception:
+                self.parse_errors += 1
+                return None
+            return ("start", query_id, user, query, parse_timestamp(line))
 
+        # END: Completed compiling command
+        end_match = COMPILE_END_RE.search(line)
+        if end_match:
+            try:
+                query_id = end_match.group("queryId").strip()
+                compile_time_ms = int(end_match.group("compileTime"))
+            except Exception:
+                self.parse_errors += 1
+                return None
+            return ("end", query_id, compile_time_ms, parse_timestamp(line))
+
+        return None
+
+    def iter_events(
+        self,
+        path: Path,
+        start_offset: int = 0,
+        complete_lines_only: bool = False,
+    ) -> Iterator[Tuple]:
+        """
+        Yield compile events from one log file, in line order:
+          ("start", query_id, user, query, ts)
+          ("end", query_id, compile_time_ms, ts)
+
+        Reading starts at start_offset (bytes of decompressed log). When the
+        file is exhausted, the offset reached is stored in file_offsets. With
+        complete_lines_only, a trailing line without a newline (still being
+        written) is not consumed and is picked up by the next run.
+        """
+        progress = {"offset": start_offset}
+        with open_log_stream(path, self.gzip_backend) as f:
+            for raw in scan_marked_lines(f, EVENT_MARKER, start_offset, complete_lines_only, progress):
+                event = self.parse_line(raw)
+                if event is not None:
+                    yield event
+
+        self.file_offsets[str(path)] = progress["offset"]
+
+    def process_logs(
+        self,
+        log_paths: List[Path],
+        csv_writer: csv.DictWriter,
+        complete_lines_only: bool = False,
+    ) -> None:
         for path in log_paths:
-            with open_maybe_gzip(path) as f:
-                for line in f:
-                    line_ts = parse_timestamp(line)
-
-                    # START: Compiling command
-                    start_match = COMPILE_START_RE.search(line)
-                    if start_match:
-                        try:
-                            query_id = start_match.group("queryId").strip()
-                            user = start_match.group("user").strip()
-                            query = start_match.group("query").strip()
-
-                            # Avoid unbounded memory for extremely long queries
-                            if len(query) > self.max_query_len:
-                                query = query[: self.max_query_len] + " --[TRUNCATED]"
-
-                            inflight[query_id] = InFlightQuery(
-                                query_id=query_id,
-                                user=user,
-                                query=query,
-                                start_ts=line_ts,
-                            )
-                        except Exception:
-                            self.parse_errors += 1
-                        continue
-
-                    # END: Completed compiling command
-                    end_match = COMPILE_END_RE.search(line)
-                    if end_match:
-                        try:
-                            query_id = end_match.group("queryId").strip()
-                            compile_time_ms = int(end_match.group("compileTime"))
-
-                            infl = inflight.pop(query_id, None)
-                            if infl is None:
-                                # We saw an end without a start (rotated log or pattern mismatch)
-                                # You can choose to log this somewhere.
-                                continue
-
-                            union_count = len(UNION_ALL_RE.findall(infl.query))
-                            slow = compile_time_ms > self.compile_threshold_ms
-                            excessive_unions = union_count > self.union_threshold
-
-                            rec = QueryRecord(
-                                query_id=query_id,
-                                user=infl.user,
-                                compile_time_ms=compile_time_ms,
-                                union_count=union_count,
-                                slow_compile=slow,
-                                excessive_unions=excessive_unions,
-                                start_ts=infl.start_ts.isoformat() if infl.start_ts else None,
-                                end_ts=line_ts.isoformat() if line_ts else None,
-                                source_log=str(path),
-                                query=infl.query,
-                            )
-
-                            self._emit_record(rec, csv_writer)
-
-                        except Exception:
-                            self.parse_errors += 1
-                        continue
+            start_offset = self.file_offsets.get(str(path), 0)
+            for event in self.iter_events(path, start_offset, complete_lines_only):
+                rec = self.handle_event(event, path)
+                if rec is not None:
+                    self._emit_record(rec, csv_writer)
 
         # Note: any remaining inflight entries represent queries that never completed
         # (e.g., in-progress at time of log cut). You can optionally export them.
 
+    def iter_host_events(
+        self,
+        host: str,
+        log_paths: List[Path],
+        rank: int,
+        complete_lines_only: bool = False,
+    ) -> Iterator[Tuple]:
+        """
+        Yield (sort_ts, rank, host, path, event) for one HS2 instance, reading
+        its files (oldest first) one at a time. sort_ts never goes backwards:
+        lines without a timestamp, or out of order, sort at the newest
+        timestamp seen so far, which keeps the k-way merge valid.
+        """
+        clock = datetime.min
+        for path in log_paths:
+            start_offset = self.file_offsets.get(str(path), 0)
+            for event in self.iter_events(path, start_offset, complete_lines_only):
+                ts = event[-1]
+                if ts is not None and ts > clock:
+                    clock = ts
+                yield (clock, rank, host, path, event)
+
+    def process_logs_merged(
+        self,
+        host_logs: Dict[str, List[Path]],
+        csv_writer: csv.DictWriter,
+        complete_lines_only: bool = False,
+    ) -> None:
+        """
+        Process logs from several HS2 instances as one time-ordered stream:
+        a heap merges the per-host event streams on line timestamp, so per-hour
+        stats and the inflight TTL see a single log clock, records come out in
+        global time order, and only one file per host is open at a time.
+        HS2 queryIds embed a UUID, so one inflight table serves all hosts.
+        """
+        streams = [
+            self.iter_host_events(host, paths, rank, complete_lines_only)
+            for rank, (host, paths) in enumerate(host_logs.items())
+        ]
+        for _, _, host, path, event in heapq.merge(*streams):
+            rec = self.handle_event(event, path, host)
+            if rec is not None:
+                self._emit_record(rec, csv_writer)
+
+    def handle_event(self, event: Tuple, path, host: str = "") -> Optional[QueryRecord]:
+        """Apply one event to the inflight map; returns the completed record, if any."""
+        if event[0] == "start":
+            entry = self.new_inflight(event, host)
+            if host:
+                replaced = self.inflight.pop(entry.query_id, None)
+                if replaced is not None:
+                    self._close_host_compile(replaced.host)
+                self.host_open[host] += 1
+            self.inflight.put(entry)
+            if host:
+                self._track_concurrency(host, entry.start_ts, start=True)
+            return None
+
+        _, query_id, compile_time_ms, line_ts = event
+        infl = self.inflight.pop(query_id, None)
+        # Pop before advancing the clock so a start is matched before it can expire
+        self.inflight.advance(line_ts)
+        if infl is None:
+            # We saw an end without a start (rotated log, evicted, or pattern mismatch)
+            self._record_end_without_start(query_id, compile_time_ms, line_ts)
+            return None
+        if infl.host:
+            # Count the finishing compile as still running at its end time
+            self._track_concurrency(infl.host, line_ts)
+            self._close_host_compile(infl.host)
+
+        try:
+            return self._build_record(infl, compile_time_ms, line_ts, path)
+        except Exception:
+            self.parse_errors += 1
+            return None
+
+    def _track_concurrency(self, host: str, ts: Optional[datetime], start: bool = False) -> None:
+        if ts is None:
+            return
+        h = self.per_host_hour_stats[host][ts.strftime("%Y-%m-%d %H")]
+        if start:
+            h["compile_starts"] += 1
+        if self.host_open[host] > h["peak_concurrent_compiles"]:
+            h["peak_concurrent_compiles"] = self.host_open[host]
+
+    def _close_host_compile(self, host: str) -> None:
+        if host and self.host_open[host] > 0:
+            self.host_open[host] -= 1
+
+    def new_inflight(self, event: Tuple, host: str = "") -> InFlightQuery:
+        """Build the inflight entry for a start event, registering its query shape."""
+        _, query_id, user, query, line_ts = event
+        fingerprint, normalized = fingerprint_query(query)
+        if fingerprint not in self.shapes:
+            self.shapes[fingerprint] = QueryShape(
+                fingerprint, normalized, len(UNION_ALL_RE.findall(normalized))
+            )
+        return InFlightQuery(
+            query_id=query_id,
+            user=user,
+            query=query if self.keep_query_text else "",
+            start_ts=line_ts,
+            fingerprint=fingerprint,
+            union_count=len(UNION_ALL_RE.findall(query)),
+            host=host,
+        )
+
+    def _on_evict(self, entry: InFlightQuery, reason: str) -> None:
+        self._close_host_compile(entry.host)
+        if self.incomplete_writer is not None:
+            self.incomplete_writer.writerow(incomplete_row(entry, reason))
+
+    def _record_end_without_start(
+        self,
+        query_id: str,
+        compile_time_ms: int,
+        end_ts: Optional[datetime],
+    ) -> None:
+        self.ends_without_start += 1
+        if self.incomplete_writer is not None:
+            self.incomplete_writer.writerow(
+                orphan_end_row(query_id, compile_time_ms, end_ts)
+            )
+
+    def flush_incomplete(self) -> None:
+        """Report starts that never completed; call once no more input follows."""
+        if self.incomplete_writer is None:
+            return
+        for entry in self.inflight.values():
+            self.incomplete_writer.writerow(incomplete_row(entry, "open_at_end"))
+
+    def process_logs_parallel(
+        self,
+        log_paths: List[Path],
+        csv_writer: csv.DictWriter,
+        workers: int,
+        complete_lines_only: bool = False,
+    ) -> None:
+        """
+        Parse each log file in its own worker process, then merge the partial
+        results in the order the files were given. Queries whose start and end
+        land in different (rotated) files are paired here, so the CSV rows and
+        aggregates match a single-threaded process_logs() run. (With inflight
+        limits, capacity/TTL are applied per file in the workers and again to
+        the merged table, so eviction counts can differ slightly.)
+        """
+        inflight = self.inflight
+
+        with tempfile.TemporaryDirectory(prefix="hs2_parts_") as part_dir:
+            jobs = [
+                (str(path), idx, part_dir, self.compile_threshold_ms,
+                 self.union_threshold, self.max_query_len,
+                 self.file_offsets.get(str(path), 0), complete_lines_only,
+                 self.max_inflight, self.inflight_ttl_s, self.keep_query_text,
+                 self.gzip_backend)
+                for idx, path in enumerate(log_paths)
+            ]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # map() yields in submission order, so files are merged in order
+                # while later files are still being parsed.
+                for partial in pool.map(_parse_file_worker, jobs):
+                    self._merge_partial(partial, inflight, csv_writer)
+                    os.remove(partial.part_path)
+
+    def _merge_partial(
+        self,
+        partial: FilePartial,
+        inflight: InflightStore,
+        csv_writer: csv.DictWriter,
+    ) -> None:
+        self.parse_errors += partial.parse_errors
+        self.file_offsets[partial.path] = partial.end_offset
+        self.ends_without_start += partial.ends_without_start
+        for reason, count in partial.evicted.items():
+            inflight.evicted[reason] += count
+        inflight.peak_entries = max(inflight.peak_entries, partial.peak_inflight)
+        if self.incomplete_writer is not None:
+            for row in partial.incomplete_rows:
+                self.incomplete_writer.writerow(row)
+        _merge_counters(self.per_user_stats, partial.per_user_stats, max_keys=("max_compile_ms",))
+        _merge_counters(self.per_hour_stats, partial.per_hour_stats)
+        self.merge_sketches(partial.user_sketches, partial.hour_sketches, partial.global_sketch)
+        self.merge_shapes(partial.shapes)
+
+        orphans = iter(partial.orphan_ends)
+        pending = next(orphans, None)
+        written = 0
+
+        def resolve(orphan: OrphanEnd) -> None:
+            infl = inflight.pop(orphan.query_id, None)
+            inflight.advance(orphan.end_ts)
+            if infl is None:
+                self._record_end_without_start(
+                    orphan.query_id, orphan.compile_time_ms, orphan.end_ts
+                )
+                return
+            try:
+                rec = self._build_record(infl, orphan.compile_time_ms, orphan.end_ts, partial.path)
+                self._emit_record(rec, csv_writer)
+            except Exception:
+                self.parse_errors += 1
+
+        with open(partial.part_path, "r", newline="", encoding="utf-8") as part:
+            for row in csv.reader(part):
+                while pending is not None and pending.position == written:
+                    resolve(pending)
+                    pending = next(orphans, None)
+                # Already counted in the partial aggregates; only copy the row
+                csv_writer.writerow(dict(zip(CSV_FIELDNAMES, row)))
+                written += 1
+        while pending is not None:
+            resolve(pending)
+            pending = next(orphans, None)
+
+        # Starts seen in this file replace whatever earlier files left open
+        for query_id in partial.started_ids:
+            inflight.pop(query_id, None)
+        inflight.update(partial.open_starts)
+
+    def merge_sketches(
+        self,
+        user_sketches: Dict[str, QuantileSketch],
+        hour_sketches: Dict[str, QuantileSketch],
+        global_sketch: Optional[QuantileSketch],
+    ) -> None:
+        for user, sketch in user_sketches.items():
+            self.user_sketches[user].merge(sketch)
+        for hour_key, sketch in hour_sketches.items():
+            self.hour_sketches[hour_key].merge(sketch)
+        if global_sketch is not None:
+            self.global_sketch.merge(global_sketch)
+
+    def merge_shapes(self, shapes: Dict[str, QueryShape]) -> None:
+        for fingerprint, shape in shapes.items():
+            mine = self.shapes.get(fingerprint)
+            if mine is None:
+                self.shapes[fingerprint] = shape
+            else:
+                mine.merge(shape)
+
+    def _build_record(
+        self,
+        infl: InFlightQuery,
+        compile_time_ms: int,
+        end_ts: Optional[datetime],
+        path,
+    ) -> QueryRecord:
+        union_count = infl.union_count
+        return QueryRecord(
+            query_id=infl.query_id,
+            user=infl.user,
+            compile_time_ms=compile_time_ms,
+            union_count=union_count,
+            slow_compile=compile_time_ms > self.compile_threshold_ms,
+            excessive_unions=union_count > self.union_threshold,
+            start_ts=infl.start_ts.isoformat() if infl.start_ts else None,
+            end_ts=end_ts.isoformat() if end_ts else None,
+            host=infl.host,
+            source_log=str(path),
+            fingerprint=infl.fingerprint,
+            query=infl.query,
+        )
+
     def _emit_record(self, rec: QueryRecord, csv_writer: csv.DictWriter) -> None:
-        # Write to CSV
-        csv_writer.writerow(asdict(rec))
+        # Write to CSV (or columnar writer); vars() avoids asdict()'s deep copy
+        csv_writer.writerow(vars(rec))
 
         # Update per-user stats
         u = self.per_user_stats[rec.user]
@@ -199,11 +1148,18 @@ class HiveServer2LogAnalyzer:
         u["total_compile_ms"] += rec.compile_time_ms
         if rec.compile_time_ms > u["max_compile_ms"]:
             u["max_compile_ms"] = rec.compile_time_ms
+        self.user_sketches[rec.user].add(rec.compile_time_ms)
+        self.global_sketch.add(rec.compile_time_ms)
         if rec.slow_compile:
             u["slow_queries"] += 1
         if rec.excessive_unions:
             u["excessive_union_queries"] += 1
 
+        # Update per-fingerprint stats
+        shape = self.shapes.get(rec.fingerprint)
+        if shape is not None:
+            shape.add(rec.compile_time_ms, rec.slow_compile)
+
         # Update per-hour stats (based on start time prefer, else end time)
         ts = rec.start_ts or rec.end_ts
         if ts:
@@ -212,12 +1168,140 @@ class HiveServer2LogAnalyzer:
             h = self.per_hour_stats[hour_key]
             h["total_queries"] += 1
             h["sum_compile_ms"] += rec.compile_time_ms
+            self.hour_sketches[hour_key].add(rec.compile_time_ms)
+            if rec.host:
+                hh = self.per_host_hour_stats[rec.host][hour_key]
+                hh["total_queries"] += 1
+                hh["sum_compile_ms"] += rec.compile_time_ms
+                if rec.slow_compile:
+                    hh["slow_queries"] += 1
+
+    def follow_log(
+        self,
+        path: Path,
+        csv_writer: csv.DictWriter,
+        sink,
+        on_flush,
+        flush_interval: float = 60.0,
+        window_hours: int = 24,
+        poll_interval: float = 1.0,
+        from_start: bool = False,
+    ) -> None:
+        """
+        Run until interrupted, following the active log. Completed queries are
+        written as they arrive; slow or UNION-heavy ones are also sent to the
+        alert sink. Every flush_interval seconds on_flush() is called and
+        per-hour stats older than window_hours (by log clock) are dropped.
+        """
+        last_flush = time.monotonic()
+        latest_ts: Optional[datetime] = None
+
+        for raw in follow_lines(path, poll_interval, from_start):
+            if raw is not None:
+                event = self.parse_line(raw)
+                if event is not None:
+                    if event[-1] is not None and (latest_ts is None or event[-1] > latest_ts):
+                        latest_ts = event[-1]
+                    rec = self.handle_event(event, path)
+                    if rec is not None:
+                        self._emit_record(rec, csv_writer)
+                        if rec.slow_compile or rec.excessive_unions:
+                            sink.send(rec)
+
+            if time.monotonic() - last_flush >= flush_interval:
+                if latest_ts is not None:
+                    self.expire_hours(latest_ts - timedelta(hours=window_hours))
+                on_flush()
+                last_flush = time.monotonic()
+
+    def expire_hours(self, cutoff: datetime) -> None:
+        cutoff_key = cutoff.strftime("%Y-%m-%d %H")
+        for hour_key in [k for k in self.per_hour_stats if k < cutoff_key]:
+            del self.per_hour_stats[hour_key]
+            self.hour_sketches.pop(hour_key, None)
+
+    def restore_state(self, state: dict) -> None:
+        """Seed aggregates and unmatched starts from a previous run's checkpoint."""
+        for user, stats in state.get("per_user", {}).items():
+            self.per_user_stats[user].update(stats)
+        for hour_key, stats in state.get("per_hour", {}).items():
+            self.per_hour_stats[hour_key].update(stats)
+        self.parse_errors = state.get("parse_errors", 0)
+        counters = state.get("inflight_counters", {})
+        self.inflight.evicted.update(counters.get("evicted", {}))
+        self.inflight.peak_entries = counters.get("peak_entries", 0)
+        self.ends_without_start = counters.get("ends_without_start", 0)
+        for query_id, q in state.get("inflight", {}).items():
+            self.inflight.put(InFlightQuery(
+                query_id=query_id,
+                user=sys.intern(q["user"]),
+                query=q["query"],
+                start_ts=datetime.fromisoformat(q["start_ts"]) if q["start_ts"] else None,
+                fingerprint=q.get("fingerprint", ""),
+                union_count=q.get("union_count", 0),
+                host=q.get("host", ""),
+            ))
+            if q.get("host"):
+                self.host_open[q["host"]] += 1
+        for host, hours in state.get("per_host_hour", {}).items():
+            for hour_key, stats in hours.items():
+                self.per_host_hour_stats[host][hour_key].update(stats)
+        for fingerprint, d in state.get("shapes", {}).items():
+            self.shapes[fingerprint] = QueryShape.from_state(fingerprint, d)
+        sketches = state.get("sketches", {})
+        for user, d in sketches.get("per_user", {}).items():
+            self.user_sketches[user] = QuantileSketch.from_state(d)
+        for hour_key, d in sketches.get("per_hour", {}).items():
+            self.hour_sketches[hour_key] = QuantileSketch.from_state(d)
+        if "global" in sketches:
+            self.global_sketch = QuantileSketch.from_state(sketches["global"])
+
+    def export_state(self) -> dict:
+        return {
+            "per_user": self.per_user_stats,
+            "per_hour": self.per_hour_stats,
+            "per_host_hour": self.per_host_hour_stats,
+            "parse_errors": self.parse_errors,
+            "inflight_counters": {
+                "evicted": self.inflight.evicted,
+                "peak_entries": self.inflight.peak_entries,
+                "ends_without_start": self.ends_without_start,
+            },
+            "inflight": {
+                query_id: {
+                    "user": q.user,
+                    "query": q.query,
+                    "start_ts": q.start_ts.isoformat() if q.start_ts else None,
+                    "fingerprint": q.fingerprint,
+                    "union_count": q.union_count,
+                    "host": q.host,
+                }
+                for query_id, q in self.inflight.items()
+            },
+            "shapes": {fp: shape.to_state() for fp, shape in self.shapes.items()},
+            "sketches": {
+                "per_user": {u: sk.to_state() for u, sk in self.user_sketches.items()},
+                "per_hour": {h: sk.to_state() for h, sk in self.hour_sketches.items()},
+                "global": self.global_sketch.to_state(),
+            },
+        }
+
+    def distinct_fingerprints(self) -> int:
+        return sum(1 for s in self.shapes.values() if s.executions)
+
+    def fingerprint_rows(self) -> List[dict]:
+        """Per-shape rows, most total compile time first (the shapes to fix first)."""
+        shapes = [s for s in self.shapes.values() if s.executions]
+        shapes.sort(key=lambda s: s.total_compile_ms, reverse=True)
+        return [s.to_row() for s in shapes]
 
     def build_summary(self) -> dict:
         # finalize per_hour avg
         for hour_key, h in self.per_hour_stats.items():
             if h["total_queries"] > 0:
                 h["avg_compile_ms"] = h["sum_compile_ms"] / h["total_queries"]
+            if hour_key in self.hour_sketches:
+                h.update(self.hour_sketches[hour_key].percentiles())
 
         # finalize per_user avg
         for user, u in self.per_user_stats.items():
@@ -225,17 +1309,458 @@ class HiveServer2LogAnalyzer:
                 u["avg_compile_ms"] = u["total_compile_ms"] / u["total_queries"]
             else:
                 u["avg_compile_ms"] = 0.0
+            if user in self.user_sketches:
+                u.update(self.user_sketches[user].percentiles())
+
+        # finalize per-host per-hour: mean compiles in flight over the hour
+        # (compile time attributed to the hour the query started in)
+        for hours in self.per_host_hour_stats.values():
+            for h in hours.values():
+                h["avg_compile_ms"] = (
+                    h["sum_compile_ms"] / h["total_queries"] if h["total_queries"] else 0.0
+                )
+                h["avg_concurrent_compiles"] = h["sum_compile_ms"] / 3_600_000
 
         summary = {
             "compile_threshold_ms": self.compile_threshold_ms,
             "union_threshold": self.union_threshold,
             "per_user": self.per_user_stats,
             "per_hour": self.per_hour_stats,
+            "per_host_hour": self.per_host_hour_stats,
+            "overall": {
+                "total_queries": self.global_sketch.count,
+                **self.global_sketch.percentiles(),
+            },
             "parse_errors": self.parse_errors,
+            "distinct_fingerprints": self.distinct_fingerprints(),
+            "inflight": {
+                "open": len(self.inflight),
+                "peak_entries": self.inflight.peak_entries,
+                "evicted_capacity": self.inflight.evicted["capacity"],
+                "evicted_ttl": self.inflight.evicted["ttl"],
+                "ends_without_start": self.ends_without_start,
+            },
         }
         return summary
 
 
+# ----------------------------
+# Columnar output (Parquet / Arrow IPC)
+# ----------------------------
+
+class ColumnarRecordWriter:
+    """
+    Drop-in for csv.DictWriter that buffers per-query rows into columns and
+    writes one Parquet row group / Arrow record batch every row_group_size
+    rows. user, host, source_log and fingerprint are dictionary-encoded,
+    timestamps are stored as timestamp[ms]. With query_prefix_chars > 0 only
+    a SHA-1 of the query plus its first N characters are kept.
+
+    Accepts both QueryRecord dicts and the all-string rows read back from the
+    worker part files, so values are coerced on the way in.
+    Requires pyarrow.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        out_format: str = "parquet",
+        row_group_size: int = 100000,
+        query_prefix_chars: int = 0,
+    ):
+        try:
+            import pyarrow as pa
+            import pyarrow.ipc as ipc
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("--out-format parquet/arrow requires pyarrow (pip install pyarrow)")
+        self.pa = pa
+        self.row_group_size = row_group_size
+        self.query_prefix_chars = query_prefix_chars
+
+        fields = [
+            ("query_id", pa.string()),
+            ("user", pa.dictionary(pa.int32(), pa.string())),
+            ("compile_time_ms", pa.int64()),
+            ("union_count", pa.int32()),
+            ("slow_compile", pa.bool_()),
+            ("excessive_unions", pa.bool_()),
+            ("start_ts", pa.timestamp("ms")),
+            ("end_ts", pa.timestamp("ms")),
+            ("host", pa.dictionary(pa.int32(), pa.string())),
+            ("source_log", pa.dictionary(pa.int32(), pa.string())),
+            ("fingerprint", pa.dictionary(pa.int32(), pa.string())),
+        ]
+        if query_prefix_chars:
+            fields.append(("query_hash", pa.string()))
+        fields.append(("query", pa.string()))
+        self.schema = pa.schema(fields)
+        self.columns: Dict[str, list] = {name: [] for name in self.schema.names}
+
+        # Stable, growing dictionaries so every batch extends the previous one
+        # (Arrow IPC files accept dictionary deltas, not replacements).
+        self.dicts: Dict[str, Dict[str, int]] = {
+            "user": {}, "host": {}, "source_log": {}, "fingerprint": {},
+        }
+
+        if out_format == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+            self._write = self.writer.write_table
+        elif out_format == "arrow":
+            self.writer = ipc.new_file(
+                path, self.schema, options=ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            )
+            self._write = self.writer.write_table
+        else:
+            raise ValueError(f"Unknown columnar format: {out_format}")
+
+    def writeheader(self) -> None:
+        pass
+
+    def writerow(self, row: dict) -> None:
+        cols = self.columns
+        cols["query_id"].append(row["query_id"])
+        cols["compile_time_ms"].append(int(row["compile_time_ms"]))
+        cols["union_count"].append(int(row["union_count"]))
+        cols["slow_compile"].append(row["slow_compile"] in (True, "True"))
+        cols["excessive_unions"].append(row["excessive_unions"] in (True, "True"))
+        cols["start_ts"].append(datetime.fromisoformat(row["start_ts"]) if row["start_ts"] else None)
+        cols["end_ts"].append(datetime.fromisoformat(row["end_ts"]) if row["end_ts"] else None)
+        for name in ("user", "host", "source_log", "fingerprint"):
+            codes = self.dicts[name]
+            cols[name].append(codes.setdefault(row[name], len(codes)))
+
+        query = row["query"]
+        if self.query_prefix_chars:
+            cols["query_hash"].append(hashlib.sha1(query.encode("utf-8")).hexdigest())
+            query = query[: self.query_prefix_chars]
+        cols["query"].append(query)
+
+        if len(cols["query_id"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.columns["query_id"]:
+            return
+        pa = self.pa
+        arrays = []
+        for f in self.schema:
+            values = self.columns[f.name]
+            if f.name in self.dicts:
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    pa.array(values, type=pa.int32()),
+                    pa.array(list(self.dicts[f.name]), type=pa.string()),
+                ))
+            else:
+                arrays.append(pa.array(values, type=f.type))
+        self._write(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+@contextmanager
+def open_record_writer(
+    path: str,
+    out_format: str = "csv",
+    append: bool = False,
+    row_group_size: int = 100000,
+    query_prefix_chars: int = 0,
+):
+    """Yield a writer with csv.DictWriter's writerow() for per-query records."""
+    if out_format == "csv":
+        with open(path, "a" if append else "w", newline="", encoding="utf-8") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+            if not append:
+                writer.writeheader()
+            yield writer
+        return
+
+    writer = ColumnarRecordWriter(path, out_format, row_group_size, query_prefix_chars)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+# ----------------------------
+# Alert sinks (follow mode)
+# ----------------------------
+
+# In-flight bounds --follow uses unless given: a compile start whose end
+# never comes (HS2 restart, lost line) would otherwise be kept forever
+FOLLOW_MAX_INFLIGHT = 200000
+FOLLOW_INFLIGHT_TTL_S = 21600
+
+def alert_payload(rec: QueryRecord) -> dict:
+    reasons = []
+    if rec.slow_compile:
+        reasons.append("slow_compile")
+    if rec.excessive_unions:
+        reasons.append("excessive_unions")
+    payload = asdict(rec)
+    payload["alert"] = reasons
+    return payload
+
+
+class StdoutSink:
+    """Alerts as JSON lines on stdout."""
+
+    def send(self, rec: QueryRecord) -> None:
+        sys.stdout.write(json.dumps(alert_payload(rec)) + "\n")
+        sys.stdout.flush()
+
+    def close(self) -> None:
+        pass
+
+
+class FileSink:
+    """Alerts appended as JSON lines to a local file."""
+
+    def __init__(self, path: str):
+        self.f = open(path, "a", encoding="utf-8")
+
+    def send(self, rec: QueryRecord) -> None:
+        self.f.write(json.dumps(alert_payload(rec)) + "\n")
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class UnixSocketSink:
+    """
+    Alerts as JSON lines to a listener on a local Unix stream socket.
+    Reconnects lazily; alerts are dropped (and counted) while nobody listens,
+    so a missing consumer never stalls the analyzer.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sock: Optional[socket.socket] = None
+        self.dropped = 0
+
+    def send(self, rec: QueryRecord) -> None:
+        data = (json.dumps(alert_payload(rec)) + "\n").encode("utf-8")
+        for _ in range(2):
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.settimeout(2.0)
+                    self.sock.connect(self.path)
+                self.sock.sendall(data)
+                return
+            except OSError:
+                self.close()
+        self.dropped += 1
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+def make_alert_sink(spec: str):
+    """stdout | file:/path/alerts.jsonl | unix:/path/alerts.sock"""
+    if spec == "stdout":
+        return StdoutSink()
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec.startswith("unix:"):
+        return UnixSocketSink(spec[len("unix:"):])
+    raise ValueError(f"Unknown alert sink: {spec}")
+
+
+# ----------------------------
+# Parallel workers
+# ----------------------------
+
+def _merge_counters(dst: dict, src: Dict[str, dict], max_keys: Tuple[str, ...] = ()) -> None:
+    for key, stats in src.items():
+        d = dst[key]
+        for name, value in stats.items():
+            if name in max_keys:
+                d[name] = max(d[name], value)
+            else:
+                d[name] += value
+
+
+def _parse_file_worker(job: Tuple) -> FilePartial:
+    (path, idx, part_dir, compile_threshold_ms, union_threshold, max_query_len,
+     start_offset, complete_lines_only, max_inflight, inflight_ttl_s, keep_query_text,
+     gzip_backend) = job
+    analyzer = HiveServer2LogAnalyzer(
+        compile_threshold_ms=compile_threshold_ms,
+        union_threshold=union_threshold,
+        max_query_len=max_query_len,
+        max_inflight=max_inflight,
+        inflight_ttl_s=inflight_ttl_s,
+        keep_query_text=keep_query_text,
+        gzip_backend=gzip_backend,
+    )
+    partial = FilePartial(
+        path=path,
+        part_path=os.path.join(part_dir, f"{idx:06d}.csv"),
+        start_offset=start_offset,
+    )
+    inflight = analyzer.inflight
+    inflight.on_evict = lambda entry, reason: partial.incomplete_rows.append(
+        incomplete_row(entry, reason)
+    )
+    written = 0
+
+    with open(partial.part_path, "w", newline="", encoding="utf-8") as part:
+        writer = csv.DictWriter(part, fieldnames=CSV_FIELDNAMES)
+        for event in analyzer.iter_events(Path(path), start_offset, complete_lines_only):
+            if event[0] == "start":
+                partial.started_ids.add(event[1])
+                inflight.put(analyzer.new_inflight(event))
+                continue
+
+            _, query_id, compile_time_ms, line_ts = event
+            infl = inflight.pop(query_id, None)
+            inflight.advance(line_ts)
+            if infl is None:
+                # Only resolvable against earlier files if this file has not
+                # started the same queryId yet (a local start would shadow it).
+                if query_id not in partial.started_ids:
+                    partial.orphan_ends.append(
+                        OrphanEnd(written, query_id, compile_time_ms, line_ts)
+                    )
+                else:
+                    partial.ends_without_start += 1
+                    partial.incomplete_rows.append(
+                        orphan_end_row(query_id, compile_time_ms, line_ts)
+                    )
+                continue
+
+            try:
+                rec = analyzer._build_record(infl, compile_time_ms, line_ts, path)
+                analyzer._emit_record(rec, writer)
+                written += 1
+            except Exception:
+                analyzer.parse_errors += 1
+
+    partial.open_starts = dict(inflight.entries)
+    partial.evicted = dict(inflight.evicted)
+    partial.peak_inflight = inflight.peak_entries
+    partial.end_offset = analyzer.file_offsets[str(Path(path))]
+    # Plain dicts: defaultdict(lambda) does not pickle
+    partial.per_user_stats = {k: dict(v) for k, v in analyzer.per_user_stats.items()}
+    partial.per_hour_stats = {k: dict(v) for k, v in analyzer.per_hour_stats.items()}
+    partial.shapes = analyzer.shapes
+    partial.user_sketches = dict(analyzer.user_sketches)
+    partial.hour_sketches = dict(analyzer.hour_sketches)
+    partial.global_sketch = analyzer.global_sketch
+    partial.parse_errors = analyzer.parse_errors
+    return partial
+
+
+# ----------------------------
+# Incremental checkpoint state
+# ----------------------------
+
+STATE_VERSION = 1
+
+# Bytes of decompressed log hashed to recognise a file after it is renamed or
+# compressed by log rotation (hiveserver2.log -> hiveserver2.log.1.gz).
+HEAD_FINGERPRINT_BYTES = 1024
+
+
+def read_head(path: Path) -> bytes:
+    with open_maybe_gzip_binary(path) as f:
+        return f.read(HEAD_FINGERPRINT_BYTES)
+
+
+def head_digest(head: bytes) -> str:
+    return hashlib.sha1(head).hexdigest()
+
+
+def load_state(state_path: Path) -> dict:
+    if not state_path.exists():
+        return {"version": STATE_VERSION, "files": {}}
+    with open(state_path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("version") != STATE_VERSION:
+        raise ValueError(f"Unsupported state file version in {state_path}: {state.get('version')}")
+    return state
+
+
+def save_state(state_path: Path, state: dict) -> None:
+    # Write-then-rename so a crash never leaves a half-written checkpoint
+    tmp_path = state_path.with_name(state_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, default=str)
+    os.replace(tmp_path, state_path)
+
+
+def plan_incremental(
+    log_paths: List[Path],
+    file_entries: Dict[str, dict],
+) -> Tuple[List[Path], Dict[str, int], Dict[str, dict]]:
+    """
+    Decide where to resume each log file.
+
+    A file is recognised either by path + inode (the active log that keeps
+    growing) or by the digest of its first HEAD_FINGERPRINT_BYTES (a file that
+    was renamed and/or gzipped by rotation). Files whose inode and size are
+    unchanged since the last run are skipped; a file that shrank or whose head
+    changed is treated as new and read from the beginning.
+
+    Returns (paths to parse, start offsets, new file entries).
+    """
+    to_parse: List[Path] = []
+    offsets: Dict[str, int] = {}
+    new_entries: Dict[str, dict] = {}
+
+    for path in log_paths:
+        key = str(path)
+        st = os.stat(path)
+        head = read_head(path)
+        entry = {
+            "inode": st.st_ino,
+            "size": st.st_size,
+            "offset": 0,
+            "head": head_digest(head),
+            "head_len": len(head),
+        }
+
+        prev = file_entries.get(key)
+        if prev is not None and not (
+            prev["inode"] == st.st_ino
+            and prev["head_len"] <= len(head)
+            and head_digest(head[: prev["head_len"]]) == prev["head"]
+        ):
+            prev = None
+        if prev is None and len(head) == HEAD_FINGERPRINT_BYTES:
+            for other in file_entries.values():
+                if other["head_len"] == HEAD_FINGERPRINT_BYTES and other["head"] == entry["head"]:
+                    prev = other
+                    break
+
+        if prev is not None:
+            if prev["inode"] == st.st_ino and prev["size"] == st.st_size:
+                # Already parsed to the end and untouched since
+                entry["offset"] = prev["offset"]
+                new_entries[key] = entry
+                continue
+            if not compressed_suffix(key) and prev["offset"] > st.st_size:
+                prev = None  # truncated in place
+        if prev is not None:
+            entry["offset"] = prev["offset"]
+
+        new_entries[key] = entry
+        offsets[key] = entry["offset"]
+        to_parse.append(path)
+
+    return to_parse, offsets, new_entries
+
+
 # ----------------------------
 # CLI
 # ----------------------------
@@ -247,8 +1772,24 @@ def parse_args() -> argparse.Namespace:
     p.add_argument(
         "--logs",
         nargs="+",
-        required=True,
-        help="Paths to hiveserver2 log files (plain or .gz)",
+        default=[],
+        help="Paths to hiveserver2 log files (plain, .gz or .bz2)",
+    )
+    p.add_argument(
+        "--host-logs",
+        action="append",
+        default=[],
+        metavar="HOST=PATH[,PATH...]",
+        help="Logs of one HS2 instance, oldest file first; repeat per host. The "
+             "hosts are merged into one time-ordered stream with a host column "
+             "and per-host per-hour concurrency stats",
+    )
+    p.add_argument(
+        "--gzip-backend",
+        choices=GZIP_BACKENDS,
+        default="auto",
+        help="Decompressor for .gz logs: auto (isal if installed, else zlib), "
+             "gzip, zlib, isal or pigz (external `pigz -dc` process)",
     )
     p.add_argument(
         "--compile-threshold-ms",
@@ -268,56 +1809,312 @@ def parse_args() -> argparse.Namespace:
         default=20000,
         help="Max query length to store; longer queries are truncated",
     )
+    p.add_argument(
+        "--max-inflight",
+        type=int,
+        default=None,
+        help="Max compile starts kept waiting for their end event; the oldest "
+             f"are evicted beyond this, 0 = unbounded (default {FOLLOW_MAX_INFLIGHT} "
+             "with --follow, else 0)",
+    )
+    p.add_argument(
+        "--inflight-ttl-s",
+        type=float,
+        default=None,
+        help="Evict compile starts older than this many seconds of log time "
+             f"without an end event, 0 = never (default {FOLLOW_INFLIGHT_TTL_S} "
+             "with --follow, else 0)",
+    )
     p.add_argument(
         "--out-queries",
-        default="hs2_queries.csv",
-        help="Output CSV file with per-query records",
+        default=None,
+        help="Output file with per-query records (default hs2_queries.<format>)",
+    )
+    p.add_argument(
+        "--out-format",
+        choices=["csv", "parquet", "arrow"],
+        default="csv",
+        help="Format of the per-query records (parquet/arrow need pyarrow)",
+    )
+    p.add_argument(
+        "--row-group-size",
+        type=int,
+        default=100000,
+        help="With parquet/arrow, rows buffered per row group / record batch",
+    )
+    p.add_argument(
+        "--query-prefix-chars",
+        type=int,
+        default=0,
+        help="With parquet/arrow, store a SHA-1 of the query plus only its first "
+             "N characters (0 = store the full, possibly truncated, query)",
     )
     p.add_argument(
         "--out-summary",
         default="hs2_summary.json",
         help="Output JSON file with aggregates (per user & per hour)",
     )
-    return p.parse_args()
+    p.add_argument(
+        "--out-fingerprints",
+        default="hs2_fingerprints.csv",
+        help="Output CSV with per-fingerprint (query shape) aggregates, "
+             "most total compile time first",
+    )
+    p.add_argument(
+        "--query-text",
+        choices=["full", "none"],
+        default="full",
+        help="'none' keeps only the fingerprint per query (the normalised text "
+             "is written once per shape to --out-fingerprints)",
+    )
+    p.add_argument(
+        "--out-incomplete",
+        default=None,
+        help="Optional CSV of queries that never completed: evicted starts, "
+             "starts still open at the end, and ends without a start",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Parse log files in N worker processes (1 = single-threaded)",
+    )
+    p.add_argument(
+        "--state-file",
+        default=None,
+        help="Checkpoint file for incremental runs: only bytes appended since the "
+             "previous run are parsed and aggregates are merged into its summary",
+    )
+    p.add_argument(
+        "--follow",
+        action="store_true",
+        help="Run as a daemon following the (single) active log like tail -F",
+    )
+    p.add_argument(
+        "--from-start",
+        action="store_true",
+        help="With --follow, read the log from the beginning instead of its end",
+    )
+    p.add_argument(
+        "--alert-sink",
+        default="stdout",
+        help="With --follow, where slow/UNION-heavy queries are reported: "
+             "stdout, file:/path/alerts.jsonl or unix:/path/alerts.sock",
+    )
+    p.add_argument(
+        "--flush-interval",
+        type=float,
+        default=60.0,
+        help="With --follow, seconds between summary flushes",
+    )
+    p.add_argument(
+        "--window-hours",
+        type=int,
+        default=24,
+        help="With --follow, hours of per-hour stats kept in the summary",
+    )
+    args = p.parse_args()
+    if bool(args.logs) == bool(args.host_logs):
+        p.error("give either --logs or --host-logs")
+    args.host_map = {}
+    for spec in args.host_logs:
+        host, sep, paths = spec.partition("=")
+        if not sep or not host or not paths:
+            p.error(f"--host-logs expects HOST=PATH[,PATH...], got {spec!r}")
+        args.host_map.setdefault(host, []).extend(paths.split(","))
+    if args.host_logs:
+        if args.follow:
+            p.error("--follow cannot be combined with --host-logs")
+        if args.workers > 1:
+            print("--host-logs merges hosts in a single process; ignoring --workers",
+                  file=sys.stderr)
+        args.logs = [path for paths in args.host_map.values() for path in paths]
+    if args.follow and len(args.logs) != 1:
+        p.error("--follow takes exactly one log file")
+    if args.follow and args.state_file:
+        p.error("--follow cannot be combined with --state-file")
+    if args.follow and args.out_format != "csv":
+        p.error("--follow writes CSV only")
+    # A daemon never reaches end of input, so its in-flight store must be bounded
+    if args.max_inflight is None:
+        args.max_inflight = FOLLOW_MAX_INFLIGHT if args.follow else 0
+    if args.inflight_ttl_s is None:
+        args.inflight_ttl_s = FOLLOW_INFLIGHT_TTL_S if args.follow else 0
+    if args.follow and not args.max_inflight and not args.inflight_ttl_s:
+        p.error("--follow needs a non-zero --max-inflight or --inflight-ttl-s")
+    if args.out_queries is None:
+        args.out_queries = {"csv": "hs2_queries.csv", "parquet": "hs2_queries.parquet",
+                            "arrow": "hs2_queries.arrow"}[args.out_format]
+    return args
+
+
+def write_summary(analyzer: HiveServer2LogAnalyzer, out_summary: str) -> None:
+    summary = analyzer.build_summary()
+    tmp_path = out_summary + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, default=str)
+    os.replace(tmp_path, out_summary)
+
+
+def write_fingerprints(analyzer: HiveServer2LogAnalyzer, out_fingerprints: str) -> None:
+    tmp_path = out_fingerprints + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=FINGERPRINT_FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(analyzer.fingerprint_rows())
+    os.replace(tmp_path, out_fingerprints)
+
+
+def run_follow(args: argparse.Namespace, analyzer: HiveServer2LogAnalyzer) -> None:
+    sink = make_alert_sink(args.alert_sink)
+
+    def on_term(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, on_term)
+
+    with open(args.out_queries, "a", newline="", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+        if csvfile.tell() == 0:
+            writer.writeheader()
+
+        def on_flush():
+            csvfile.flush()
+            write_summary(analyzer, args.out_summary)
+            write_fingerprints(analyzer, args.out_fingerprints)
+
+        print(f"Following {args.logs[0]} (alerts -> {args.alert_sink})", file=sys.stderr)
+        try:
+            analyzer.follow_log(
+                Path(args.logs[0]),
+                writer,
+                sink,
+                on_flush,
+                flush_interval=args.flush_interval,
+                window_hours=args.window_hours,
+                from_start=args.from_start,
+            )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            analyzer.flush_incomplete()
+            on_flush()
+            sink.close()
 
 
 def main():
     args = parse_args()
 
-    log_paths = [Path(p) for p in args.logs]
-
     analyzer = HiveServer2LogAnalyzer(
         compile_threshold_ms=args.compile_threshold_ms,
         union_threshold=args.union_threshold,
         max_query_len=args.max_query_len,
+        max_inflight=args.max_inflight,
+        inflight_ttl_s=args.inflight_ttl_s,
+        keep_query_text=args.query_text == "full",
+        gzip_backend=args.gzip_backend,
     )
 
-    # Stream output CSV
-    fieldnames = [
-        "query_id",
-        "user",
-        "compile_time_ms",
-        "union_count",
-        "slow_compile",
-        "excessive_unions",
-        "start_ts",
-        "end_ts",
-        "source_log",
-        "query",
-    ]
-
-    with open(args.out_queries, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    incomplete_file = None
+    if args.out_incomplete:
+        incomplete_file = open(args.out_incomplete, "w", newline="", encoding="utf-8")
+        analyzer.incomplete_writer = csv.DictWriter(incomplete_file, fieldnames=INCOMPLETE_FIELDNAMES)
+        analyzer.incomplete_writer.writeheader()
 
-        analyzer.process_logs(log_paths, writer)
+    try:
+        run_analysis(args, analyzer)
+    finally:
+        if incomplete_file is not None:
+            incomplete_file.close()
 
-    summary = analyzer.build_summary()
-    with open(args.out_summary, "w", encoding="utf-8") as f:
-        json.dump(summary, f, indent=2, default=str)
 
-    print(f"Wrote per-query CSV to {args.out_queries}")
+def run_analysis(args: argparse.Namespace, analyzer: HiveServer2LogAnalyzer) -> None:
+    log_paths = [Path(p) for p in args.logs]
+    host_map = {host: [Path(p) for p in paths] for host, paths in args.host_map.items()}
+
+    if args.follow:
+        run_follow(args, analyzer)
+        return
+
+    state = None
+    resuming = False
+    if args.state_file:
+        state_path = Path(args.state_file)
+        state = load_state(state_path)
+        resuming = bool(state["files"])
+        if resuming and (
+            state.get("compile_threshold_ms") != args.compile_threshold_ms
+            or state.get("union_threshold") != args.union_threshold
+        ):
+            sys.exit(
+                f"Thresholds differ from the ones recorded in {state_path}; "
+                "use a new --state-file to re-baseline"
+            )
+        analyzer.restore_state(state)
+        log_paths, offsets, file_entries = plan_incremental(log_paths, state["files"])
+        pending = set(log_paths)
+        host_map = {
+            host: [Path(p) for p in paths if Path(p) in pending]
+            for host, paths in args.host_map.items()
+        }
+        analyzer.file_offsets.update(offsets)
+        skipped = len(args.logs) - len(log_paths)
+        if skipped:
+            print(f"Skipping {skipped} log file(s) already parsed to the end")
+
+    # Stream output; incremental runs only add the newly completed queries:
+    # appended to the CSV, or as a new per-run file for parquet/arrow.
+    out_queries = args.out_queries
+    append = False
+    if resuming and args.out_format == "csv":
+        append = os.path.exists(out_queries)
+    elif resuming:
+        stem, ext = os.path.splitext(out_queries)
+        out_queries = f"{stem}.{datetime.now().strftime('%Y%m%dT%H%M%S')}{ext}"
+
+    with open_record_writer(
+        out_queries,
+        args.out_format,
+        append=append,
+        row_group_size=args.row_group_size,
+        query_prefix_chars=args.query_prefix_chars,
+    ) as writer:
+        if host_map:
+            analyzer.process_logs_merged(host_map, writer, complete_lines_only=state is not None)
+        elif args.workers > 1 and len(log_paths) > 1:
+            analyzer.process_logs_parallel(
+                log_paths, writer, args.workers, complete_lines_only=state is not None
+            )
+        else:
+            analyzer.process_logs(log_paths, writer, complete_lines_only=state is not None)
+
+    # Open starts are carried over in the checkpoint; otherwise they are final
+    if state is None:
+        analyzer.flush_incomplete()
+
+    write_summary(analyzer, args.out_summary)
+    write_fingerprints(analyzer, args.out_fingerprints)
+
+    if state is not None:
+        for key, entry in file_entries.items():
+            entry["offset"] = analyzer.file_offsets.get(key, entry["offset"])
+        # Keep entries for files not passed this time, as long as they still exist
+        for key, entry in state["files"].items():
+            if key not in file_entries and os.path.exists(key):
+                file_entries[key] = entry
+        new_state = {
+            "version": STATE_VERSION,
+            "compile_threshold_ms": args.compile_threshold_ms,
+            "union_threshold": args.union_threshold,
+            "files": file_entries,
+        }
+        new_state.update(analyzer.export_state())
+        save_state(state_path, new_state)
+        print(f"Wrote checkpoint to {state_path}")
+
+    print(f"Wrote per-query {args.out_format} to {out_queries}")
     print(f"Wrote summary JSON to {args.out_summary}")
+    print(f"Wrote {analyzer.distinct_fingerprints()} query fingerprints to {args.out_fingerprints}")
     print(f"Parse errors: {analyzer.parse_errors}")
 
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for hs2_anlyzer.py.
+
+Generates a synthetic HiveServer2 log (a few percent compile events mixed
+into ordinary INFO noise) and reports:
+
+  scanner   lines/second for the line scanner before and after the literal
+            prefilter / block scanner
+  backends  decompression + scan throughput for plain, .gz (per gzip
+            backend) and .bz2 copies of the same log
+
+Example:
+    python3 hs2_benchmark.py --size-mb 2048 --log /data/tmp/hs2_bench.log
+    python3 hs2_benchmark.py --suite backends --size-mb 512
+"""
+import argparse
+import bz2
+import gzip
+import os
+import random
+import re
+import shutil
+import subprocess
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from hs2_anlyzer import HiveServer2LogAnalyzer, open_maybe_gzip, resolve_gzip_backend
+
+# ----------------------------
+# Synthetic log generation
+# ----------------------------
+
+NOISE_TEMPLATES = [
+    "INFO  org.apache.hive.service.cli.thrift.ThriftCLIService: [HiveServer2-Handler-Pool: Thread-{t}]: Client protocol version: HIVE_CLI_SERVICE_PROTOCOL_V10",
+    "INFO  org.apache.hadoop.hive.ql.session.SessionState: [HiveServer2-Handler-Pool: Thread-{t}]: Updating thread name to {s}",
+    "INFO  org.apache.hadoop.hive.conf.HiveConf: [HiveServer2-Handler-Pool: Thread-{t}]: Using the default value passed in for log id: {s}",
+    "INFO  org.apache.hadoop.hive.ql.Driver: [HiveServer2-Background-Pool: Thread-{t}]: Executing command(queryId=hive_{s}): SELECT 1",
+    "WARN  org.apache.hadoop.hive.metastore.RetryingMetaStoreClient: [pool-{t}-thread-1]: MetaStoreClient lost connection. Attempting to reconnect (1 of 1) after 1s.",
+]
+
+USERS = ["svc_hue", "svc_tableau", "etl_batch", "analyst1", "analyst2"]
+
+
+def generate_log(path: Path, size_mb: int, event_rate: float, seed: int = 42) -> int:
+    """Write a synthetic log of roughly size_mb MiB; returns the line count."""
+    rnd = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    ts = datetime(2024, 11, 14, 0, 0, 0)
+    open_ids = []
+    written = 0
+    lines = 0
+    seq = 0
+
+    with open(path, "w", encoding="utf-8") as f:
+        buf = []
+        while written < target:
+            ts += timedelta(milliseconds=rnd.randint(1, 50))
+            stamp = ts.strftime("%Y-%m-%d %H:%M:%S,") + f"{ts.microsecond // 1000:03d}"
+            seq += 1
+            r = rnd.random()
+            if r < event_rate / 2:
+                qid = f"hive_{seq}"
+                unions = " UNION ALL SELECT b FROM u" * rnd.randint(0, 6)
+                line = (
+                    f"{stamp} INFO  org.apache.hadoop.hive.ql.Driver: [HiveServer2-Handler-Pool: Thread-{seq % 64}]: "
+                    f"Compiling command(queryId={qid}): user={rnd.choice(USERS)}; "
+                    f"query=SELECT a FROM t WHERE x={seq}{unions}\n"
+                )
+                open_ids.append(qid)
+            elif r < event_rate and open_ids:
+                qid = open_ids.pop(rnd.randrange(len(open_ids)))
+                line = (
+                    f"{stamp} INFO  org.apache.hadoop.hive.ql.Driver: [HiveServer2-Handler-Pool: Thread-{seq % 64}]: "
+                    f"Completed compiling command(queryId={qid}); compileTime={rnd.randint(1, 30000)}ms\n"
+                )
+            else:
+                line = f"{stamp} " + rnd.choice(NOISE_TEMPLATES).format(t=seq % 64, s=seq) + "\n"
+            buf.append(line)
+            written += len(line)
+            lines += 1
+            if len(buf) >= 10000:
+                f.write("".join(buf))
+                buf = []
+        f.write("".join(buf))
+    return lines
+
+
+# ----------------------------
+# Scanners under test
+# ----------------------------
+
+# The pre-prefilter scanner: regex + strptime timestamp on every line, then
+# both compile regexes.
+LEGACY_TIMESTAMP_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3})")
+LEGACY_START_RE = re.compile(
+    r"Compiling command\(queryId=(?P<queryId>[^)]+)\).*?"
+    r"user=(?P<user>[^;]+);.*?"
+    r"query=(?P<query>.*)$",
+    re.IGNORECASE,
+)
+LEGACY_END_RE = re.compile(
+    r"Completed compiling command\(queryId=(?P<queryId>[^)]+)\).*?"
+    r"compileTime=(?P<compileTime>\d+)ms",
+    re.IGNORECASE,
+)
+
+
+def scan_legacy(path: Path) -> int:
+    events = 0
+    with open_maybe_gzip(path) as f:
+        for line in f:
+            m = LEGACY_TIMESTAMP_RE.match(line)
+            if m:
+                try:
+                    datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S,%f")
+                except ValueError:
+                    pass
+            if LEGACY_START_RE.search(line):
+                events += 1
+                continue
+            if LEGACY_END_RE.search(line):
+                events += 1
+    return events
+
+
+def scan_prefilter(path: Path) -> int:
+    analyzer = HiveServer2LogAnalyzer()
+    return sum(1 for _ in analyzer.iter_events(path))
+
+
+def count_lines(path: Path) -> int:
+    with open_maybe_gzip(path) as f:
+        return sum(1 for _ in f)
+
+
+def scan_text_mode(path: Path) -> int:
+    # The pre-block-reader path: text-mode decompression of every line
+    events = 0
+    with open_maybe_gzip(path) as f:
+        for line in f:
+            if "ompiling command(" in line:
+                events += 1
+    return events
+
+
+def scan_backend(backend: str):
+    def scan(path: Path) -> int:
+        analyzer = HiveServer2LogAnalyzer(gzip_backend=backend)
+        return sum(1 for _ in analyzer.iter_events(path))
+    return scan
+
+
+def compress_copy(src: Path, suffix: str) -> Path:
+    dst = Path(str(src) + suffix)
+    if dst.exists():
+        return dst
+    print(f"Compressing {src} -> {dst} ...")
+    tool = {".gz": "gzip", ".bz2": "bzip2"}[suffix]
+    if shutil.which(tool):
+        with open(dst, "wb") as out:
+            subprocess.run([tool, "-c", str(src)], stdout=out, check=True)
+    else:
+        opener = gzip.open if suffix == ".gz" else bz2.open
+        with open(src, "rb") as fin, opener(dst, "wb") as fout:
+            shutil.copyfileobj(fin, fout, 4 * 1024 * 1024)
+    return dst
+
+
+def gzip_backends_available():
+    backends = ["gzip", "zlib"]
+    if resolve_gzip_backend("auto") == "isal":
+        backends.append("isal")
+    if shutil.which("pigz"):
+        backends.append("pigz")
+    return backends
+
+
+def run_backends_suite(path: Path, lines: int, raw_mb: float) -> list:
+    gz = compress_copy(path, ".gz")
+    bz = compress_copy(path, ".bz2")
+
+    cases = [("plain", "block", path, scan_backend("auto"))]
+    cases.append((".gz", "text-mode", gz, scan_text_mode))
+    for backend in gzip_backends_available():
+        cases.append((".gz", backend, gz, scan_backend(backend)))
+    cases.append((".bz2", "text-mode", bz, scan_text_mode))
+    cases.append((".bz2", "block", bz, scan_backend("auto")))
+
+    print(f"{'input':<6} {'reader':<10} {'on disk':>10} {'elapsed':>10} {'MiB/s':>10} {'lines/s':>14}")
+    for kind, reader, p, fn in cases:
+        t0 = time.perf_counter()
+        events = fn(p)
+        elapsed = time.perf_counter() - t0
+        size_mb = os.path.getsize(p) / 1024 / 1024
+        print(
+            f"{kind:<6} {reader:<10} {size_mb:>8.0f}Mi {elapsed:>9.2f}s "
+            f"{raw_mb / elapsed:>10.1f} {lines / elapsed:>14,.0f}   events={events}"
+        )
+    return [gz, bz]
+
+
+def run_scanner(name, fn, path: Path, lines: int) -> float:
+    t0 = time.perf_counter()
+    events = fn(path)
+    elapsed = time.perf_counter() - t0
+    rate = lines / elapsed if elapsed > 0 else 0.0
+    print(f"{name:<12} {elapsed:>10.2f}s {rate:>16,.0f} lines/s   events={events}")
+    return rate
+
+
+# ----------------------------
+# CLI
+# ----------------------------
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark the HS2 log analyzer line scanner")
+    p.add_argument("--log", default="hs2_bench.log", help="Synthetic log path (generated if missing)")
+    p.add_argument("--size-mb", type=int, default=2048, help="Size of the synthetic log to generate")
+    p.add_argument("--event-rate", type=float, default=0.01, help="Fraction of lines that are compile events")
+    p.add_argument("--keep", action="store_true", help="Keep the generated log after the run")
+    p.add_argument(
+        "--suite",
+        choices=["scanner", "backends", "all"],
+        default="scanner",
+        help="scanner: prefilter before/after; backends: plain vs .gz backends vs .bz2",
+    )
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    path = Path(args.log)
+
+    generated = False
+    if not path.exists():
+        print(f"Generating ~{args.size_mb} MiB synthetic log at {path} ...")
+        lines = generate_log(path, args.size_mb, args.event_rate)
+        generated = True
+    else:
+        lines = count_lines(path)
+
+    raw_mb = os.path.getsize(path) / 1024 / 1024
+    print(f"Lines: {lines:,}   Size: {raw_mb:,.0f} MiB")
+
+    extra = []
+    if args.suite in ("scanner", "all"):
+        print(f"{'scanner':<12} {'elapsed':>11} {'throughput':>16}")
+        before = run_scanner("legacy", scan_legacy, path, lines)
+        after = run_scanner("prefilter", scan_prefilter, path, lines)
+        if before > 0:
+            print(f"Speedup: {after / before:.1f}x")
+    if args.suite in ("backends", "all"):
+        if args.suite == "all":
+            print()
+        extra = run_backends_suite(path, lines, raw_mb)
+
+    if generated and not args.keep:
+        os.remove(path)
+        for p in extra:
+            os.remove(p)
+
+
+if __name__ == "__main__":
+    main()
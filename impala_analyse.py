@@ -1,10 +1,13 @@
-import cm_client
-from cm_client.rest import ApiException
 from datetime import datetime, timedelta
-import pandas as pd
 from tabulate import tabulate
+import argparse
 import logging
 
+from impala_cm import CMApiError, CMClient
+from impala_cache import RETENTION_DAYS, QueryCache
+from impala_engine import (REGRESSION_QUANTILE, ShapeRollup, WorkloadStats, analyze_batches,
+                           compare_rollups, format_fingerprint)
+
 # ==========================================
 # CONFIGURATION
 # ==========================================
@@ -19,99 +22,68 @@ SERVICE_NAME = 'impala'
 MIN_DURATION_SECONDS = 5.0  # Only analyze queries longer than this
 LOOKBACK_HOURS = 24         # Analyze last 24 hours
 
+# Fetch Settings
+SLICE_MINUTES = 60
+FETCH_WORKERS = 8
+CACHE_DB = 'impala_query_cache.db'  # Shared with new_impala.py / updated_impala.py
+
+# Regression Mode (--regression): the last LOOKBACK_HOURS against the
+# BASELINE_DAYS full UTC days before it, per statement fingerprint
+BASELINE_DAYS = 7
+REGRESSION_THRESHOLD = 0.5  # Flag shapes whose p95 grew by more than 50%
+
 # ==========================================
 # SETUP
 # ==========================================
-pd.set_option('display.max_columns', None)
-pd.set_option('display.width', 1000)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_cm_client():
-    cm_client.configuration.username = CM_USER
-    cm_client.configuration.password = CM_PASS
-    api_url = f"{CM_HOST}:{CM_PORT}/api/v43" # v43 is safe for CDP 7.1.x
-    return cm_client.ApiClient(api_url)
-
-def fetch_impala_queries(api_client):
-    cluster_api = cm_client.ClustersResourceApi(api_client)
-    impala_api = cm_client.ImpalaQueriesResourceApi(api_client)
-    
+def fetch_workload_stats():
     end_time = datetime.utcnow()
     start_time = end_time - timedelta(hours=LOOKBACK_HOURS)
     
-    # Filter: Only queries > 5s to reduce API load and noise
-    filter_str = f'queryDuration > {MIN_DURATION_SECONDS}s'
-    
     logging.info(f"Fetching Impala queries from {start_time} to {end_time}...")
     
-    all_queries = []
-    offset = 0
-    limit = 1000
-    
+    client = CMClient(CM_HOST, CM_PORT, CM_USER, CM_PASS)
     try:
-        while True:
-            # Fetch pages of queries
-            resp = impala_api.get_impala_queries(
-                cluster_name=CLUSTER_NAME,
-                service_name=SERVICE_NAME,
-                filter=filter_str,
-                from_time=start_time,
-                to_time=end_time,
-                limit=limit,
-                offset=offset
+        # Only queries > MIN_DURATION_SECONDS are analysed; the cache holds a
+        # superset, so the threshold is applied locally
+        with QueryCache(CACHE_DB) as cache:
+            cache.refresh(
+                client, CLUSTER_NAME, SERVICE_NAME, start_time, end_time,
+                slice_minutes=SLICE_MINUTES, workers=FETCH_WORKERS
             )
-            
-            if not resp.queries:
-                break
-                
-            for q in resp.queries:
-                # flatten the attributes for easy DataFrame conversion
-                q_data = {
-                    'queryId': q.query_id,
-                    'user': q.user,
-                    'duration': q.attributes.get('query_duration', 0) / 1000.0, # Convert ms to s
-                    'state': q.query_state,
-                    'memory_per_node_peak': q.attributes.get('memory_per_node_peak', 0),
-                    'spilled': str(q.attributes.get('spilled', 'false')).lower() == 'true',
-                    'stats_missing': str(q.attributes.get('stats_missing', 'false')).lower() == 'true',
-                    'admission_wait': q.attributes.get('admission_wait', 0) / 1000.0,
-                    'rows_inserted': q.attributes.get('rows_inserted', 0),
-                    'planning_wait_time': q.attributes.get('planning_wait_time', 0) / 1000.0,
-                    'thread_network_receive_wait_time': q.attributes.get('thread_network_receive_wait_time', 0) / 1000.0
-                }
-                all_queries.append(q_data)
-            
-            offset += len(resp.queries)
-            logging.info(f"Fetched {offset} queries so far...")
-            
-            if len(resp.queries) < limit:
-                break
-                
-    except ApiException as e:
+            # Each cached batch is folded into the aggregates and dropped
+            stats = analyze_batches(cache.iter_batches(
+                CLUSTER_NAME, SERVICE_NAME, start_time, end_time,
+                min_duration_ms=MIN_DURATION_SECONDS * 1000
+            ))
+    except CMApiError as e:
         logging.error(f"CM API Exception: {e}")
-        return pd.DataFrame()
+        return WorkloadStats()
+    finally:
+        client.close()
 
-    return pd.DataFrame(all_queries)
+    logging.info(f"Analyzed {stats.total} queries")
+    return stats
 
-def analyze_performance(df):
-    if df.empty:
+def analyze_performance(stats):
+    if not stats.total:
         print("No queries found matching criteria.")
         return
 
+    total = stats.total
     print("\n" + "="*60)
     print(f"IMPALA PERFORMANCE REPORT (Last {LOOKBACK_HOURS}h)")
     print("="*60)
-    print(f"Total Queries Analyzed (> {MIN_DURATION_SECONDS}s): {len(df)}")
+    print(f"Total Queries Analyzed (> {MIN_DURATION_SECONDS}s): {total}")
     
     # 1. BOTTLENECK OVERVIEW
-    spilled_count = df[df['spilled'] == True].shape[0]
-    missing_stats_count = df[df['stats_missing'] == True].shape[0]
-    high_wait_count = df[df['admission_wait'] > 1.0].shape[0] # Waiting > 1s
+    counts = stats.bottlenecks()  # queued = waiting > 1s
     
     overview = [
-        ["Spilling to Disk (CRITICAL)", spilled_count, f"{(spilled_count/len(df))*100:.1f}%", "Increase MEM_LIMIT or optimize Join"],
-        ["Missing Table Stats (MAJOR)", missing_stats_count, f"{(missing_stats_count/len(df))*100:.1f}%", "Run COMPUTE STATS"],
-        ["Admission Queueing (>1s)", high_wait_count, f"{(high_wait_count/len(df))*100:.1f}%", "Cluster is busy or Pool limits too low"]
+        ["Spilling to Disk (CRITICAL)", counts['spilled'], f"{(counts['spilled']/total)*100:.1f}%", "Increase MEM_LIMIT or optimize Join"],
+        ["Missing Table Stats (MAJOR)", counts['stats_missing'], f"{(counts['stats_missing']/total)*100:.1f}%", "Run COMPUTE STATS"],
+        ["Admission Queueing (>1s)", counts['queued'], f"{(counts['queued']/total)*100:.1f}%", "Cluster is busy or Pool limits too low"]
     ]
     
     print("\n>>> 1. BOTTLENECK DISTRIBUTION")
@@ -119,25 +91,126 @@ def analyze_performance(df):
 
     # 2. TOP OFFENDERS (Longest Duration)
     print("\n>>> 2. TOP 5 SLOWEST QUERIES")
-    top_slow = df.sort_values(by='duration', ascending=False).head(5)
-    print(tabulate(top_slow[['user', 'duration', 'spilled', 'stats_missing', 'queryId']], headers='keys', tablefmt="simple", showindex=False))
+    top_slow = [
+        [q['user'], q['duration_s'], q['spilled'], q['stats_missing'], q['query_id']]
+        for q in stats.slowest(5)
+    ]
+    print(tabulate(top_slow, headers=['user', 'duration', 'spilled', 'stats_missing', 'queryId'], tablefmt="simple"))
 
     # 3. USER RESOURCE HOGS
     print("\n>>> 3. TOP USERS BY TOTAL DURATION")
-    user_agg = df.groupby('user').agg(
-        Total_Duration=('duration', 'sum'),
-        Query_Count=('queryId', 'count'),
-        Spill_Count=('spilled', 'sum')
-    ).sort_values(by='Total_Duration', ascending=False).head(5)
-    print(tabulate(user_agg, headers='keys', tablefmt="simple"))
+    user_agg = [
+        [user, u['total_duration_s'], u['count'], u['spilled']]
+        for user, u in stats.group_by('user').rows('total_duration_s', n=5)
+    ]
+    print(tabulate(user_agg, headers=['user', 'Total_Duration', 'Query_Count', 'Spill_Count'], tablefmt="simple"))
 
     # 4. QUEUE WAIT ANALYSIS
-    if df['admission_wait'].max() > 5:
+    max_wait_s = stats.max_admission_wait_ms / 1000.0
+    if max_wait_s > 5:
         print("\n>>> 4. QUEUE CONGESTION ALERT")
-        print(f"Max Wait Time: {df['admission_wait'].max()}s")
+        print(f"Max Wait Time: {max_wait_s}s")
         print("Queries are waiting in the admission pool. Check your Dynamic Resource Pools configuration.")
 
+def build_rollup(cache, start_time, end_time):
+    rollup = ShapeRollup()
+    for batch in cache.iter_batches(CLUSTER_NAME, SERVICE_NAME, start_time, end_time):
+        rollup.add_records(batch)
+    return rollup
+
+def load_baseline(cache, days):
+    """Merge the daily rollups of `days`, building (and storing) any that are missing."""
+    baseline = ShapeRollup()
+    used = 0
+    for day in days:
+        stored = cache.load_rollup(CLUSTER_NAME, SERVICE_NAME, day.date())
+        if stored is not None:
+            rollup = ShapeRollup.from_bytes(stored[1], queries=stored[0])
+        elif cache.covers(CLUSTER_NAME, SERVICE_NAME, day, day + timedelta(days=1)):
+            rollup = build_rollup(cache, day, day + timedelta(days=1))
+            cache.save_rollup(CLUSTER_NAME, SERVICE_NAME, day.date(), rollup.queries,
+                              rollup.to_bytes(), rollup.statements)
+            logging.info(f"Rolled up {day:%Y-%m-%d}: {rollup.queries} queries")
+        else:
+            logging.warning(f"No history for {day:%Y-%m-%d}; left out of the baseline")
+            continue
+        baseline.merge(rollup)
+        used += 1
+    return baseline, used
+
+def fetch_regressions(baseline_days=BASELINE_DAYS):
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(hours=LOOKBACK_HOURS)
+    first_window_day = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [first_window_day - timedelta(days=k) for k in range(baseline_days, 0, -1)]
+
+    client = CMClient(CM_HOST, CM_PORT, CM_USER, CM_PASS)
+    try:
+        with QueryCache(CACHE_DB) as cache:
+            # Only baseline days without a stored rollup need raw history, and
+            # only as far back as the cache keeps it
+            missing = [d for d in days if cache.load_rollup(CLUSTER_NAME, SERVICE_NAME, d.date()) is None]
+            oldest = end_time - timedelta(days=RETENTION_DAYS)
+            fetch_from = max(min([start_time] + missing), oldest)
+            cache.refresh(
+                client, CLUSTER_NAME, SERVICE_NAME, fetch_from, end_time,
+                slice_minutes=SLICE_MINUTES, workers=FETCH_WORKERS
+            )
+            baseline, used = load_baseline(cache, days)
+            current = build_rollup(cache, start_time, end_time)
+            regressions = compare_rollups(current, baseline, threshold=REGRESSION_THRESHOLD)
+            unknown = {r['fingerprint'] for r in regressions if not r['statement']}
+            statements = cache.shape_statements(CLUSTER_NAME, SERVICE_NAME, unknown)
+            for r in regressions:
+                r['statement'] = r['statement'] or statements.get(r['fingerprint'], '')
+    except CMApiError as e:
+        logging.error(f"CM API Exception: {e}")
+        return None
+    finally:
+        client.close()
+    return current, baseline, used, regressions
+
+def format_metric(metric, value):
+    if metric == 'memory_per_node_peak':
+        return f"{value / 1024**2:.0f} MB"
+    if metric == 'duration_ms':
+        return f"{value / 1000:.1f}s"
+    return f"{value:.0f} ms"
+
+def report_regressions(result):
+    if result is None:
+        return
+    current, baseline, used, regressions = result
+    print("\n" + "="*60)
+    print(f"IMPALA REGRESSION REPORT (Last {LOOKBACK_HOURS}h vs {used}-day baseline)")
+    print("="*60)
+    print(f"Queries: {current.queries} now, {baseline.queries} in baseline")
+    if not regressions:
+        print(f"No query shape regressed by more than {REGRESSION_THRESHOLD:.0%} "
+              f"at p{REGRESSION_QUANTILE * 100:.0f}.")
+        return
+
+    rows = [
+        [format_fingerprint(r['fingerprint']), r['metric'],
+         format_metric(r['metric'], r['baseline']), format_metric(r['metric'], r['current']),
+         f"+{r['change']:.0%}", f"{r['current_queries']}/{r['baseline_queries']}",
+         r['statement'][:60]]
+        for r in regressions
+    ]
+    print(f"\n>>> SHAPES REGRESSED BY > {REGRESSION_THRESHOLD:.0%} (p{REGRESSION_QUANTILE * 100:.0f})")
+    print(tabulate(rows, headers=['Fingerprint', 'Metric', 'Baseline', 'Now', 'Change',
+                                  'Runs (now/base)', 'Statement'], tablefmt="simple"))
+
 if __name__ == "__main__":
-    api_client = get_cm_client()
-    df = fetch_impala_queries(api_client)
-    analyze_performance(df)
+    parser = argparse.ArgumentParser(description="Impala workload report from CM query history")
+    parser.add_argument("--regression", action="store_true",
+                        help="Compare the window against a baseline of previous days per query shape")
+    parser.add_argument("--baseline-days", type=int, default=BASELINE_DAYS,
+                        help=f"Days in the regression baseline (default {BASELINE_DAYS})")
+    args = parser.parse_args()
+
+    if args.regression:
+        report_regressions(fetch_regressions(args.baseline_days))
+    else:
+        stats = fetch_workload_stats()
+        analyze_performance(stats)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the Impala tooling against the fake CM API (impala_fake_cm.py).
+
+For each history size a fake CM server is started in its own process, then
+every stage runs in a fresh child process so its peak RSS is its own:
+
+  fetch     stream every page of the window (impala_cm, no storage):
+            the raw fetch throughput
+  cache     the same fetch stored into an empty query cache, as the tools'
+            fetch_workload_stats does on a cold start
+  report    new_impala: aggregate the cached window (queries > 5s) and
+            render analyze_and_report
+  queuing   updated_impala: aggregate + concurrency timeline and render
+            analyze_queuing
+
+Example:
+    python3 impala_benchmark.py
+    python3 impala_benchmark.py --sizes 10k,100k --latency-ms 20 --error-rate 0.02
+    python3 impala_benchmark.py --sizes 1m --stages fetch,cache --workers 16
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+CLUSTER = 'Cluster 1'
+SERVICE = 'impala'
+END_TIME = datetime(2024, 11, 14)     # Fixed, so every run sees the same history
+STAGES = ['fetch', 'cache', 'report', 'queuing']
+HERE = Path(__file__).resolve().parent
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    scale = {'k': 1000, 'm': 1000 ** 2}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+# ----------------------------
+# Fake CM server
+# ----------------------------
+
+@contextlib.contextmanager
+def fake_cm(queries: int, hours: float, latency_ms: float, error_rate: float, reset_rate: float,
+            processes: int):
+    port = free_port()
+    cmd = [
+        sys.executable, str(HERE / 'impala_fake_cm.py'), '--port', str(port),
+        '--queries', str(queries), '--hours', str(hours), '--end', END_TIME.strftime('%Y-%m-%dT%H:%M:%S'),
+        '--latency-ms', str(latency_ms), '--error-rate', str(error_rate), '--reset-rate', str(reset_rate),
+        '--processes', str(processes),
+    ]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    try:
+        # The server prints one line once the history is generated, one once it listens
+        for _ in range(2):
+            line = server.stdout.readline()
+            if not line:
+                raise RuntimeError(f"Fake CM server exited with {server.wait()}")
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# ----------------------------
+# Stages (run in a child process)
+# ----------------------------
+
+def stage_fetch(args) -> dict:
+    from impala_cache import CACHE_FILTER
+    from impala_cm import CMClient, iter_impala_query_pages
+
+    client = CMClient('http://127.0.0.1', args.port, 'admin', 'admin')
+    start_time = END_TIME - timedelta(hours=args.hours)
+    fetched = 0
+    t0 = time.perf_counter()
+    try:
+        for page in iter_impala_query_pages(client, CLUSTER, SERVICE, start_time, END_TIME, CACHE_FILTER,
+                                            workers=args.workers):
+            fetched += len(page)
+    finally:
+        client.close()
+    return {'elapsed': time.perf_counter() - t0, 'queries': fetched,
+            'requests': client.stats['requests'], 'retries': client.stats['retries']}
+
+
+def stage_cache(args) -> dict:
+    from impala_cache import QueryCache
+    from impala_cm import CMClient
+
+    client = CMClient('http://127.0.0.1', args.port, 'admin', 'admin')
+    start_time = END_TIME - timedelta(hours=args.hours)
+    t0 = time.perf_counter()
+    try:
+        with QueryCache(args.db) as cache:
+            stored = cache.refresh(client, CLUSTER, SERVICE, start_time, END_TIME, workers=args.workers)
+    finally:
+        client.close()
+    return {'elapsed': time.perf_counter() - t0, 'queries': stored,
+            'requests': client.stats['requests'], 'retries': client.stats['retries']}
+
+
+def stage_report(args) -> dict:
+    import new_impala
+    from impala_cache import QueryCache
+    from impala_engine import analyze_batches
+
+    start_time = END_TIME - timedelta(hours=args.hours)
+    t0 = time.perf_counter()
+    with QueryCache(args.db) as cache:
+        stats = analyze_batches(cache.iter_batches(
+            CLUSTER, SERVICE, start_time, END_TIME,
+            min_duration_ms=new_impala.MIN_DURATION_SECONDS * 1000
+        ), top_k=max(5, new_impala.PROFILE_TOP_N))
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_impala.analyze_and_report(stats)
+    return {'elapsed': time.perf_counter() - t0, 'queries': stats.total}
+
+
+def stage_queuing(args) -> dict:
+    import updated_impala
+    from impala_cache import QueryCache
+    from impala_engine import ConcurrencyTimeline, analyze_batches
+
+    updated_impala.TIMELINE_CSV = ''
+    start_time = END_TIME - timedelta(hours=args.hours)
+    t0 = time.perf_counter()
+    with QueryCache(args.db) as cache:
+        timeline = ConcurrencyTimeline(updated_impala.TIMELINE_RESOLUTION_SECONDS,
+                                       updated_impala.SATURATED_FRACTION)
+        stats = analyze_batches(cache.iter_batches(
+            CLUSTER, SERVICE, start_time, END_TIME, min_duration_ms=1000, min_admission_wait_ms=100
+        ), timeline=timeline)
+    with contextlib.redirect_stdout(io.StringIO()):
+        updated_impala.analyze_queuing(stats, timeline)
+    return {'elapsed': time.perf_counter() - t0, 'queries': stats.total}
+
+
+STAGE_FUNCS = {'fetch': stage_fetch, 'cache': stage_cache, 'report': stage_report, 'queuing': stage_queuing}
+
+
+def run_child(args):
+    # The tools log every fetched page at INFO
+    logging.disable(logging.WARNING)
+    result = STAGE_FUNCS[args.child](args)
+    result['rss_mb'] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+def run_stage(stage: str, port: int, db: str, args) -> dict:
+    cmd = [sys.executable, str(Path(__file__).resolve()), '--child', stage, '--port', str(port),
+           '--db', db, '--hours', str(args.hours), '--workers', str(args.workers)]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+# ----------------------------
+# CLI
+# ----------------------------
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark the Impala tools against a fake CM API")
+    p.add_argument("--sizes", default="10k,100k,1m", help="Comma-separated history sizes (k/m suffixes)")
+    p.add_argument("--stages", default=",".join(STAGES), help=f"Subset of {','.join(STAGES)}")
+    p.add_argument("--hours", type=float, default=24, help="Window the history is spread over")
+    p.add_argument("--workers", type=int, default=8, help="Concurrent fetch slices (FETCH_WORKERS)")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="Fake CM latency per request")
+    p.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake CM 503s")
+    p.add_argument("--reset-rate", type=float, default=0.0, help="Fraction of dropped connections")
+    p.add_argument("--server-processes", type=int, default=4,
+                   help="Fake CM processes, so the fake server is not what gets measured")
+    p.add_argument("--workdir", help="Where the cache databases go (default: a temp dir)")
+    # Internal: run one stage and print its result as JSON
+    p.add_argument("--child", choices=STAGES, help=argparse.SUPPRESS)
+    p.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--db", help=argparse.SUPPRESS)
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        sys.exit(f"Unknown stages: {', '.join(sorted(unknown))}")
+    # report / queuing read the cache the cache stage fills
+    if {'report', 'queuing'} & set(stages) and 'cache' not in stages:
+        stages.insert(0, 'cache')
+    stages = [s for s in STAGES if s in stages]
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        print(f"{'queries':>9} {'stage':<8} {'elapsed':>9} {'queries/s':>11} {'requests':>9} "
+              f"{'retries':>8} {'peak RSS':>9}")
+        for size in (parse_size(s) for s in args.sizes.split(",")):
+            db = os.path.join(workdir, f"bench_{size}.db")
+            with fake_cm(size, args.hours, args.latency_ms, args.error_rate, args.reset_rate,
+                         args.server_processes) as port:
+                for stage in stages:
+                    r = run_stage(stage, port, db, args)
+                    rate = r['queries'] / r['elapsed'] if r['elapsed'] > 0 else 0.0
+                    print(f"{size:>9,} {stage:<8} {r['elapsed']:>8.2f}s {rate:>11,.0f} "
+                          f"{r.get('requests', '-'):>9} {r.get('retries', '-'):>8} {r['rss_mb']:>7.0f}Mi",
+                          flush=True)
+
+
+if __name__ == "__main__":
+    main()
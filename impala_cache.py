@@ -0,0 +1,248 @@
+"""
+Local SQLite cache of CM Impala query history, shared by new_impala.py,
+updated_impala.py and impala_analyse.py.
+
+Queries are fetched from CM once with CACHE_FILTER (a superset of what the
+tools need) and stored keyed by (cluster, service, queryId) with an index on
+start time. Each tool then applies its own thresholds locally. Per cluster /
+service the cache remembers which time range it holds, so a run only fetches
+the gap since the previous one (plus REFRESH_OVERLAP_MINUTES, to pick up
+queries that were still running) and repeat runs are served from disk.
+Pre-aggregated daily rollups (opaque blobs built by impala_engine.ShapeRollup)
+are kept alongside for ROLLUP_RETENTION_DAYS, outliving the raw rows.
+Delete the database file to start over.
+"""
+import json
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+from impala_cm import iter_impala_query_pages, parse_cm_time
+
+# ==========================================
+# DEFAULTS
+# ==========================================
+CACHE_DB = 'impala_query_cache.db'
+# Must match every query any of the tools look at
+CACHE_FILTER = 'admissionWait > 100 OR queryDuration > 1s'
+REFRESH_OVERLAP_MINUTES = 30   # Re-fetch this much before the cached end (running queries)
+RETENTION_DAYS = 14            # Rows older than this are pruned on refresh
+BATCH_SIZE = 10000             # Queries per batch handed to the analysis
+ROLLUP_RETENTION_DAYS = 90     # Daily rollups are small; keep them longer than raw rows
+
+EPOCH = datetime(1970, 1, 1)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    cluster TEXT NOT NULL,
+    service TEXT NOT NULL,
+    query_id TEXT NOT NULL,
+    start_time REAL,
+    duration_ms REAL,
+    admission_wait_ms REAL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (cluster, service, query_id)
+);
+CREATE INDEX IF NOT EXISTS queries_start ON queries (cluster, service, start_time);
+CREATE TABLE IF NOT EXISTS coverage (
+    cluster TEXT NOT NULL,
+    service TEXT NOT NULL,
+    filter TEXT NOT NULL,
+    covered_from REAL NOT NULL,
+    covered_to REAL NOT NULL,
+    PRIMARY KEY (cluster, service, filter)
+);
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    cluster TEXT NOT NULL,
+    service TEXT NOT NULL,
+    day TEXT NOT NULL,
+    queries INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (cluster, service, day)
+);
+CREATE TABLE IF NOT EXISTS shape_statements (
+    cluster TEXT NOT NULL,
+    service TEXT NOT NULL,
+    fingerprint INTEGER NOT NULL,
+    statement TEXT NOT NULL,
+    PRIMARY KEY (cluster, service, fingerprint)
+);
+"""
+
+
+def to_epoch(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def from_epoch(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def _float_attr(attrs, name):
+    try:
+        return float(attrs.get(name, 0) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class QueryCache:
+    def __init__(self, path=CACHE_DB, scope=''):
+        self.path = path
+        # Prefixed to the cluster name in every key, so clusters of the same
+        # name on different CM hosts can share one file (see impala_fleet.py)
+        self.scope = scope
+        # Several tools may refresh the same file; WAL lets readers run alongside a writer
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def coverage(self, cluster, service, filter_str=CACHE_FILTER):
+        row = self.conn.execute(
+            'SELECT covered_from, covered_to FROM coverage WHERE cluster=? AND service=? AND filter=?',
+            (self.scope + cluster, service, filter_str),
+        ).fetchone()
+        if row is None:
+            return None
+        return from_epoch(row[0]), from_epoch(row[1])
+
+    def covers(self, cluster, service, start_time, end_time, filter_str=CACHE_FILTER):
+        """True if [start_time, end_time) is entirely within the cached range."""
+        covered = self.coverage(cluster, service, filter_str)
+        return covered is not None and covered[0] <= start_time and end_time <= covered[1]
+
+    def plan_refresh(self, cluster, service, start_time, end_time, filter_str=CACHE_FILTER):
+        """Return the [from, to) ranges that have to be fetched to cover the window."""
+        covered = self.coverage(cluster, service, filter_str)
+        if covered is None or covered[1] < start_time or covered[0] > end_time:
+            return [(start_time, end_time)]
+        covered_from, covered_to = covered
+        ranges = []
+        if start_time < covered_from:
+            ranges.append((start_time, covered_from))
+        refresh_from = max(covered_to - timedelta(minutes=REFRESH_OVERLAP_MINUTES), start_time)
+        if refresh_from < end_time:
+            ranges.append((refresh_from, end_time))
+        return ranges
+
+    def store(self, cluster, service, queries):
+        rows = []
+        for q in queries:
+            attrs = q.get('attributes') or {}
+            start = parse_cm_time(q.get('startTime'))
+            rows.append((
+                self.scope + cluster,
+                service,
+                q.get('queryId'),
+                to_epoch(start) if start else None,
+                _float_attr(attrs, 'query_duration'),
+                _float_attr(attrs, 'admission_wait'),
+                json.dumps(q, separators=(',', ':')),
+            ))
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+        )
+        return len(rows)
+
+    def refresh(self, client, cluster, service, start_time, end_time,
+                filter_str=CACHE_FILTER, **fetch_kwargs):
+        """Fetch whatever part of [start_time, end_time) is not cached yet."""
+        ranges = self.plan_refresh(cluster, service, start_time, end_time, filter_str)
+        covered = self.coverage(cluster, service, filter_str)
+        stored = 0
+        for lo, hi in ranges:
+            logging.info(f"Cache refresh: fetching {lo:%Y-%m-%d %H:%M} -> {hi:%Y-%m-%d %H:%M} UTC")
+            for page in iter_impala_query_pages(client, cluster, service, lo, hi, filter_str,
+                                                **fetch_kwargs):
+                stored += self.store(cluster, service, page)
+                # Short write transactions: other refreshes of the same file
+                # (other clusters, other tools) only wait for one page
+                self.conn.commit()
+
+        if covered is not None and covered[1] >= start_time and covered[0] <= end_time:
+            new_from = min(covered[0], start_time)
+            new_to = max(covered[1], end_time)
+        else:
+            new_from, new_to = start_time, end_time
+        new_from = max(new_from, end_time - timedelta(days=RETENTION_DAYS))
+        self.conn.execute(
+            'INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?)',
+            (self.scope + cluster, service, filter_str, to_epoch(new_from), to_epoch(new_to)),
+        )
+        self.conn.execute(
+            'DELETE FROM queries WHERE cluster=? AND service=? AND start_time < ?',
+            (self.scope + cluster, service, to_epoch(new_from)),
+        )
+        self.conn.commit()
+        logging.info(f"Cache refresh: stored {stored} queries in {self.path}")
+        return stored
+
+    def iter_batches(self, cluster, service, start_time, end_time,
+                     min_duration_ms=0.0, min_admission_wait_ms=None, batch_size=BATCH_SIZE):
+        """
+        Yield lists of at most batch_size cached queries that started in
+        [start_time, end_time), oldest first: duration above min_duration_ms,
+        or (if given) admission wait above min_admission_wait_ms.
+        """
+        sql = ('SELECT record FROM queries WHERE cluster=? AND service=? '
+               'AND start_time >= ? AND start_time < ? ')
+        params = [self.scope + cluster, service, to_epoch(start_time), to_epoch(end_time)]
+        if min_admission_wait_ms is None:
+            sql += 'AND duration_ms > ? '
+            params.append(min_duration_ms)
+        else:
+            sql += 'AND (duration_ms > ? OR admission_wait_ms > ?) '
+            params.extend([min_duration_ms, min_admission_wait_ms])
+        sql += 'ORDER BY start_time'
+        cursor = self.conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [json.loads(row[0]) for row in rows]
+
+    def load_rollup(self, cluster, service, day):
+        """(queries, data) of the stored rollup for a date, or None."""
+        row = self.conn.execute(
+            'SELECT queries, data FROM daily_rollups WHERE cluster=? AND service=? AND day=?',
+            (self.scope + cluster, service, day.isoformat()),
+        ).fetchone()
+        return None if row is None else (row[0], bytes(row[1]))
+
+    def save_rollup(self, cluster, service, day, queries, data, statements):
+        """Store a day's rollup plus the normalised statement of each fingerprint in it."""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO daily_rollups VALUES (?, ?, ?, ?, ?)',
+            (self.scope + cluster, service, day.isoformat(), queries, data),
+        )
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO shape_statements VALUES (?, ?, ?, ?)',
+            [(self.scope + cluster, service, fp, text) for fp, text in statements.items()],
+        )
+        self.conn.execute(
+            'DELETE FROM daily_rollups WHERE cluster=? AND service=? AND day < ?',
+            (self.scope + cluster, service, (day - timedelta(days=ROLLUP_RETENTION_DAYS)).isoformat()),
+        )
+        self.conn.commit()
+
+    def shape_statements(self, cluster, service, fingerprints):
+        """fingerprint -> normalised statement, for the fingerprints that are known."""
+        result = {}
+        fingerprints = list(fingerprints)
+        for i in range(0, len(fingerprints), 500):
+            chunk = fingerprints[i:i + 500]
+            rows = self.conn.execute(
+                'SELECT fingerprint, statement FROM shape_statements WHERE cluster=? AND service=? '
+                f'AND fingerprint IN ({",".join("?" * len(chunk))})',
+                [self.scope + cluster, service] + chunk,
+            )
+            result.update(rows)
+        return result
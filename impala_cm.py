@@ -0,0 +1,256 @@
+"""
+Shared Cloudera Manager API access for the Impala health tools
+(new_impala.py, updated_impala.py, impala_analyse.py).
+
+The lookback window is cut into time slices that are fetched concurrently,
+each worker thread reusing one keep-alive HTTP(S) connection. Transient
+failures (connection resets, 429/5xx) are retried with exponential backoff.
+A slice whose first page comes back full is split in half until it either
+fits in one page or reaches MIN_SLICE_SECONDS, at which point it is paged
+through with offset; so the full window is fetched without a query cap.
+Pages are yielded as they arrive rather than collected into one list.
+"""
+import base64
+import contextlib
+import http.client
+import json
+import logging
+import random
+import ssl
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+# ==========================================
+# DEFAULTS
+# ==========================================
+API_VERSION = 'v43'
+PAGE_LIMIT = 1000           # CM caps impalaQueries pages at 1000
+SLICE_MINUTES = 60          # Initial slice width; busy slices split further
+MIN_SLICE_SECONDS = 60      # Below this a full slice is paged with offset instead
+FETCH_WORKERS = 8           # Concurrent slices = open connections to CM
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 0.5       # First retry delay; doubles per attempt (with jitter)
+REQUEST_TIMEOUT = 120
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CMApiError(Exception):
+    """A CM API call failed for good (non-retryable status or retries exhausted)."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def format_cm_time(dt):
+    """ISO 8601 with milliseconds, as the CM API expects (naive datetimes are UTC)."""
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f"{dt.microsecond // 1000:03d}Z"
+
+
+def parse_cm_time(value):
+    """Parse a CM timestamp such as '2024-11-14T10:12:34.567Z' to a naive UTC datetime."""
+    if not value:
+        return None
+    value = value.rstrip('Z')
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class CMClient:
+    """
+    Minimal thread-safe CM REST client. Every thread gets its own persistent
+    connection (http.client is not thread-safe), so TLS handshakes happen
+    once per worker instead of once per page.
+    """
+
+    def __init__(self, host, port, username, password, api_version=API_VERSION,
+                 verify_ssl=False, timeout=REQUEST_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_seconds=BACKOFF_SECONDS, limiter=None):
+        parsed = urllib.parse.urlsplit(host if '://' in host else f'https://{host}')
+        self.scheme = parsed.scheme
+        self.hostname = parsed.hostname
+        self.port = int(port)
+        self.base_path = f'/api/{api_version}'
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # Optional semaphore shared by all clients of one CM host: caps the
+        # requests in flight to it however many clusters are fetched at once
+        self.limiter = limiter if limiter is not None else contextlib.nullcontext()
+
+        auth = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        self.headers = {'Authorization': f'Basic {auth}', 'Accept': 'application/json'}
+
+        self.ssl_context = ssl.create_default_context()
+        if not verify_ssl:
+            # Common for internal CM hosts with self-signed certs
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self.stats = {'requests': 0, 'retries': 0, 'connections': 0}
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.scheme == 'https':
+                conn = http.client.HTTPSConnection(
+                    self.hostname, self.port, timeout=self.timeout, context=self.ssl_context)
+            else:
+                conn = http.client.HTTPConnection(self.hostname, self.port, timeout=self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.add(conn)
+                self.stats['connections'] += 1
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+            with self._lock:
+                self._connections.discard(conn)
+
+    def get_json(self, path, params=None):
+        """GET base_path + path and return the decoded JSON body."""
+        url = self.base_path + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+
+        for attempt in range(self.max_retries + 1):
+            conn = self._connection()
+            with self._lock:
+                self.stats['requests'] += 1
+            try:
+                with self.limiter:
+                    conn.request('GET', url, headers=self.headers)
+                    response = conn.getresponse()
+                    body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                # Also covers a keep-alive connection the server closed while idle
+                self._drop_connection()
+                error = CMApiError(f"Connection error: {e} - URL: {url}")
+            else:
+                if response.status == 200:
+                    return json.loads(body.decode())
+                error = CMApiError(f"HTTP Error {response.status}: {response.reason} - URL: {url}",
+                                   response.status)
+                if response.will_close:
+                    self._drop_connection()
+                if response.status not in RETRY_STATUSES:
+                    raise error
+
+            if attempt == self.max_retries:
+                raise error
+            delay = self.backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+            with self._lock:
+                self.stats['retries'] += 1
+            logging.warning(f"{error}; retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def impala_queries_path(cluster_name, service_name):
+    cluster = urllib.parse.quote(cluster_name, safe='')
+    service = urllib.parse.quote(service_name, safe='')
+    return f'/clusters/{cluster}/services/{service}/impalaQueries'
+
+
+def time_slices(start_time, end_time, slice_minutes=SLICE_MINUTES):
+    """Cut [start_time, end_time) into consecutive slices of slice_minutes."""
+    step = timedelta(minutes=slice_minutes)
+    slices = []
+    lo = start_time
+    while lo < end_time:
+        hi = min(lo + step, end_time)
+        slices.append((lo, hi))
+        lo = hi
+    return slices
+
+
+def iter_impala_query_pages(client, cluster_name, service_name, start_time, end_time, filter_str,
+                            slice_minutes=SLICE_MINUTES, workers=FETCH_WORKERS,
+                            page_limit=PAGE_LIMIT, min_slice_seconds=MIN_SLICE_SECONDS):
+    """
+    Yield pages (lists of raw CM query dicts) covering every Impala query in
+    [start_time, end_time) matching filter_str, as they arrive. At most
+    `workers` pages are held at once, so memory does not grow with the
+    window. A query reported by two adjacent slices is yielded twice;
+    callers keyed by queryId (the cache) absorb that.
+    """
+    path = impala_queries_path(cluster_name, service_name)
+    warnings = set()
+
+    def fetch_page(lo, hi, offset):
+        # Returns (page, follow-up tasks): the next offset of a busy minimal
+        # slice, or two half slices instead of a page for a splittable one
+        data = client.get_json(path, {
+            'from': format_cm_time(lo),
+            'to': format_cm_time(hi),
+            'filter': filter_str,
+            'limit': page_limit,
+            'offset': offset,
+        })
+        for w in data.get('warnings') or []:
+            warnings.add(w)
+        queries = data.get('queries') or []
+        if len(queries) < page_limit:
+            return queries, []
+        if offset == 0 and (hi - lo).total_seconds() > min_slice_seconds:
+            mid = lo + (hi - lo) / 2
+            return None, [(lo, mid, 0), (mid, hi, 0)]
+        return queries, [(lo, hi, offset + len(queries))]
+
+    fetched = 0
+    splits = 0
+    # Tasks are submitted only while fewer than `workers` are in flight: with
+    # everything queued up front, a consumer slower than CM (the cache
+    # writing to disk) would let finished pages pile up in memory
+    tasks = [(lo, hi, 0) for lo, hi in time_slices(start_time, end_time, slice_minutes)]
+    tasks.reverse()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        try:
+            while tasks or pending:
+                while tasks and len(pending) < workers:
+                    pending.add(pool.submit(fetch_page, *tasks.pop()))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    queries, follow_ups = future.result()
+                    tasks.extend(reversed(follow_ups))
+                    if queries is None:
+                        splits += 1
+                        continue
+                    fetched += len(queries)
+                    logging.info(f"Fetched {fetched} queries...")
+                    yield queries
+        except BaseException:
+            # A slice failed for good (or the consumer stopped): don't let the
+            # executor shutdown work through, and retry, the slices in flight
+            for future in pending:
+                future.cancel()
+            raise
+
+    for w in sorted(warnings):
+        logging.warning(f"CM API warning: {w}")
+    logging.info(
+        f"Fetched {fetched} queries in {client.stats['requests']} requests "
+        f"({splits} slice splits, {client.stats['retries']} retries, "
+        f"{client.stats['connections']} connections)"
+    )
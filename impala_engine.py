@@ -0,0 +1,752 @@
+"""
+Columnar analysis engine shared by the Impala health tools (new_impala.py,
+updated_impala.py, impala_analyse.py).
+
+CM query records are normalised batch by batch into typed numpy arrays
+(QueryColumns); user, pool and coordinator are dictionary-encoded into
+integer codes. Each batch is folded into a WorkloadStats of incremental
+aggregators (counters, per-key sums, a bounded top-K heap and log-bucket
+quantile sketches) and then dropped, so memory does not depend on how many
+queries the window holds. Within a batch everything is vectorised: counts
+are np.count_nonzero, group-bys one np.bincount per aggregate, and top-N
+uses np.argpartition. Optionally a ConcurrencyTimeline replays the batches
+as a sweep-line to rebuild per-pool / per-coordinator queue and running
+concurrency over time, and ShapeRollup keeps per-statement-fingerprint
+histograms compact enough to persist one per day for regression checks.
+Requires numpy.
+"""
+import hashlib
+import heapq
+import math
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("The Impala analysis engine requires numpy (pip install numpy)")
+
+from sql_fingerprint import sql_digest
+
+# ==========================================
+# DEFAULTS
+# ==========================================
+QUEUED_WAIT_MS = 1000   # Admission wait above which a query counts as queued
+TOP_K = 5               # Slowest queries kept by WorkloadStats
+SKETCH_ALPHA = 0.01     # Relative error of the quantile sketches
+TIMELINE_RESOLUTION_S = 60   # Bucket width of the concurrency time series
+SATURATED_FRACTION = 0.5     # Bucket counts as saturated when the queue was non-empty this long
+FINGERPRINT_CACHE_SIZE = 4096   # Distinct raw statements whose fingerprint is memoised
+
+REGRESSION_QUANTILE = 0.95
+REGRESSION_THRESHOLD = 0.5   # Flag a shape when its quantile grew by more than this fraction
+REGRESSION_MIN_QUERIES = 5   # ... and it ran at least this often in both periods
+
+GROUP_KEYS = ('user', 'pool', 'coordinator')
+
+# Metrics kept per statement fingerprint by ShapeRollup, with the smallest
+# absolute increase worth flagging (ms, ms, bytes)
+ROLLUP_METRICS = ('duration_ms', 'admission_wait_ms', 'memory_per_node_peak')
+REGRESSION_MIN_DELTA = {'duration_ms': 1000, 'admission_wait_ms': 500,
+                        'memory_per_node_peak': 64 * 1024 ** 2}
+ROLLUP_DTYPE = np.dtype([('fingerprint', '<i8'), ('metric', 'u1'), ('bucket', '<u2'), ('count', '<u4')])
+
+def _num(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _flag(value):
+    # CM returns booleans as strings 'true'/'false' or actual booleans depending on version
+    return value is True or str(value).lower() == 'true'
+
+
+def _epoch_seconds(timestamps):
+    """ISO timestamp strings (or 'NaT') to float epoch seconds, NaN where unparseable."""
+    try:
+        parsed = np.array(timestamps, dtype='datetime64[ms]')
+    except ValueError:
+        parsed = np.array([_parse_datetime64(t) for t in timestamps], dtype='datetime64[ms]')
+    seconds = parsed.astype(np.int64) / 1000.0
+    seconds[np.isnat(parsed)] = np.nan
+    return seconds
+
+
+def _parse_datetime64(value):
+    try:
+        return np.datetime64(value, 'ms')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+# Keyed on a 16-byte digest of the raw text rather than the text itself, which
+# can be megabytes long; at most FINGERPRINT_CACHE_SIZE entries, oldest evicted
+_fingerprint_cache = {}
+
+
+def statement_fingerprint(sql):
+    """(signed 64-bit hash, normalised text) of a SQL statement (see sql_fingerprint.py)."""
+    key = hashlib.blake2b(sql.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    cached = _fingerprint_cache.get(key)
+    if cached is None:
+        digest, normalized = sql_digest(sql)
+        cached = int.from_bytes(digest, 'little', signed=True), normalized
+        if len(_fingerprint_cache) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprint_cache.pop(next(iter(_fingerprint_cache)), None)  # Oldest entry
+        _fingerprint_cache[key] = cached
+    return cached
+
+
+def format_fingerprint(fingerprint):
+    # The digest's own hex, as hs2_anlyzer.py prints it for the same statement
+    return fingerprint.to_bytes(8, 'little', signed=True).hex()
+
+
+def top_indices(values, n):
+    """Indices of the n largest values, largest first (partial sort)."""
+    if n <= 0 or len(values) == 0:
+        return np.empty(0, dtype=np.intp)
+    if n < len(values):
+        candidates = np.argpartition(values, len(values) - n)[len(values) - n:]
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(values[candidates], kind='stable')[::-1]]
+
+
+class QueryColumns:
+    """CM Impala query records as typed column arrays."""
+
+    def __init__(self, query_id, codes, categories, start_time, duration_s, admission_wait_ms,
+                 memory_per_node_peak, spilled, stats_missing):
+        self.query_id = query_id                  # list of str
+        self.codes = codes                        # key -> int32 codes
+        self.categories = categories              # key -> list of names
+        self.start_time = start_time              # epoch seconds (UTC), NaN if unknown
+        self.duration_s = duration_s
+        self.admission_wait_ms = admission_wait_ms
+        self.memory_per_node_peak = memory_per_node_peak
+        self.spilled = spilled
+        self.stats_missing = stats_missing
+        self.queued = admission_wait_ms > QUEUED_WAIT_MS
+
+    def __len__(self):
+        return len(self.query_id)
+
+    @classmethod
+    def from_records(cls, queries):
+        """Build the columns in a single pass over the raw CM query dicts."""
+        query_id = []
+        start = []
+        duration_ms = []
+        wait_ms = []
+        memory = []
+        spilled = []
+        stats_missing = []
+        lookups = {key: {} for key in GROUP_KEYS}
+        codes = {key: [] for key in GROUP_KEYS}
+        users, pools, coords = lookups['user'], lookups['pool'], lookups['coordinator']
+        user_codes, pool_codes, coord_codes = codes['user'], codes['pool'], codes['coordinator']
+
+        for q in queries:
+            attrs = q.get('attributes') or {}
+            coord_node = q.get('coordinator') or {}
+            user = q.get('user') or 'unknown'
+            pool = attrs.get('request_pool') or attrs.get('pool') or 'default'
+            coord = coord_node.get('hostname') or coord_node.get('hostId') or 'Unknown'
+
+            query_id.append(q.get('queryId', 'N/A'))
+            # 'YYYY-MM-DDTHH:MM:SS.mmm': drops the 'Z' and any sub-millisecond digits
+            start.append((q.get('startTime') or 'NaT')[:23])
+            user_codes.append(users.setdefault(user, len(users)))
+            pool_codes.append(pools.setdefault(pool, len(pools)))
+            coord_codes.append(coords.setdefault(coord, len(coords)))
+            duration_ms.append(_num(attrs.get('query_duration')))
+            wait_ms.append(_num(attrs.get('admission_wait')))
+            memory.append(_num(attrs.get('memory_per_node_peak')))
+            spilled.append(_flag(attrs.get('spilled')))
+            stats_missing.append(_flag(attrs.get('stats_missing')))
+
+        return cls(
+            query_id=query_id,
+            codes={key: np.array(codes[key], dtype=np.int32) for key in GROUP_KEYS},
+            categories={key: list(lookups[key]) for key in GROUP_KEYS},
+            start_time=_epoch_seconds(start),
+            duration_s=np.array(duration_ms, dtype=np.float64) / 1000.0,
+            admission_wait_ms=np.array(wait_ms, dtype=np.float64),
+            memory_per_node_peak=np.array(memory, dtype=np.float64),
+            spilled=np.array(spilled, dtype=bool),
+            stats_missing=np.array(stats_missing, dtype=bool),
+        )
+
+    def category(self, key, i):
+        """Name of key ('user', 'pool', 'coordinator') for query i."""
+        return self.categories[key][self.codes[key][i]]
+
+    def bottlenecks(self):
+        return {
+            'spilled': int(np.count_nonzero(self.spilled)),
+            'stats_missing': int(np.count_nonzero(self.stats_missing)),
+            'queued': int(np.count_nonzero(self.queued)),
+        }
+
+    def slowest(self, n=5):
+        """Indices of the n longest-running queries, slowest first."""
+        return top_indices(self.duration_s, n)
+
+    def group_by(self, key):
+        """Per-user / per-pool / per-coordinator aggregates."""
+        codes = self.codes[key]
+        size = len(self.categories[key])
+        max_memory = np.zeros(size)
+        np.maximum.at(max_memory, codes, self.memory_per_node_peak)
+        return GroupStats(self.categories[key], {
+            'count': np.bincount(codes, minlength=size),
+            'total_duration_s': np.bincount(codes, weights=self.duration_s, minlength=size),
+            'spilled': np.bincount(codes, weights=self.spilled, minlength=size).astype(np.int64),
+            'stats_missing': np.bincount(codes, weights=self.stats_missing, minlength=size).astype(np.int64),
+            'queued': np.bincount(codes, weights=self.queued, minlength=size).astype(np.int64),
+            'total_wait_ms': np.bincount(codes, weights=self.admission_wait_ms, minlength=size),
+            'max_memory_per_node_peak': max_memory,
+        })
+
+
+class GroupStats:
+    """Aggregate arrays aligned with a list of group names."""
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def rows(self, order_by, n=None):
+        """[(name, {column: value})] by descending order_by; all groups unless n is given."""
+        values = self.columns[order_by]
+        order = top_indices(values, len(values) if n is None else n)
+        return [
+            (self.names[i], {name: col[i].item() for name, col in self.columns.items()})
+            for i in order
+        ]
+
+
+class LogHistogram:
+    """
+    Mergeable streaming quantile sketch: counts per logarithmic bucket over a
+    fixed range, so any quantile is within SKETCH_ALPHA relative error and
+    the sketch is a constant ~2k counters whatever the number of values.
+    """
+    MIN_VALUE = 1e-3
+    MAX_VALUE = 1e12
+
+    def __init__(self, alpha=SKETCH_ALPHA):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        size = int(math.ceil(math.log(self.MAX_VALUE / self.MIN_VALUE) / self.log_gamma)) + 1
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.count = 0
+
+    def index(self, values):
+        """Bucket index of each value (0 holds everything <= MIN_VALUE)."""
+        values = np.asarray(values, dtype=np.float64)
+        positive = values > self.MIN_VALUE
+        idx = np.zeros(len(values), dtype=np.int64)
+        idx[positive] = np.ceil(np.log(values[positive] / self.MIN_VALUE) / self.log_gamma)
+        return np.clip(idx, 0, len(self.counts) - 1, out=idx)
+
+    def value(self, idx):
+        """Representative value of bucket(s) idx, within alpha of every value in it."""
+        idx = np.asarray(idx)
+        values = self.MIN_VALUE * 2 * self.gamma ** idx.astype(np.float64) / (self.gamma + 1)
+        return np.where(idx == 0, 0.0, values)
+
+    def add(self, values):
+        if not len(values):
+            return
+        self.counts += np.bincount(self.index(values), minlength=len(self.counts))
+        self.count += len(values)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        i = int(np.searchsorted(np.cumsum(self.counts), rank, side='right'))
+        return float(self.value(i))
+
+
+class WorkloadStats:
+    """
+    Incremental aggregates over any number of QueryColumns batches; exposes
+    the same report helpers as QueryColumns (bottlenecks, group_by) plus
+    slowest() rows and quantile sketches.
+    """
+
+    GROUP_COLUMNS = ('count', 'total_duration_s', 'spilled', 'stats_missing',
+                     'queued', 'total_wait_ms', 'max_memory_per_node_peak')
+
+    def __init__(self, top_k=TOP_K):
+        self.top_k = top_k
+        self.total = 0
+        self.counts = {'spilled': 0, 'stats_missing': 0, 'queued': 0}
+        self.max_admission_wait_ms = 0.0
+        self.duration_sketch = LogHistogram()
+        self.pool_wait_sketches = {}
+        self._slowest = []          # min-heap of (duration_s, seq, row)
+        self._seq = 0
+        self._groups = {key: ({}, {c: np.zeros(0) for c in self.GROUP_COLUMNS})
+                        for key in GROUP_KEYS}
+
+    def __len__(self):
+        return self.total
+
+    def add_records(self, queries):
+        self.add(QueryColumns.from_records(queries))
+
+    def add(self, cols):
+        if not len(cols):
+            return
+        self.total += len(cols)
+        for name, value in cols.bottlenecks().items():
+            self.counts[name] += value
+        self.max_admission_wait_ms = max(self.max_admission_wait_ms,
+                                         float(cols.admission_wait_ms.max()))
+        self.duration_sketch.add(cols.duration_s)
+
+        pool_codes = cols.codes['pool']
+        for code, pool in enumerate(cols.categories['pool']):
+            sketch = self.pool_wait_sketches.get(pool)
+            if sketch is None:
+                sketch = self.pool_wait_sketches[pool] = LogHistogram()
+            sketch.add(cols.admission_wait_ms[pool_codes == code])
+
+        for i in cols.slowest(self.top_k):
+            duration = float(cols.duration_s[i])
+            if len(self._slowest) == self.top_k and duration <= self._slowest[0][0]:
+                break
+            row = {
+                'query_id': cols.query_id[i],
+                'user': cols.category('user', i),
+                'pool': cols.category('pool', i),
+                'coordinator': cols.category('coordinator', i),
+                'duration_s': duration,
+                'admission_wait_ms': float(cols.admission_wait_ms[i]),
+                'spilled': bool(cols.spilled[i]),
+                'stats_missing': bool(cols.stats_missing[i]),
+            }
+            self._seq += 1
+            if len(self._slowest) < self.top_k:
+                heapq.heappush(self._slowest, (duration, self._seq, row))
+            else:
+                heapq.heappushpop(self._slowest, (duration, self._seq, row))
+
+        for key in GROUP_KEYS:
+            self._merge_groups(key, cols.group_by(key))
+
+    def merge(self, other):
+        """Fold another WorkloadStats (e.g. another cluster's) into this one."""
+        self.total += other.total
+        for name, value in other.counts.items():
+            self.counts[name] += value
+        self.max_admission_wait_ms = max(self.max_admission_wait_ms, other.max_admission_wait_ms)
+        self.duration_sketch.merge(other.duration_sketch)
+        for pool, sketch in other.pool_wait_sketches.items():
+            if pool not in self.pool_wait_sketches:
+                self.pool_wait_sketches[pool] = LogHistogram()
+            self.pool_wait_sketches[pool].merge(sketch)
+        for duration, _, row in other._slowest:
+            self._seq += 1
+            if len(self._slowest) < self.top_k:
+                heapq.heappush(self._slowest, (duration, self._seq, row))
+            elif duration > self._slowest[0][0]:
+                heapq.heappushpop(self._slowest, (duration, self._seq, row))
+        for key in GROUP_KEYS:
+            groups = other.group_by(key)
+            if len(groups):
+                self._merge_groups(key, groups)
+
+    def _merge_groups(self, key, batch):
+        index, columns = self._groups[key]
+        positions = np.array([index.setdefault(name, len(index)) for name in batch.names],
+                             dtype=np.intp)
+        if len(index) > len(columns['count']):
+            for name, col in columns.items():
+                columns[name] = np.concatenate([col, np.zeros(len(index) - len(col))])
+        for name, col in columns.items():
+            if name.startswith('max_'):
+                col[positions] = np.maximum(col[positions], batch[name])
+            else:
+                col[positions] += batch[name]
+
+    def bottlenecks(self):
+        return dict(self.counts)
+
+    def slowest(self, n=None):
+        """Rows of the slowest queries seen (at most top_k), slowest first."""
+        rows = [row for _, _, row in sorted(self._slowest, reverse=True)]
+        return rows if n is None else rows[:n]
+
+    def group_by(self, key):
+        index, columns = self._groups[key]
+        result = dict(columns)
+        for name in ('count', 'spilled', 'stats_missing', 'queued'):
+            result[name] = columns[name].astype(np.int64)
+        return GroupStats(list(index), result)
+
+    def duration_quantiles(self, qs=(0.5, 0.95, 0.99)):
+        return {q: self.duration_sketch.quantile(q) for q in qs}
+
+    def pool_wait_quantiles(self, qs=(0.5, 0.95, 0.99)):
+        """pool -> {q: admission wait ms}"""
+        return {pool: {q: sketch.quantile(q) for q in qs}
+                for pool, sketch in self.pool_wait_sketches.items()}
+
+
+class _Series:
+    """Step function of one pool's / coordinator's load, integrated into buckets."""
+    __slots__ = ('last', 'queued', 'running', 'memory', 'buckets')
+
+    def __init__(self):
+        self.last = None
+        self.queued = 0
+        self.running = 0
+        self.memory = 0.0
+        # bucket index -> [queued-seconds, running-seconds, seconds with a queue,
+        #                  peak queued, peak running, peak memory]
+        self.buckets = {}
+
+    def _bucket(self, index):
+        bucket = self.buckets.get(index)
+        if bucket is None:
+            bucket = self.buckets[index] = [0.0, 0.0, 0.0, 0, 0, 0.0]
+        return bucket
+
+    def _touch(self, bucket):
+        if self.queued > bucket[3]:
+            bucket[3] = self.queued
+        if self.running > bucket[4]:
+            bucket[4] = self.running
+        if self.memory > bucket[5]:
+            bucket[5] = self.memory
+
+    def shift(self, t, resolution, d_queued, d_running, d_memory):
+        """Account for the current level up to t, then apply the change at t."""
+        a = self.last
+        if a is not None and t > a and (self.queued or self.running):
+            index = int(a // resolution)
+            while a < t:
+                edge = min((index + 1) * resolution, t)
+                span = edge - a
+                bucket = self._bucket(index)
+                bucket[0] += self.queued * span
+                bucket[1] += self.running * span
+                if self.queued:
+                    bucket[2] += span
+                self._touch(bucket)
+                a = edge
+                index += 1
+        self.last = t
+        self.queued += d_queued
+        self.running += d_running
+        self.memory = self.memory + d_memory if self.running else 0.0
+        self._touch(self._bucket(int(t // resolution)))
+
+
+class ConcurrencyTimeline:
+    """
+    Per-pool and per-coordinator time series of queued and running queries
+    and memory reserved, at resolution_s buckets.
+
+    A query sits in its pool's queue from startTime for admission_wait, then
+    runs, holding memory_per_node_peak, until startTime + query_duration.
+    Queries are swept in start-time order; the pending admit / finish events
+    of queries already seen wait in a heap, so memory is bounded by the
+    number of concurrent queries plus the number of buckets. Feed batches
+    oldest first (QueryCache.iter_batches does) and call finish() at the end.
+    """
+    KEYS = ('pool', 'coordinator')
+
+    def __init__(self, resolution_s=TIMELINE_RESOLUTION_S, saturated_fraction=SATURATED_FRACTION):
+        self.resolution_s = resolution_s
+        self.saturated_fraction = saturated_fraction
+        self.series = {key: {} for key in self.KEYS}
+        self.skipped = 0            # queries without a usable start time
+        self._events = []           # heap of (time, seq, end_time or None, series, memory)
+        self._seq = 0
+        self._clock = -math.inf
+
+    def _series_for(self, key, names):
+        series = self.series[key]
+        return [series.get(name) or series.setdefault(name, _Series()) for name in names]
+
+    def _apply(self, t, series, d_queued, d_running, d_memory):
+        for s in series:
+            s.shift(t, self.resolution_s, d_queued, d_running, d_memory)
+
+    def _advance(self, t):
+        events = self._events
+        while events and events[0][0] <= t:
+            when, seq, end_time, series, memory = heapq.heappop(events)
+            if end_time is None:
+                self._apply(when, series, 0, -1, -memory)
+            else:
+                # Admitted: leaves the queue, starts running until end_time
+                self._apply(when, series, -1, 1, memory)
+                heapq.heappush(events, (end_time, seq, None, series, memory))
+
+    def add(self, cols):
+        valid = np.flatnonzero(~np.isnan(cols.start_time))
+        self.skipped += len(cols) - len(valid)
+        order = valid[np.argsort(cols.start_time[valid], kind='stable')]
+        if not len(order):
+            return
+        waits = cols.admission_wait_ms[order] / 1000.0
+        starts = cols.start_time[order]
+        ends = starts + np.maximum(cols.duration_s[order], waits)
+        pools = self._series_for('pool', cols.categories['pool'])
+        coords = self._series_for('coordinator', cols.categories['coordinator'])
+
+        for start, wait, end, memory, pool, coord in zip(
+                starts.tolist(), waits.tolist(), ends.tolist(),
+                cols.memory_per_node_peak[order].tolist(),
+                cols.codes['pool'][order].tolist(), cols.codes['coordinator'][order].tolist()):
+            # Out-of-order input is clamped to the sweep position
+            if start < self._clock:
+                end += self._clock - start
+                start = self._clock
+            self._advance(start)
+            self._clock = start
+            series = (pools[pool], coords[coord])
+            self._seq += 1
+            if wait > 0:
+                self._apply(start, series, 1, 0, 0.0)
+                heapq.heappush(self._events, (start + wait, self._seq, end, series, memory))
+            else:
+                self._apply(start, series, 0, 1, memory)
+                heapq.heappush(self._events, (end, self._seq, None, series, memory))
+
+    def finish(self):
+        """Play out every pending admit / finish event."""
+        self._advance(math.inf)
+
+    def _is_saturated(self, bucket):
+        return bucket[2] >= self.saturated_fraction * self.resolution_s
+
+    def rows(self, key):
+        """Yield (name, bucket start epoch, avg queued, peak queued, avg running, peak running, peak memory)."""
+        res = self.resolution_s
+        for name in sorted(self.series[key]):
+            buckets = self.series[key][name].buckets
+            for index in sorted(buckets):
+                b = buckets[index]
+                yield (name, index * res, b[0] / res, b[3], b[1] / res, b[4], b[5])
+
+    def peak_windows(self, key, n=5):
+        """
+        The n buckets with the highest running concurrency across all
+        groups of key, at most one per group per run of adjacent buckets.
+        """
+        candidates = []
+        for name, s in self.series[key].items():
+            for index, b in s.buckets.items():
+                candidates.append((b[4], b[3], name, index))
+        candidates.sort(reverse=True)
+        taken = set()
+        windows = []
+        for peak_running, peak_queued, name, index in candidates:
+            if len(windows) == n:
+                break
+            if (name, index - 1) in taken or (name, index + 1) in taken:
+                taken.add((name, index))
+                continue
+            taken.add((name, index))
+            b = self.series[key][name].buckets[index]
+            windows.append({
+                'name': name,
+                'start': index * self.resolution_s,
+                'peak_running': peak_running,
+                'peak_queued': peak_queued,
+                'avg_running': b[1] / self.resolution_s,
+                'peak_memory': b[5],
+            })
+        return windows
+
+    def saturation(self, key='pool'):
+        """
+        name -> {'seconds', 'ranges': [(from epoch, to epoch)], 'peak_queued',
+        'running_when_saturated'} for the buckets in which the queue was
+        non-empty at least saturated_fraction of the time. running_when_saturated
+        (peak running while queries were waiting) approximates the limit
+        admission control actually enforced.
+        """
+        res = self.resolution_s
+        result = {}
+        for name, s in self.series[key].items():
+            saturated = sorted(i for i, b in s.buckets.items() if self._is_saturated(b))
+            if not saturated:
+                continue
+            ranges = []
+            for index in saturated:
+                if ranges and ranges[-1][1] == index * res:
+                    ranges[-1][1] += res
+                else:
+                    ranges.append([index * res, (index + 1) * res])
+            result[name] = {
+                'seconds': len(saturated) * res,
+                'ranges': [tuple(r) for r in ranges],
+                'peak_queued': max(s.buckets[i][3] for i in saturated),
+                'running_when_saturated': max(s.buckets[i][4] for i in saturated),
+            }
+        return result
+
+
+class ShapeRollup:
+    """
+    Per statement fingerprint log-bucket histograms (see LogHistogram) of
+    ROLLUP_METRICS, held sparsely as one ROLLUP_DTYPE array of
+    (fingerprint, metric, bucket, count) cells sorted by key. A day of
+    queries typically reduces to a few cells per shape and metric, so daily
+    rollups can be stored as bytes and merged into a baseline without going
+    back to the raw rows.
+    """
+
+    def __init__(self, cells=None, queries=0, alpha=SKETCH_ALPHA):
+        self.sketch = LogHistogram(alpha)   # bucket layout only
+        self.cells = np.zeros(0, dtype=ROLLUP_DTYPE) if cells is None else cells
+        self.queries = queries
+        self.statements = {}                # fingerprint -> normalised statement
+        self._pending = []
+
+    @classmethod
+    def from_bytes(cls, data, queries=0):
+        return cls(np.frombuffer(data, dtype=ROLLUP_DTYPE).copy(), queries)
+
+    def to_bytes(self):
+        self._compact()
+        return self.cells.tobytes()
+
+    def add_records(self, queries):
+        n = len(queries)
+        if not n:
+            return
+        fingerprints = np.empty(n, dtype=np.int64)
+        values = np.empty((len(ROLLUP_METRICS), n), dtype=np.float64)
+        statements = self.statements
+        for i, q in enumerate(queries):
+            attrs = q.get('attributes') or {}
+            fingerprint, normalized = statement_fingerprint(q.get('statement') or '')
+            if fingerprint not in statements:
+                statements[fingerprint] = normalized
+            fingerprints[i] = fingerprint
+            values[0, i] = _num(attrs.get('query_duration'))
+            values[1, i] = _num(attrs.get('admission_wait'))
+            values[2, i] = _num(attrs.get('memory_per_node_peak'))
+
+        cells = np.empty(n * len(ROLLUP_METRICS), dtype=ROLLUP_DTYPE)
+        cells['fingerprint'] = np.tile(fingerprints, len(ROLLUP_METRICS))
+        cells['metric'] = np.repeat(np.arange(len(ROLLUP_METRICS)), n)
+        cells['bucket'] = self.sketch.index(values.ravel())
+        cells['count'] = 1
+        self._pending.append(self._reduce(cells))
+        self.queries += n
+        if len(self._pending) > 16:
+            self._compact()
+
+    def merge(self, other):
+        self._pending.append(other.cells)
+        self._pending.extend(other._pending)
+        self.queries += other.queries
+        for fingerprint, normalized in other.statements.items():
+            self.statements.setdefault(fingerprint, normalized)
+
+    @staticmethod
+    def _reduce(cells):
+        """Sort cells by key and sum the counts of equal keys."""
+        if not len(cells):
+            return cells
+        order = np.lexsort((cells['bucket'], cells['metric'], cells['fingerprint']))
+        cells = cells[order]
+        key_change = ((cells['fingerprint'][1:] != cells['fingerprint'][:-1])
+                      | (cells['metric'][1:] != cells['metric'][:-1])
+                      | (cells['bucket'][1:] != cells['bucket'][:-1]))
+        starts = np.flatnonzero(np.concatenate(([True], key_change)))
+        reduced = cells[starts]
+        reduced['count'] = np.add.reduceat(cells['count'].astype(np.int64), starts)
+        return reduced
+
+    def _compact(self):
+        if self._pending:
+            self.cells = self._reduce(np.concatenate([self.cells] + self._pending))
+            self._pending = []
+
+    def quantile(self, metric, q):
+        """(fingerprints, query counts, quantile values) for one metric, by fingerprint."""
+        self._compact()
+        cells = self.cells[self.cells['metric'] == ROLLUP_METRICS.index(metric)]
+        if not len(cells):
+            empty = np.zeros(0)
+            return empty.astype(np.int64), empty.astype(np.int64), empty
+        fingerprint = cells['fingerprint']
+        starts = np.flatnonzero(np.concatenate(([True], fingerprint[1:] != fingerprint[:-1])))
+        counts = cells['count'].astype(np.int64)
+        totals = np.add.reduceat(counts, starts)
+        cumulative = np.cumsum(counts)
+        before = cumulative[starts] - counts[starts]
+        # Same rank rule as LogHistogram.quantile, on each fingerprint's slice
+        positions = np.searchsorted(cumulative, before + q * (totals - 1), side='right')
+        return fingerprint[starts], totals, self.sketch.value(cells['bucket'][positions])
+
+
+def compare_rollups(current, baseline, q=REGRESSION_QUANTILE, threshold=REGRESSION_THRESHOLD,
+                    min_queries=REGRESSION_MIN_QUERIES, min_delta=REGRESSION_MIN_DELTA):
+    """
+    Shapes whose q-quantile of any ROLLUP_METRICS grew by more than
+    threshold (and at least min_delta) from baseline to current, as row
+    dicts sorted by relative increase.
+    """
+    regressions = []
+    for metric in ROLLUP_METRICS:
+        cur_fp, cur_n, cur_v = current.quantile(metric, q)
+        base_fp, base_n, base_v = baseline.quantile(metric, q)
+        _, ci, bi = np.intersect1d(cur_fp, base_fp, assume_unique=True, return_indices=True)
+        cur_n, cur_v, base_n, base_v = cur_n[ci], cur_v[ci], base_n[bi], base_v[bi]
+        flagged = ((cur_n >= min_queries) & (base_n >= min_queries)
+                   & (cur_v > base_v * (1 + threshold))
+                   & (cur_v - base_v >= min_delta[metric]))
+        for i in np.flatnonzero(flagged):
+            fingerprint = int(cur_fp[ci[i]])
+            regressions.append({
+                'fingerprint': fingerprint,
+                'statement': current.statements.get(fingerprint) or baseline.statements.get(fingerprint, ''),
+                'metric': metric,
+                'current': float(cur_v[i]),
+                'baseline': float(base_v[i]),
+                'change': float(cur_v[i] / base_v[i] - 1) if base_v[i] else math.inf,
+                'current_queries': int(cur_n[i]),
+                'baseline_queries': int(base_n[i]),
+            })
+    regressions.sort(key=lambda r: r['change'], reverse=True)
+    return regressions
+
+
+def analyze_batches(batches, top_k=TOP_K, timeline=None):
+    """
+    Fold an iterable of raw CM query lists into one WorkloadStats; batches
+    are also swept into timeline (a ConcurrencyTimeline) when given.
+    """
+    stats = WorkloadStats(top_k)
+    for queries in batches:
+        cols = QueryColumns.from_records(queries)
+        stats.add(cols)
+        if timeline is not None:
+            timeline.add(cols)
+    if timeline is not None:
+        timeline.finish()
+    return stats
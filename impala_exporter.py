@@ -0,0 +1,284 @@
+"""
+Prometheus / OpenMetrics exporter for Impala workload health.
+
+    python impala_exporter.py [--port 9472] [--interval 300] [--once]
+
+Every REFRESH_SECONDS the shared query cache is refreshed from CM, which
+only fetches queries since the previous poll (plus the cache's overlap).
+Aggregates are kept in memory per BUCKET_MINUTES of query start time; a
+poll recomputes just the buckets the refresh touched, drops the ones that
+fell out of the WINDOW_HOURS window and merges the rest. The rendered
+metrics are served from memory at http://<host>:<port>/metrics, so a
+scrape never triggers CM calls or analysis. --once prints one exposition
+and exits (cron + node_exporter textfile collector).
+"""
+import argparse
+import logging
+import math
+import numbers
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from impala_cm import CMApiError, CMClient
+from impala_cache import QueryCache
+from impala_engine import WorkloadStats, analyze_batches
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+CM_HOST = 'https://your-cm-host.com'
+CM_PORT = '7183'
+CM_USER = 'admin'
+CM_PASS = 'password'
+CLUSTER_NAME = 'Cluster 1'
+SERVICE_NAME = 'impala'
+
+# Exporter Settings
+LISTEN_ADDRESS = '0.0.0.0'
+LISTEN_PORT = 9472
+REFRESH_SECONDS = 300       # Poll CM this often
+WINDOW_HOURS = 24           # Rolling window the metrics describe
+BUCKET_MINUTES = 5          # Aggregation granularity (the window is rounded to it)
+MIN_DURATION_SECONDS = 0.0  # 0 = every cached query (see impala_cache.CACHE_FILTER)
+TOP_USERS = 10              # Users exported, by total duration
+
+# Fetch Settings
+SLICE_MINUTES = 60
+FETCH_WORKERS = 8
+CACHE_DB = 'impala_query_cache.db'
+
+QUANTILES = (0.5, 0.95, 0.99)
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class RollingWorkload:
+    """WorkloadStats per start-time bucket over a rolling window."""
+
+    def __init__(self, window=timedelta(hours=WINDOW_HOURS), bucket=timedelta(minutes=BUCKET_MINUTES)):
+        self.window = window
+        self.bucket = bucket
+        self.buckets = {}           # bucket start -> WorkloadStats
+
+    def floor(self, dt):
+        epoch = datetime(1970, 1, 1)
+        return dt - (dt - epoch) % self.bucket
+
+    def update(self, cache, since, now):
+        """Recompute every bucket from the one holding `since` up to now."""
+        start = self.floor(since)
+        while start < now:
+            self.buckets[start] = analyze_batches(cache.iter_batches(
+                CLUSTER_NAME, SERVICE_NAME, start, start + self.bucket,
+                min_duration_ms=MIN_DURATION_SECONDS * 1000
+            ))
+            start += self.bucket
+        oldest = self.floor(now - self.window)
+        for start in [b for b in self.buckets if b < oldest]:
+            del self.buckets[start]
+
+    def stats(self):
+        total = WorkloadStats()
+        for stats in self.buckets.values():
+            total.merge(stats)
+        return total
+
+def format_value(value):
+    # Integers exactly, floats with repr() so large values keep every digit
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Exposition:
+    """Accumulates metric families in OpenMetrics text format."""
+
+    def __init__(self, base_labels):
+        self.base = base_labels
+        self.lines = []
+
+    def family(self, name, kind, help_text, unit=None):
+        self.lines.append(f"# TYPE {name} {kind}")
+        if unit:
+            self.lines.append(f"# UNIT {name} {unit}")
+        self.lines.append(f"# HELP {name} {help_text}")
+
+    def sample(self, name, value, **labels):
+        labels = dict(self.base, **labels)
+        rendered = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+        if rendered:
+            rendered = f"{{{rendered}}}"
+        self.lines.append(f"{name}{rendered} {format_value(value)}")
+
+    def text(self):
+        return "\n".join(self.lines + ["# EOF"]) + "\n"
+
+def render(stats, exporter_stats):
+    out = Exposition({'cluster': CLUSTER_NAME, 'service': SERVICE_NAME})
+    total = stats.total
+    counts = stats.bottlenecks()
+
+    out.family('impala_window_queries', 'gauge', f'Queries started in the last {WINDOW_HOURS}h')
+    out.sample('impala_window_queries', total)
+    for name, help_text in (('spilled', 'spilled to disk'),
+                            ('stats_missing', 'ran with missing table stats'),
+                            ('queued', 'waited in admission control > 1s')):
+        metric = f'impala_window_{name}_ratio'
+        out.family(metric, 'gauge', f'Fraction of window queries that {help_text}', 'ratio')
+        out.sample(metric, counts[name] / total if total else 0)
+
+    out.family('impala_query_duration_seconds', 'summary', 'Query duration over the window', 'seconds')
+    for q, value in stats.duration_quantiles(QUANTILES).items():
+        out.sample('impala_query_duration_seconds', value, quantile=q)
+    users = stats.group_by('user')
+    out.sample('impala_query_duration_seconds_sum', users['total_duration_s'].sum() if len(users) else 0)
+    out.sample('impala_query_duration_seconds_count', total)
+
+    pools = dict(stats.group_by('pool').rows('count'))
+    out.family('impala_pool_admission_wait_seconds', 'summary', 'Admission wait per resource pool', 'seconds')
+    for pool, quantiles in sorted(stats.pool_wait_quantiles(QUANTILES).items()):
+        for q, value in quantiles.items():
+            out.sample('impala_pool_admission_wait_seconds', value / 1000.0, pool=pool, quantile=q)
+        out.sample('impala_pool_admission_wait_seconds_sum', pools[pool]['total_wait_ms'] / 1000.0, pool=pool)
+        out.sample('impala_pool_admission_wait_seconds_count', pools[pool]['count'], pool=pool)
+    out.family('impala_pool_queued_queries', 'gauge', 'Window queries that queued > 1s per pool')
+    for pool, p in sorted(pools.items()):
+        out.sample('impala_pool_queued_queries', p['queued'], pool=pool)
+
+    coords = stats.group_by('coordinator').rows('count')
+    out.family('impala_coordinator_queries', 'gauge', 'Window queries per coordinator')
+    for coord, c in coords:
+        out.sample('impala_coordinator_queries', c['count'], coordinator=coord)
+    out.family('impala_coordinator_queued_queries', 'gauge', 'Window queries that queued > 1s per coordinator')
+    for coord, c in coords:
+        out.sample('impala_coordinator_queued_queries', c['queued'], coordinator=coord)
+    out.family('impala_coordinator_query_duration_seconds', 'gauge',
+               'Total duration of window queries per coordinator', 'seconds')
+    for coord, c in coords:
+        out.sample('impala_coordinator_query_duration_seconds', c['total_duration_s'], coordinator=coord)
+
+    top_users = users.rows('total_duration_s', n=TOP_USERS) if len(users) else []
+    out.family('impala_user_query_duration_seconds', 'gauge',
+               f'Total duration of window queries of the top {TOP_USERS} users', 'seconds')
+    for user, u in top_users:
+        out.sample('impala_user_query_duration_seconds', u['total_duration_s'], user=user)
+    out.family('impala_user_queries', 'gauge', f'Window queries of the top {TOP_USERS} users')
+    for user, u in top_users:
+        out.sample('impala_user_queries', u['count'], user=user)
+
+    out.family('impala_exporter_last_success_timestamp_seconds', 'gauge',
+               'Unix time of the last successful refresh', 'seconds')
+    out.sample('impala_exporter_last_success_timestamp_seconds', exporter_stats['last_success'])
+    out.family('impala_exporter_refresh_duration_seconds', 'gauge', 'Duration of the last refresh', 'seconds')
+    out.sample('impala_exporter_refresh_duration_seconds', exporter_stats['refresh_seconds'])
+    out.family('impala_exporter_fetched_queries', 'counter', 'Queries fetched from CM since start')
+    out.sample('impala_exporter_fetched_queries_total', exporter_stats['fetched'])
+    out.family('impala_exporter_refresh_errors', 'counter', 'Failed refreshes since start')
+    out.sample('impala_exporter_refresh_errors_total', exporter_stats['errors'])
+    return out.text()
+
+class Exporter:
+    def __init__(self):
+        self.client = CMClient(CM_HOST, CM_PORT, CM_USER, CM_PASS)
+        self.cache = None
+        self.rolling = RollingWorkload()
+        self.lock = threading.Lock()
+        self.text = None
+        self.stats = {'last_success': 0, 'refresh_seconds': 0, 'fetched': 0, 'errors': 0}
+
+    def refresh(self):
+        began = time.time()
+        now = datetime.utcnow()
+        window_start = now - self.rolling.window
+        try:
+            if self.cache is None:
+                self.cache = QueryCache(CACHE_DB)
+            if self.rolling.buckets:
+                # Only buckets the refresh can have touched are recomputed
+                ranges = self.cache.plan_refresh(CLUSTER_NAME, SERVICE_NAME, window_start, now)
+                since = min([lo for lo, _ in ranges] + [now])
+            else:
+                since = window_start
+            self.stats['fetched'] += self.cache.refresh(
+                self.client, CLUSTER_NAME, SERVICE_NAME, window_start, now,
+                slice_minutes=SLICE_MINUTES, workers=FETCH_WORKERS
+            )
+            self.rolling.update(self.cache, since, now)
+            stats = self.rolling.stats()
+        except CMApiError as e:
+            # Keep serving the previous aggregates; last_success shows they are stale
+            logging.error(f"Refresh failed: {e}")
+            self.stats['errors'] += 1
+            if self.text is None:
+                return
+            stats = self.rolling.stats()
+        else:
+            self.stats['last_success'] = time.time()
+            self.stats['refresh_seconds'] = time.time() - began
+            logging.info(f"Refreshed in {time.time() - began:.1f}s: {stats.total} queries "
+                         f"in window, {len(self.rolling.buckets)} buckets")
+        text = render(stats, self.stats)
+        with self.lock:
+            self.text = text
+
+    def metrics(self):
+        with self.lock:
+            return self.text
+
+def make_handler(exporter):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            text = exporter.metrics()
+            if text is None:
+                self.send_error(503, 'First refresh still running')
+                return
+            body = text.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logging.debug(fmt % args)
+    return MetricsHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Impala workload metrics in OpenMetrics format")
+    parser.add_argument("--port", type=int, default=LISTEN_PORT)
+    parser.add_argument("--interval", type=int, default=REFRESH_SECONDS,
+                        help="Seconds between refreshes from CM")
+    parser.add_argument("--once", action="store_true", help="Print the metrics once and exit")
+    args = parser.parse_args()
+
+    exporter = Exporter()
+    if args.once:
+        exporter.refresh()
+        print(exporter.metrics() or "", end="")
+    else:
+        server = ThreadingHTTPServer((LISTEN_ADDRESS, args.port), make_handler(exporter))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://{LISTEN_ADDRESS}:{args.port}/metrics "
+                     f"(refresh every {args.interval}s)")
+        try:
+            while True:
+                started = time.time()
+                exporter.refresh()
+                time.sleep(max(0, args.interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            server.shutdown()
+            exporter.client.close()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Cloudera Manager impalaQueries API, so the Impala
+tools (new_impala.py, updated_impala.py, impala_analyse.py, ...) can be run
+and benchmarked without a cluster.
+
+    python3 impala_fake_cm.py --queries 100000 --port 7180
+    python3 new_impala.py      # with CM_HOST = 'http://localhost', CM_PORT = '7180'
+
+Serves GET /api/<version>/clusters/<cluster>/services/<service>/impalaQueries
+over a synthetic query history generated up front (columnar, so a million
+queries take a few hundred MB). Behaves like CM where the tools depend on it:
+
+  paging    from/to select by start time, newest first; limit (capped at
+            1000) and offset page through the selection
+  filter    comparisons on queryDuration / admissionWait / memoryPerNodePeak
+            / rowsProduced combined with AND / OR, e.g.
+            'admissionWait > 100 OR queryDuration > 1s'; anything else is a 400
+  records   queryId, statement, user, database, coordinator, start/end time
+            and the attributes the tools read (query_duration, admission_wait,
+            memory_per_node_peak, spilled, stats_missing, request_pool, ...)
+
+Traffic follows a daily curve with per-pool queueing that worsens at peak
+hours, a skewed mix of users and statement shapes, and missing stats on a
+few tables. --latency-ms, --error-rate and --reset-rate inject slow
+responses, 503s and dropped connections; --processes forks extra server
+processes so the fake is not the bottleneck. Runtime profiles are not served
+(impalaQueries/<id> answers 404, which impala_profile.py skips).
+"""
+import argparse
+import json
+import os
+import random
+import re
+import signal
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from impala_cm import PAGE_LIMIT, parse_cm_time
+from impala_cache import from_epoch, to_epoch
+
+# ----------------------------
+# Synthetic workload
+# ----------------------------
+
+# (statement template, median duration s, memory per node MB, tables missing stats?)
+SHAPES = [
+    ("SELECT c.region, SUM(o.amount) FROM sales.fact_orders o JOIN sales.dim_customer c "
+     "ON o.cust_id = c.id WHERE o.order_date >= '2024-{m:02d}-{d:02d}' GROUP BY c.region", 40, 2048, False),
+    ("SELECT * FROM web.clicks WHERE session_id = '{s}' LIMIT 100", 2, 64, False),
+    ("SELECT page_id, COUNT(*) FROM web.clicks WHERE dt = '2024-{m:02d}-{d:02d}' GROUP BY page_id "
+     "ORDER BY 2 DESC LIMIT 50", 15, 512, False),
+    ("INSERT OVERWRITE TABLE mart.daily_revenue PARTITION (dt='2024-{m:02d}-{d:02d}') "
+     "SELECT store_id, SUM(amount) FROM sales.fact_orders WHERE order_date = '2024-{m:02d}-{d:02d}' "
+     "GROUP BY store_id", 120, 4096, False),
+    ("SELECT e.name, d.name FROM hr.emp e JOIN hr.dept d ON e.dept_id = d.id WHERE e.id IN ({n}, {k})",
+     1.5, 32, True),
+    ("SELECT COUNT(DISTINCT user_id) FROM web.events WHERE event_type = 'purchase' AND dt BETWEEN "
+     "'2024-{m:02d}-01' AND '2024-{m:02d}-{d:02d}'", 90, 8192, True),
+    ("SELECT * FROM finance.ledger l JOIN finance.accounts a ON l.acct = a.id WHERE l.amount > {n}",
+     25, 1024, False),
+    ("COMPUTE INCREMENTAL STATS sales.fact_orders PARTITION (order_date='2024-{m:02d}-{d:02d}')", 60, 512, False),
+    ("SELECT store_id, AVG(amount) FROM sales.fact_orders WHERE cust_id = {n} GROUP BY store_id", 5, 256, False),
+    ("WITH t AS (SELECT user_id, MIN(ts) first_seen FROM web.events GROUP BY user_id) "
+     "SELECT DATE_TRUNC('day', first_seen), COUNT(*) FROM t GROUP BY 1", 180, 16384, True),
+]
+SHAPE_WEIGHTS = [0.14, 0.30, 0.10, 0.03, 0.12, 0.04, 0.08, 0.01, 0.16, 0.02]
+
+# user -> resource pool
+USERS = {
+    'svc_tableau': 'root.bi', 'svc_hue': 'root.adhoc', 'etl_batch': 'root.etl',
+    'svc_airflow': 'root.etl', 'analyst1': 'root.adhoc', 'analyst2': 'root.adhoc',
+    'analyst3': 'root.adhoc', 'ds_team': 'root.adhoc', 'finance_rpt': 'root.bi', 'audit': 'default',
+}
+USER_WEIGHTS = [0.25, 0.15, 0.12, 0.10, 0.08, 0.07, 0.06, 0.08, 0.07, 0.02]
+# pool -> (probability of queueing at peak load, mean wait ms when queued)
+POOL_QUEUEING = {'root.bi': (0.25, 3000), 'root.adhoc': (0.35, 8000),
+                 'root.etl': (0.15, 20000), 'default': (0.05, 500)}
+COORDINATORS = [f'impalad-{n:02d}.example.com' for n in range(1, 7)]
+COORDINATOR_WEIGHTS = [0.30, 0.20, 0.15, 0.15, 0.10, 0.10]    # a skewed load balancer
+# Relative traffic per hour of day (UTC)
+HOURLY_LOAD = [0.3, 0.3, 0.6, 0.8, 0.5, 0.3, 0.4, 0.7, 1.0, 1.0, 1.0, 0.9,
+               0.8, 0.9, 1.0, 1.0, 0.9, 0.7, 0.5, 0.4, 0.3, 0.3, 0.3, 0.3]
+USER_NAMES = list(USERS)
+SHAPE_DATABASES = [re.search(r'\b(\w+)\.\w+', s[0]).group(1) for s in SHAPES]
+SPILL_MB = 3072          # Queries needing more memory than this per node may spill
+FAILED_RATE = 0.01
+
+FILTER_FIELDS = {
+    'queryDuration': 'duration_ms', 'admissionWait': 'admission_wait_ms',
+    'memoryPerNodePeak': 'memory', 'rowsProduced': 'rows',
+}
+FILTER_UNITS = {'': 1, 'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000,
+                'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+FILTER_TERM_RE = re.compile(r'^\s*(\w+)\s*(>=|<=|!=|=|>|<)\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*$')
+FILTER_OPS = {'>': np.greater, '<': np.less, '>=': np.greater_equal, '<=': np.less_equal,
+              '=': np.equal, '!=': np.not_equal}
+QUERIES_PATH_RE = re.compile(r'^/api/v\d+/clusters/([^/]+)/services/([^/]+)/impalaQueries(/[^/]+)?$')
+
+
+class FilterError(ValueError):
+    pass
+
+
+class SyntheticWorkload:
+    """Columnar synthetic query history; records are materialised per page."""
+
+    def __init__(self, count, end_time, hours=24, seed=42):
+        rng = np.random.default_rng(seed)
+        self.count = count
+        start = to_epoch(end_time) - hours * 3600
+
+        # Start times: queries per hour follow HOURLY_LOAD, uniform within the hour
+        hour_starts = start + 3600 * np.arange(int(np.ceil(hours)))
+        load = np.array([HOURLY_LOAD[from_epoch(t).hour] for t in hour_starts])
+        per_hour = rng.multinomial(count, load / load.sum())
+        starts = np.repeat(hour_starts, per_hour) + rng.random(count) * 3600
+        order = np.argsort(starts, kind='stable')
+        self.start = np.minimum(starts[order], to_epoch(end_time) - 0.001)
+        self.load = np.repeat(load, per_hour)[order]
+
+        self.shape = rng.choice(len(SHAPES), count, p=SHAPE_WEIGHTS).astype(np.int16)
+        self.user = rng.choice(len(USERS), count, p=USER_WEIGHTS).astype(np.int16)
+        self.coordinator = rng.choice(len(COORDINATORS), count, p=COORDINATOR_WEIGHTS).astype(np.int16)
+        self.ids = rng.integers(0, 2 ** 63, count, dtype=np.int64)
+        self.literal = rng.integers(1, 10 ** 6, count, dtype=np.int64)
+
+        median_s = np.array([s[1] for s in SHAPES])[self.shape]
+        memory_mb = np.array([s[2] for s in SHAPES])[self.shape]
+        self.duration_ms = np.round(median_s * 1000 * rng.lognormal(0, 0.6, count))
+        self.memory = np.round(memory_mb * 1024 ** 2 * rng.lognormal(0, 0.5, count))
+        self.spilled = (self.memory > SPILL_MB * 1024 ** 2) & (rng.random(count) < 0.6)
+        self.duration_ms[self.spilled] *= 1.8
+        self.stats_missing = np.array([s[3] for s in SHAPES])[self.shape]
+
+        queue_p = np.array([POOL_QUEUEING[USERS[u]][0] for u in USER_NAMES])[self.user] * self.load
+        queue_ms = np.array([POOL_QUEUEING[USERS[u]][1] for u in USER_NAMES])[self.user]
+        queued = rng.random(count) < queue_p
+        self.admission_wait_ms = np.where(queued, np.round(rng.exponential(queue_ms)), 0.0)
+        self.failed = rng.random(count) < FAILED_RATE
+        self.rows = np.where(self.shape == 1, 100, np.round(rng.lognormal(8, 2, count)))
+
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def matching(self, filter_str):
+        """Indices of the queries matching a CM filter string, in start order."""
+        with self._lock:
+            if filter_str not in self._filters:
+                self._filters[filter_str] = np.flatnonzero(self._filter_mask(filter_str))
+            return self._filters[filter_str]
+
+    def _filter_mask(self, filter_str):
+        if not filter_str.strip():
+            return np.ones(self.count, dtype=bool)
+        mask = np.zeros(self.count, dtype=bool)
+        for alternative in re.split(r'\s+OR\s+', filter_str, flags=re.IGNORECASE):
+            term_mask = np.ones(self.count, dtype=bool)
+            for term in re.split(r'\s+AND\s+', alternative, flags=re.IGNORECASE):
+                m = FILTER_TERM_RE.match(term)
+                if not m or m.group(1) not in FILTER_FIELDS or m.group(4).lower() not in FILTER_UNITS:
+                    raise FilterError(f"Unsupported filter term: {term!r}")
+                name, op, value, unit = m.groups()
+                column = getattr(self, FILTER_FIELDS[name])
+                term_mask &= FILTER_OPS[op](column, float(value) * FILTER_UNITS[unit.lower()])
+            mask |= term_mask
+        return mask
+
+    def page(self, start_time, end_time, filter_str='', offset=0, limit=PAGE_LIMIT):
+        """One page of [start_time, end_time) as CM returns it: newest first."""
+        idx = self.matching(filter_str)
+        starts = self.start[idx]
+        lo = np.searchsorted(starts, to_epoch(start_time), side='left')
+        hi = np.searchsorted(starts, to_epoch(end_time), side='left')
+        limit = min(limit, PAGE_LIMIT)
+        first = max(hi - offset, lo)
+        selection = idx[max(first - limit, lo):first][::-1]
+        return self.records(selection)
+
+    def records(self, selection):
+        """CM query dicts for an index array; columns are gathered once per page."""
+        durations = self.duration_ms[selection]
+        waits = self.admission_wait_ms[selection]
+        start_ms = np.round(self.start[selection] * 1000).astype(np.int64)
+        starts = np.datetime_as_string(start_ms.astype('datetime64[ms]'), unit='ms')
+        ends = np.datetime_as_string((start_ms + (durations + waits).astype(np.int64)).astype('datetime64[ms]'),
+                                     unit='ms')
+        columns = zip(selection.tolist(), self.ids[selection].tolist(), self.shape[selection].tolist(),
+                      self.user[selection].tolist(), self.coordinator[selection].tolist(),
+                      self.literal[selection].tolist(), starts.tolist(), ends.tolist(),
+                      durations.astype(np.int64).tolist(), waits.astype(np.int64).tolist(),
+                      self.memory[selection].astype(np.int64).tolist(), self.rows[selection].astype(np.int64).tolist(),
+                      self.spilled[selection].tolist(), self.stats_missing[selection].tolist(),
+                      self.failed[selection].tolist())
+        out = []
+        for i, qid, shape, user, coord, n, start, end, duration, wait, memory, rows, spilled, no_stats, failed in columns:
+            template = SHAPES[shape][0]
+            user = USER_NAMES[user]
+            out.append({
+                'queryId': f"{qid:016x}:{i:08x}00000000",
+                'statement': template.format(m=n % 12 + 1, d=n % 28 + 1, n=n, k=n + 7, s=f"{n:08x}"),
+                'queryType': 'DML' if template.startswith(('INSERT', 'COMPUTE')) else 'QUERY',
+                'queryState': 'EXCEPTION' if failed else 'FINISHED',
+                'startTime': start + 'Z',
+                'endTime': end + 'Z',
+                'rowsProduced': rows,
+                'user': user,
+                'coordinator': {'hostId': f"host-{coord + 1:02d}", 'hostname': COORDINATORS[coord]},
+                'detailsAvailable': True,
+                'database': SHAPE_DATABASES[shape],
+                'durationMillis': duration + wait,
+                'attributes': {
+                    'query_duration': str(duration),
+                    'admission_wait': str(wait),
+                    'admission_result': 'Admitted (queued)' if wait else 'Admitted immediately',
+                    'memory_per_node_peak': str(memory),
+                    'memory_spilled': str(memory // 4) if spilled else '0',
+                    'spilled': 'true' if spilled else 'false',
+                    'stats_missing': 'true' if no_stats else 'false',
+                    'request_pool': USERS[user],
+                    'pool': USERS[user],
+                    'hdfs_bytes_read': str(rows * 120),
+                    'thread_cpu_time': str(int(duration * 0.7)),
+                    'file_formats': 'PARQUET/SNAPPY',
+                },
+            })
+        return out
+
+
+# ----------------------------
+# HTTP server
+# ----------------------------
+
+def make_handler(workload, latency_ms=0.0, error_rate=0.0, reset_rate=0.0, seed=None):
+    rnd = random.Random(seed)
+    lock = threading.Lock()
+    counters = {'requests': 0, 'errors': 0, 'resets': 0, 'queries': 0}
+
+    class FakeCMHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'     # keep-alive, like CM
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with lock:
+                counters['requests'] += 1
+                roll = rnd.random()
+                jitter = rnd.uniform(0.5, 1.5)
+            if latency_ms:
+                time.sleep(latency_ms * jitter / 1000.0)
+            if roll < reset_rate:
+                with lock:
+                    counters['resets'] += 1
+                self.close_connection = True
+                return
+            if roll < reset_rate + error_rate:
+                with lock:
+                    counters['errors'] += 1
+                self.send_json(503, {'message': 'Service temporarily unavailable (injected)'})
+                return
+
+            url = urllib.parse.urlsplit(self.path)
+            m = QUERIES_PATH_RE.match(url.path)
+            if not m or m.group(3):
+                self.send_json(404, {'message': f"Not found: {url.path}"})
+                return
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+            start_time = parse_cm_time(params.get('from'))
+            end_time = parse_cm_time(params.get('to')) or datetime.utcnow()
+            if start_time is None:
+                start_time = end_time - timedelta(minutes=5)   # CM's default window
+            try:
+                queries = workload.page(start_time, end_time, params.get('filter', ''),
+                                        offset=int(params.get('offset', 0)),
+                                        limit=int(params.get('limit', 100)))
+            except (FilterError, ValueError) as e:
+                self.send_json(400, {'message': str(e)})
+                return
+            with lock:
+                counters['queries'] += len(queries)
+            self.send_json(200, {'queries': queries, 'warnings': []})
+
+    FakeCMHandler.counters = counters
+    return FakeCMHandler
+
+
+def start_server(workload, port=0, host='127.0.0.1', **handler_kwargs):
+    """Serve the workload from a background thread; returns the server (.server_port)."""
+    server = ThreadingHTTPServer((host, port), make_handler(workload, **handler_kwargs))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    p = argparse.ArgumentParser(description="Fake Cloudera Manager impalaQueries API")
+    p.add_argument("--port", type=int, default=7180)
+    p.add_argument("--bind", default="127.0.0.1")
+    p.add_argument("--queries", type=int, default=100000, help="Queries in the synthetic history")
+    p.add_argument("--hours", type=float, default=24, help="History length, ending at --end")
+    p.add_argument("--end", help="End of the history (UTC, YYYY-MM-DDTHH:MM:SS); default now")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--latency-ms", type=float, default=0.0, help="Mean added latency per request")
+    p.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered 503")
+    p.add_argument("--reset-rate", type=float, default=0.0, help="Fraction of connections dropped")
+    p.add_argument("--processes", type=int, default=1, help="Server processes (POSIX only)")
+    args = p.parse_args()
+
+    end_time = datetime.strptime(args.end, '%Y-%m-%dT%H:%M:%S') if args.end else datetime.utcnow()
+    t0 = time.perf_counter()
+    workload = SyntheticWorkload(args.queries, end_time, args.hours, args.seed)
+    print(f"Generated {args.queries:,} queries ({end_time - timedelta(hours=args.hours):%Y-%m-%d %H:%M} -> "
+          f"{end_time:%Y-%m-%d %H:%M} UTC) in {time.perf_counter() - t0:.1f}s", flush=True)
+    server = ThreadingHTTPServer((args.bind, args.port),
+                                 make_handler(workload, args.latency_ms, args.error_rate,
+                                              args.reset_rate, args.seed))
+    server.daemon_threads = True
+
+    # One process is GIL-bound at a few dozen pages/s; extra worker processes
+    # accept on the same listening socket and share the generated history
+    children = []
+    for k in range(1, args.processes):
+        pid = os.fork()
+        if pid == 0:
+            server.RequestHandlerClass = make_handler(workload, args.latency_ms, args.error_rate,
+                                                      args.reset_rate, args.seed + k)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Serving on http://{args.bind}:{server.server_port}/api/v43/clusters/<cluster>"
+          f"/services/<service>/impalaQueries ({args.processes} processes)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+if __name__ == "__main__":
+    main()
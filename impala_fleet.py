@@ -0,0 +1,205 @@
+"""
+Impala health report (new_impala.py) for many clusters in one run.
+
+    python impala_fleet.py clusters.json
+
+clusters.json lists the CM hosts / clusters / services; every entry
+inherits "defaults" and needs at least cm_host and cluster_name:
+
+    {
+      "defaults": {"cm_port": "7183", "cm_user": "admin", "cm_password": "secret",
+                   "service_name": "impala", "max_connections": 8},
+      "clusters": [
+        {"name": "prod-east", "cm_host": "https://cm-east.example.com", "cluster_name": "Cluster 1"},
+        {"name": "prod-west", "cm_host": "https://cm-west.example.com", "cluster_name": "Cluster 1",
+         "service_name": "impala-1"}
+      ]
+    }
+
+All clusters are fetched and analysed concurrently. max_connections caps
+the requests in flight to one CM host, shared by every cluster it manages,
+so wall time is close to the slowest cluster rather than the sum. The
+report is a consolidated fleet view followed by the usual health report
+per cluster.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from impala_cm import CMApiError, CMClient
+from impala_cache import QueryCache
+from impala_engine import WorkloadStats, analyze_batches
+from new_impala import (CACHE_DB, FETCH_WORKERS, LOOKBACK_HOURS, MIN_DURATION_SECONDS,
+                        SLICE_MINUTES, analyze_and_report, print_table)
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+MAX_CONNECTIONS_PER_HOST = 8    # Default concurrent requests per CM host
+ENTRY_DEFAULTS = {
+    'cm_port': '7183',
+    'cm_user': 'admin',
+    'cm_password': 'password',
+    'service_name': 'impala',
+    'max_connections': MAX_CONNECTIONS_PER_HOST,
+}
+
+def load_config(path):
+    """Cluster entries of the config file, each merged over the defaults."""
+    with open(path, 'r') as f:
+        config = json.load(f)
+    defaults = dict(ENTRY_DEFAULTS, **config.get('defaults', {}))
+    entries = []
+    for item in config.get('clusters', []):
+        entry = dict(defaults, **item)
+        missing = [key for key in ('cm_host', 'cluster_name') if not entry.get(key)]
+        if missing:
+            raise ValueError(f"Cluster entry {item} is missing {', '.join(missing)}")
+        entry.setdefault('name', f"{entry['cm_host']}/{entry['cluster_name']}")
+        entries.append(entry)
+    if not entries:
+        raise ValueError(f"No clusters listed in {path}")
+    names = [entry['name'] for entry in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("Cluster names in the config must be unique")
+    return entries
+
+def host_key(entry):
+    return f"{entry['cm_host']}:{entry['cm_port']}"
+
+def fetch_cluster(entry, limiter, start_time, end_time):
+    client = CMClient(entry['cm_host'], entry['cm_port'], entry['cm_user'], entry['cm_password'],
+                      limiter=limiter)
+    try:
+        # Scoped by CM host: clusters are often all called 'Cluster 1'
+        with QueryCache(CACHE_DB, scope=host_key(entry) + '/') as cache:
+            cache.refresh(
+                client, entry['cluster_name'], entry['service_name'], start_time, end_time,
+                slice_minutes=SLICE_MINUTES,
+                workers=min(FETCH_WORKERS, int(entry['max_connections']))
+            )
+            stats = analyze_batches(cache.iter_batches(
+                entry['cluster_name'], entry['service_name'], start_time, end_time,
+                min_duration_ms=MIN_DURATION_SECONDS * 1000
+            ))
+    finally:
+        client.close()
+    for row in stats.slowest():
+        row['cluster'] = entry['name']
+    return stats
+
+def run_fleet(entries):
+    """name -> (WorkloadStats or None, error or None, seconds) for every entry."""
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(hours=LOOKBACK_HOURS)
+
+    # One semaphore per CM host, sized by the first entry naming that host
+    limiters = {}
+    for entry in entries:
+        limiters.setdefault(host_key(entry), threading.BoundedSemaphore(int(entry['max_connections'])))
+
+    def run(entry):
+        began = time.time()
+        try:
+            stats = fetch_cluster(entry, limiters[host_key(entry)], start_time, end_time)
+            error = None
+        except (CMApiError, OSError) as e:
+            logging.error(f"[{entry['name']}] {e}")
+            stats, error = None, str(e)
+        except Exception as e:
+            # Anything else (bad cache row, analysis bug) fails only this cluster
+            logging.exception(f"[{entry['name']}] unexpected error")
+            stats, error = None, f"{type(e).__name__}: {e}"
+        seconds = time.time() - began
+        logging.info(f"[{entry['name']}] done in {seconds:.1f}s")
+        return entry['name'], (stats, error, seconds)
+
+    logging.info(f"Fetching {len(entries)} clusters on {len(limiters)} CM hosts "
+                 f"(last {LOOKBACK_HOURS}h, queries > {MIN_DURATION_SECONDS}s)...")
+    began = time.time()
+    with ThreadPoolExecutor(max_workers=len(entries)) as pool:
+        results = dict(pool.map(run, entries))
+    wall = time.time() - began
+    slowest = max(seconds for _, _, seconds in results.values())
+    total = sum(seconds for _, _, seconds in results.values())
+    logging.info(f"Fleet done in {wall:.1f}s (slowest cluster {slowest:.1f}s, sequential {total:.1f}s)")
+    return results
+
+def report_fleet(entries, results):
+    fleet = WorkloadStats()
+    print("\n" + "="*60)
+    print(f" IMPALA FLEET REPORT (Last {LOOKBACK_HOURS} Hours, {len(entries)} clusters)")
+    print("="*60)
+
+    print("\n>>> 1. CLUSTERS")
+    headers = ["Cluster", "Queries", "p95 Dur(s)", "% Spilled", "% No Stats", "% Queued", "Time(s)", "Status"]
+    widths = [20, 9, 10, 10, 10, 9, 8, 30]
+    rows = []
+    for entry in entries:
+        stats, error, seconds = results[entry['name']]
+        if stats is None:
+            rows.append([entry['name'], "-", "-", "-", "-", "-", f"{seconds:.1f}", f"FAILED: {error}"[:30]])
+            continue
+        fleet.merge(stats)
+        counts = stats.bottlenecks()
+        total = stats.total or 1
+        rows.append([
+            entry['name'], stats.total, f"{stats.duration_quantiles()[0.95]:.1f}",
+            f"{counts['spilled'] / total * 100:.1f}%", f"{counts['stats_missing'] / total * 100:.1f}%",
+            f"{counts['queued'] / total * 100:.1f}%", f"{seconds:.1f}", "OK",
+        ])
+    print_table(headers, rows, widths)
+
+    if not fleet.total:
+        print("\nNo queries found matching the criteria.")
+        return
+
+    p50, p95, p99 = fleet.duration_quantiles().values()
+    counts = fleet.bottlenecks()
+    print(f"\nFleet Total: {fleet.total} queries")
+    print(f"Duration p50/p95/p99: {p50:.1f}s / {p95:.1f}s / {p99:.1f}s")
+    print(f"Spilled: {counts['spilled']}  Missing Stats: {counts['stats_missing']}  Queued: {counts['queued']}")
+
+    print("\n>>> 2. TOP 5 SLOWEST QUERIES (All Clusters)")
+    top_headers = ["Cluster", "User", "Dur(s)", "Spilled?", "Stats?", "Query ID"]
+    top_widths = [20, 15, 10, 10, 10, 35]
+    top_data = [
+        [q['cluster'], q['user'], f"{q['duration_s']:.1f}", "YES" if q['spilled'] else "No",
+         "MISSING" if q['stats_missing'] else "Ok", q['query_id']]
+        for q in fleet.slowest(5)
+    ]
+    print_table(top_headers, top_data, top_widths)
+
+    print("\n>>> 3. TOP USERS (All Clusters, By Resource Time)")
+    user_headers = ["User", "Query Count", "Total Duration(s)"]
+    user_widths = [20, 15, 20]
+    user_data = [[user, u['count'], f"{u['total_duration_s']:.1f}"]
+                 for user, u in fleet.group_by('user').rows('total_duration_s', n=5)]
+    print_table(user_headers, user_data, user_widths)
+
+    for entry in entries:
+        stats = results[entry['name']][0]
+        if stats is None:
+            continue
+        print("\n" + "#"*60)
+        print(f"# CLUSTER {entry['name']}: {entry['cluster_name']} / {entry['service_name']} "
+              f"on {entry['cm_host']}")
+        print("#"*60)
+        analyze_and_report(stats)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Impala health report across several clusters")
+    parser.add_argument("config", help="JSON file listing CM hosts, clusters and services")
+    args = parser.parse_args()
+
+    try:
+        entries = load_config(args.config)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Invalid config: {e}")
+    results = run_fleet(entries)
+    report_fleet(entries, results)
@@ -0,0 +1,338 @@
+"""
+Runtime profile drill-down for the Impala health tools.
+
+Text profiles of selected queries are fetched from CM concurrently (one
+keep-alive connection per worker, see impala_cm.CMClient) and kept on disk
+as PROFILE_DIR/<queryId>.txt.gz; a finished query's profile never changes,
+so a cached one is never fetched again. Profiles are parsed line by line
+straight from the gzip stream into per-fragment and per-operator timing,
+rows, peak memory and spill bytes, and HotspotStats ranks scans, joins and
+exchanges across all parsed queries.
+"""
+import gzip
+import logging
+import os
+import re
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from impala_cm import CMApiError, impala_queries_path
+from impala_cache import RETENTION_DAYS
+
+# ==========================================
+# DEFAULTS
+# ==========================================
+PROFILE_DIR = 'impala_profiles'
+PROFILE_WORKERS = 8     # Concurrent profile downloads
+
+TIME_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 1e-3, 'us': 1e-6, 'ns': 1e-9}
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+COUNT_UNITS = {'': 1, 'K': 1e3, 'M': 1e6, 'B': 1e9}
+
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|us|ns|h|m|s)')
+SIZE_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(B|KB|MB|GB|TB)\b')
+
+# ExecSummary row: '|--03:EXCHANGE   3  1.000ms ...  UNPARTITIONED'
+SUMMARY_ROW_RE = re.compile(r'^[|\s-]*(\d+):(\S+(?: \S+)*?)\s{2,}')
+FRAGMENT_RE = re.compile(r'^(\s*)(Averaged Fragment|Coordinator Fragment|Fragment) (F\d+)')
+INSTANCE_RE = re.compile(r'^(\s*)Instance \S+?(?: \(host=([^)]*)\))?:\(Total: ([^,)]+)')
+OPERATOR_RE = re.compile(
+    r'^(\s*)([A-Z][A-Z_]*_NODE|DataStreamSender) \((?:dst_)?id=(\d+)\):'
+    r'\(Total: ([^,)]+)(?:, non-child: ([^,)]+))?'
+)
+COUNTER_RE = re.compile(r'^(\s*)- (\w+): (.*)$')
+
+# Operator counters kept (profile name -> field)
+OPERATOR_COUNTERS = {
+    'RowsReturned': 'rows',
+    'PeakMemoryUsage': 'peak_memory',
+    'WriteIoBytes': 'spill_bytes',          # buffer pool writes = spilled bytes
+    'ScratchBytesWritten': 'spill_bytes',
+    'SpilledPartitions': 'spilled_partitions',
+}
+
+
+def parse_duration(text):
+    """Impala duration ('1h2m', '5s500ms', '126.002us') to seconds."""
+    return sum(float(value) * TIME_UNITS[unit] for value, unit in DURATION_RE.findall(text or ''))
+
+
+def parse_counter(text):
+    """
+    Counter value to a number: the exact figure in parentheses when present
+    ('1.50 GB (1610612736)'), else a unit-suffixed size or count ('1.20K').
+    """
+    text = text.strip()
+    exact = re.search(r'\((\d+)\)\s*$', text)
+    if exact:
+        return float(exact.group(1))
+    size = SIZE_RE.match(text)
+    if size:
+        return float(size.group(1)) * SIZE_UNITS[size.group(2)]
+    count = re.match(r'(\d+(?:\.\d+)?)([KMB]?)\b', text)
+    if count:
+        return float(count.group(1)) * COUNT_UNITS[count.group(2)]
+    return 0.0
+
+
+def operator_kind(name):
+    if 'SCAN' in name:
+        return 'scan'
+    if 'JOIN' in name:
+        return 'join'
+    if 'EXCHANGE' in name or name == 'DataStreamSender':
+        return 'exchange'
+    return 'other'
+
+
+def parse_profile(lines, query_id=None):
+    """
+    Parse a text runtime profile from an iterable of lines in one pass.
+
+    Returns {'query_id', 'tables_missing_stats', 'fragments', 'operators'}:
+    fragments maps 'F01' to {'instances', 'max_time_s', 'peak_memory',
+    'spill_bytes'}; operators maps the plan node id to {'id', 'name',
+    'kind', 'detail', 'fragment', 'instances', 'time_s' (non-child time
+    summed over instances), 'max_time_s' (slowest instance), 'rows',
+    'peak_memory' (max over instances), 'spill_bytes', 'spilled_partitions'}.
+    Averaged Fragment sections are skipped so instances are counted once;
+    a DataStreamSender's time is charged to the exchange it feeds.
+    """
+    tables_missing = []
+    details = {}            # node id -> (ExecSummary name, detail)
+    fragments = {}
+    operators = {}
+    in_summary_table = False
+    detail_col = None
+    skip_indent = None
+    fragment = None
+    # (indent, scope) of the open blocks; scope is the operator dict or
+    # fragment dict counters below it belong to (inherited by plain sub-blocks
+    # such as 'Buffer pool:'), or None
+    stack = []
+
+    for raw in lines:
+        line = raw.rstrip('\n')
+        stripped = line.strip()
+        if query_id is None and stripped.startswith('Query (id='):
+            query_id = stripped[len('Query (id='):].split(')')[0]
+            continue
+        if stripped.startswith('Tables Missing Stats:'):
+            tables_missing = [t.strip() for t in stripped.split(':', 1)[1].split(',') if t.strip()]
+            continue
+
+        # --- ExecSummary table (printed from column 0) ---
+        if stripped.startswith('ExecSummary:'):
+            in_summary_table = True
+            continue
+        if in_summary_table:
+            if stripped.startswith('Operator') and 'Detail' in line:
+                detail_col = line.index('Detail')
+                continue
+            row = SUMMARY_ROW_RE.match(line)
+            if row:
+                detail = line[detail_col:].strip() if detail_col is not None else ''
+                details[int(row.group(1))] = (row.group(2), detail)
+                continue
+            # Separator, fragment root / sender rows; anything else ends the table
+            if (stripped and set(stripped) == {'-'}) or re.match(r'^[|\s-]*F\d+:', line) \
+                    or (not stripped and detail_col is None):
+                continue
+            in_summary_table = False
+
+        # --- Execution profile (nested by indentation) ---
+        indent = len(line) - len(line.lstrip())
+        if skip_indent is not None:
+            if indent > skip_indent or not stripped:
+                continue
+            skip_indent = None
+
+        m = FRAGMENT_RE.match(line)
+        if m:
+            stack = []
+            if m.group(2) == 'Averaged Fragment':
+                skip_indent = indent
+                fragment = None
+            else:
+                fragment = fragments.setdefault(m.group(3), {
+                    'id': m.group(3), 'instances': 0, 'max_time_s': 0.0,
+                    'peak_memory': 0.0, 'spill_bytes': 0.0,
+                })
+            continue
+        if fragment is None or not stripped:
+            continue
+
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        scope = stack[-1][1] if stack else None
+
+        counter = COUNTER_RE.match(line)
+        if counter:
+            field = OPERATOR_COUNTERS.get(counter.group(2))
+            if scope is None or field is None:
+                continue
+            value = parse_counter(counter.group(3))
+            if field == 'peak_memory':
+                scope[field] = max(scope[field], value)
+            elif scope is not fragment:
+                scope[field] += value
+            continue
+
+        m = INSTANCE_RE.match(line)
+        if m:
+            fragment['instances'] += 1
+            fragment['max_time_s'] = max(fragment['max_time_s'], parse_duration(m.group(3)))
+            stack.append((indent, fragment))
+            continue
+
+        m = OPERATOR_RE.match(line)
+        if m:
+            node_id = int(m.group(3))
+            name = m.group(2)
+            op = operators.get(node_id)
+            if op is None:
+                summary_name, detail = details.get(node_id, (name, ''))
+                op = operators[node_id] = {
+                    'id': node_id, 'name': summary_name, 'kind': operator_kind(summary_name),
+                    'detail': detail, 'fragment': fragment['id'], 'instances': 0,
+                    'time_s': 0.0, 'max_time_s': 0.0, 'rows': 0.0, 'peak_memory': 0.0,
+                    'spill_bytes': 0.0, 'spilled_partitions': 0.0,
+                }
+            non_child = parse_duration(m.group(5) if m.group(5) is not None else m.group(4))
+            op['time_s'] += non_child
+            if name == 'DataStreamSender':
+                # Sender counters (rows sent, buffers) are not the exchange's own
+                stack.append((indent, None))
+                continue
+            op['instances'] += 1
+            op['max_time_s'] = max(op['max_time_s'], non_child)
+            stack.append((indent, op))
+            continue
+        stack.append((indent, scope))
+
+    for op in operators.values():
+        fragments[op['fragment']]['spill_bytes'] += op['spill_bytes']
+
+    return {
+        'query_id': query_id,
+        'tables_missing_stats': tables_missing,
+        'fragments': fragments,
+        'operators': operators,
+    }
+
+
+class ProfileStore:
+    """On-disk cache of text runtime profiles, one gzip file per queryId."""
+
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, query_id):
+        safe = re.sub(r'[^A-Za-z0-9_.-]', '_', query_id)
+        return os.path.join(self.directory, f'{safe}.txt.gz')
+
+    def has(self, query_id):
+        return os.path.exists(self.path(query_id))
+
+    def save(self, query_id, text):
+        path = self.path(query_id)
+        tmp = f'{path}.tmp.{os.getpid()}'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def open(self, query_id):
+        return gzip.open(self.path(query_id), 'rt', encoding='utf-8', errors='replace')
+
+    def prune(self, days=RETENTION_DAYS):
+        """Drop profiles cached more than `days` ago."""
+        cutoff = time.time() - days * 86400
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+def fetch_profiles(client, cluster_name, service_name, query_ids, store, workers=PROFILE_WORKERS):
+    """
+    Download the text profile of every query in query_ids that is not in
+    the store yet, `workers` at a time. Returns the ids available on disk.
+    Profiles CM no longer has (aged out, 404) are skipped with a warning.
+    """
+    base = impala_queries_path(cluster_name, service_name)
+    missing = [qid for qid in query_ids if not store.has(qid)]
+
+    def fetch(query_id):
+        data = client.get_json(f"{base}/{urllib.parse.quote(query_id, safe='')}", {'format': 'text'})
+        store.save(query_id, data.get('details') or '')
+
+    failed = set()
+    if missing:
+        logging.info(f"Fetching {len(missing)} runtime profiles "
+                     f"({len(query_ids) - len(missing)} cached)...")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for query_id, future in [(qid, pool.submit(fetch, qid)) for qid in missing]:
+                try:
+                    future.result()
+                except CMApiError as e:
+                    logging.warning(f"No profile for {query_id}: {e}")
+                    failed.add(query_id)
+    return [qid for qid in query_ids if qid not in failed]
+
+
+class HotspotStats:
+    """Operator-level aggregates over any number of parsed profiles."""
+
+    def __init__(self):
+        self.queries = 0
+        self.operators = []         # every parsed operator, tagged with its query_id
+        self.kind_time_s = {'scan': 0.0, 'join': 0.0, 'exchange': 0.0, 'other': 0.0}
+        self.tables = {}            # scanned table -> aggregates
+        self.missing_stats = set()
+
+    def add(self, profile):
+        self.queries += 1
+        self.missing_stats.update(profile['tables_missing_stats'])
+        for op in profile['operators'].values():
+            op = dict(op, query_id=profile['query_id'])
+            self.operators.append(op)
+            self.kind_time_s[op['kind']] += op['time_s']
+            if op['kind'] == 'scan' and op['detail']:
+                table = self.tables.setdefault(op['detail'], {
+                    'queries': set(), 'time_s': 0.0, 'rows': 0.0, 'peak_memory': 0.0,
+                })
+                table['queries'].add(profile['query_id'])
+                table['time_s'] += op['time_s']
+                table['rows'] += op['rows']
+                table['peak_memory'] = max(table['peak_memory'], op['peak_memory'])
+
+    def top_operators(self, kinds=('scan', 'join', 'exchange'), n=10):
+        """The n costliest scan / join / exchange operators by summed non-child time."""
+        ops = [op for op in self.operators if op['kind'] in kinds]
+        return sorted(ops, key=lambda op: op['time_s'], reverse=True)[:n]
+
+    def table_rows(self, n=10):
+        """[(table, aggregates)] of scanned tables by total scan time."""
+        rows = []
+        for name, t in self.tables.items():
+            rows.append((name, dict(t, queries=len(t['queries']),
+                                    missing_stats=name in self.missing_stats)))
+        rows.sort(key=lambda row: row[1]['time_s'], reverse=True)
+        return rows[:n]
+
+
+def analyze_profiles(client, cluster_name, service_name, query_ids,
+                     profile_dir=PROFILE_DIR, workers=PROFILE_WORKERS):
+    """Fetch (or reuse) and parse the profiles of query_ids into a HotspotStats."""
+    store = ProfileStore(profile_dir)
+    store.prune()
+    hotspots = HotspotStats()
+    for query_id in fetch_profiles(client, cluster_name, service_name, query_ids, store, workers):
+        with store.open(query_id) as f:
+            hotspots.add(parse_profile(f, query_id))
+    return hotspots
@@ -12,6 +12,9 @@ if [[ -z "$DATE" ]]; then
   DATE=$(date +%F)
 fi
 
+# wal_compression.py lives next to this script (decompresses .zst/.lz4/.gz WAL)
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
 # Export your custom CA bundle
 export AWS_CA_BUNDLE="/path/to/tls-ca-bundle.pem"
 echo "Using CA bundle at: $AWS_CA_BUNDLE"
@@ -21,6 +24,9 @@ python3 <<EOF
 import os, sys, boto3
 from datetime import datetime
 
+sys.path.insert(0, "$SCRIPT_DIR")
+from wal_compression import codec_from_name, decompress_file
+
 backup_cluster = "$BACKUP_CLUSTER"
 cluster = "$CLUSTER"
 instance = "$INSTANCE"
@@ -46,7 +52,21 @@ s3 = boto3.client(
     aws_secret_access_key=cfg["secret"]
 )
 
-def download_key(key, dest, recursive=False):
+def restore_wal(key, tgt):
+    # The archiver stores segments compressed with the codec in the user metadata;
+    # restore them to the plain segment name PostgreSQL expects
+    if codec_from_name(tgt) == "none":
+        return
+    try:
+        metadata = s3.head_object(Bucket="pgbackup", Key=key).get("Metadata", {})
+        restored = decompress_file(tgt, metadata=metadata)
+    except Exception as e:
+        print(f"Could not decompress {tgt} (kept as is): {e}")
+        return
+    os.remove(tgt)
+    print(f"Decompressed {os.path.basename(tgt)} → {restored}")
+
+def download_key(key, dest, recursive=False, decompress=False):
     try:
         if recursive:
             paginator = s3.get_paginator("list_objects_v2")
@@ -57,6 +77,8 @@ def download_key(key, dest, recursive=False):
                     os.makedirs(os.path.dirname(tgt), exist_ok=True)
                     print(f"Downloading {obj['Key']} → {tgt}")
                     s3.download_file("pgbackup", obj["Key"], tgt)
+                    if decompress:
+                        restore_wal(obj["Key"], tgt)
         else:
             os.makedirs(os.path.dirname(dest), exist_ok=True)
             print(f"Downloading {key} → {dest}")
@@ -82,7 +104,7 @@ elif backup_type == "SQL":
 elif backup_type == "WAL":
     # WAL backups
     download_key(f"{backup_cluster}/{cluster}/wal_backups/{instance}/{date_str}/",
-                 f"{local_dir}/wal_backups", recursive=True)
+                 f"{local_dir}/wal_backups", recursive=True, decompress=True)
 else:
     print(f"Error: Invalid backup type '{backup_type}'. Must be one of: SQL, Filesystem, WAL.")
     sys.exit(1)
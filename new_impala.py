@@ -1,11 +1,11 @@
-import json
-import ssl
 import sys
-import base64
 import logging
 from datetime import datetime, timedelta
-import urllib.request
-from urllib.error import URLError, HTTPError
+
+from impala_cm import CMApiError, CMClient
+from impala_cache import QueryCache
+from impala_engine import analyze_batches
+from impala_profile import analyze_profiles
 
 # ==========================================
 # CONFIGURATION
@@ -23,40 +23,22 @@ SERVICE_NAME = 'impala'     # Usually 'impala', sometimes 'impala-1'
 # Analysis Settings
 LOOKBACK_HOURS = 24
 MIN_DURATION_SECONDS = 5.0  # Ignore fast queries to speed up analysis
-MAX_QUERIES_TO_FETCH = 5000 # Safety limit to prevent memory issues on large fetches
+
+# Fetch Settings
+SLICE_MINUTES = 60          # Window is fetched in slices; busy slices split further
+FETCH_WORKERS = 8           # Slices fetched concurrently (one keep-alive connection each)
+CACHE_DB = 'impala_query_cache.db'  # Shared with updated_impala.py / impala_analyse.py
+
+# Profile Drill-down Settings
+PROFILE_TOP_N = 20          # Runtime profiles of the N slowest queries are analysed (0 = off)
+PROFILE_WORKERS = 8         # Profiles downloaded concurrently
+PROFILE_DIR = 'impala_profiles'  # Profiles are cached here as <queryId>.txt.gz
 
 # ==========================================
 # UTILITIES & SETUP
 # ==========================================
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Disable SSL verification (common for internal CM hosts with self-signed certs)
-ctx = ssl.create_default_context()
-ctx.check_hostname = False
-ctx.verify_mode = ssl.CERT_NONE
-
-def get_auth_headers(username, password):
-    auth_str = f'{username}:{password}'
-    b64_auth = base64.b64encode(auth_str.encode()).decode()
-    return {'Authorization': f'Basic {b64_auth}'}
-
-def make_request(url):
-    """Executes a GET request and returns parsed JSON."""
-    req = urllib.request.Request(url, headers=get_auth_headers(CM_USER, CM_PASS))
-    try:
-        with urllib.request.urlopen(req, context=ctx) as response:
-            return json.loads(response.read().decode())
-    except HTTPError as e:
-        logging.error(f"HTTP Error {e.code}: {e.reason} - URL: {url}")
-        if e.code == 401:
-            logging.error("Authentication failed. Check CM_USER and CM_PASS.")
-        elif e.code == 404:
-            logging.error("Resource not found. Check CLUSTER_NAME and SERVICE_NAME.")
-        sys.exit(1)
-    except URLError as e:
-        logging.error(f"URL Error: {e.reason} - Check host reachability.")
-        sys.exit(1)
-
 def print_table(headers, rows, col_widths):
     """A manual implementation of a table printer to avoid 'tabulate' dependency."""
     # Print Header
@@ -74,170 +56,164 @@ def print_table(headers, rows, col_widths):
 # CORE LOGIC
 # ==========================================
 
-def fetch_queries():
+def fetch_workload_stats():
+    """Refresh the cache, then stream the window through the incremental aggregators."""
     end_time = datetime.utcnow()
     start_time = end_time - timedelta(hours=LOOKBACK_HOURS)
     
-    # ISO 8601 Formatting for CM API
-    from_str = start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-    to_str = end_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-    
-    # Filter syntax for CM API
-    filter_str = f'queryDuration > {MIN_DURATION_SECONDS}s'
-    
-    # Encode parameters safely
-    params = urllib.parse.urlencode({
-        'from': from_str,
-        'to': to_str,
-        'filter': filter_str,
-        'limit': 1000,
-        'offset': 0
-    })
-
-    base_url = f"{CM_HOST}:{CM_PORT}/api/v43/clusters/{CLUSTER_NAME}/services/{SERVICE_NAME}/impalaQueries"
-    
-    all_queries = []
-    offset = 0
-    
     logging.info(f"Fetching queries > {MIN_DURATION_SECONDS}s from last {LOOKBACK_HOURS}h...")
 
-    while True:
-        # Re-build query string with current offset
-        current_params = urllib.parse.urlencode({
-            'from': from_str,
-            'to': to_str,
-            'filter': filter_str,
-            'limit': 1000,
-            'offset': offset
-        })
-        
-        url = f"{base_url}?{current_params}"
-        data = make_request(url)
-        
-        queries = data.get('queries', [])
-        if not queries:
-            break
-            
-        all_queries.extend(queries)
-        offset += len(queries)
-        
-        logging.info(f"Fetched {len(all_queries)} queries...")
-        
-        if len(queries) < 1000 or len(all_queries) >= MAX_QUERIES_TO_FETCH:
-            break
-            
-    return all_queries
-
-def analyze_and_report(queries):
-    if not queries:
+    # SSL verification is disabled (common for internal CM hosts with self-signed certs)
+    client = CMClient(CM_HOST, CM_PORT, CM_USER, CM_PASS)
+    try:
+        # Only the part of the window not cached yet is fetched from CM;
+        # the duration threshold is applied to the cache
+        with QueryCache(CACHE_DB) as cache:
+            cache.refresh(
+                client, CLUSTER_NAME, SERVICE_NAME, start_time, end_time,
+                slice_minutes=SLICE_MINUTES, workers=FETCH_WORKERS
+            )
+            return analyze_batches(cache.iter_batches(
+                CLUSTER_NAME, SERVICE_NAME, start_time, end_time,
+                min_duration_ms=MIN_DURATION_SECONDS * 1000
+            ), top_k=max(5, PROFILE_TOP_N))
+    except CMApiError as e:
+        logging.error(str(e))
+        if e.status == 401:
+            logging.error("Authentication failed. Check CM_USER and CM_PASS.")
+        elif e.status == 404:
+            logging.error("Resource not found. Check CLUSTER_NAME and SERVICE_NAME.")
+        elif e.status is None:
+            logging.error("Check host reachability.")
+        sys.exit(1)
+    finally:
+        client.close()
+
+def fetch_hotspots(stats):
+    """Operator-level hotspots from the runtime profiles of the slowest queries."""
+    query_ids = [q['query_id'] for q in stats.slowest(PROFILE_TOP_N)]
+    if not query_ids:
+        return None
+    client = CMClient(CM_HOST, CM_PORT, CM_USER, CM_PASS)
+    try:
+        return analyze_profiles(client, CLUSTER_NAME, SERVICE_NAME, query_ids,
+                                profile_dir=PROFILE_DIR, workers=PROFILE_WORKERS)
+    except CMApiError as e:
+        # The summary report is still useful without the drill-down
+        logging.error(f"Profile fetch failed: {e}")
+        return None
+    finally:
+        client.close()
+
+def fmt_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f}TB"
+
+def analyze_and_report(stats, hotspots=None):
+    if not stats.total:
         print("\nNo queries found matching the criteria.")
         return
 
-    # Metrics containers
-    total_count = len(queries)
-    spilled_count = 0
-    missing_stats_count = 0
-    high_wait_count = 0
-    
-    # For Top N lists
-    slowest_queries = []
-    user_stats = {}
-
-    for q in queries:
-        attrs = q.get('attributes', {})
-        
-        # safely get attributes
-        duration_ms = attrs.get('query_duration', 0)
-        duration_s = float(duration_ms) / 1000.0
-        user = q.get('user', 'unknown')
-        query_id = q.get('queryId', 'N/A')
-        
-        # Check Booleans (CM returns them as strings 'true'/'false' or actual booleans depending on version)
-        is_spilled = str(attrs.get('spilled', 'false')).lower() == 'true'
-        is_missing_stats = str(attrs.get('stats_missing', 'false')).lower() == 'true'
-        
-        wait_ms = float(attrs.get('admission_wait', 0))
-        
-        # 1. Aggregate Bottlenecks
-        if is_spilled:
-            spilled_count += 1
-        if is_missing_stats:
-            missing_stats_count += 1
-        if wait_ms > 1000: # Wait > 1 second
-            high_wait_count += 1
-            
-        # 2. Collect for Top N
-        slowest_queries.append({
-            'user': user,
-            'duration': duration_s,
-            'spilled': "YES" if is_spilled else "No",
-            'stats': "MISSING" if is_missing_stats else "Ok",
-            'id': query_id
-        })
-        
-        # 3. User Aggregation
-        if user not in user_stats:
-            user_stats[user] = {'count': 0, 'total_duration': 0.0}
-        user_stats[user]['count'] += 1
-        user_stats[user]['total_duration'] += duration_s
+    total_count = stats.total
+    counts = stats.bottlenecks()
+    p50, p95, p99 = stats.duration_quantiles().values()
 
     # --- GENERATE REPORT ---
     print("\n" + "="*60)
     print(f" IMPALA HEALTH REPORT (Last {LOOKBACK_HOURS} Hours)")
     print("="*60)
     print(f"Total Analyzed: {total_count}")
+    print(f"Duration p50/p95/p99: {p50:.1f}s / {p95:.1f}s / {p99:.1f}s")
     
     # 1. Bottleneck Overview
-    spill_pct = (spilled_count / total_count) * 100
-    stats_pct = (missing_stats_count / total_count) * 100
-    wait_pct = (high_wait_count / total_count) * 100
+    spill_pct = (counts['spilled'] / total_count) * 100
+    stats_pct = (counts['stats_missing'] / total_count) * 100
+    wait_pct = (counts['queued'] / total_count) * 100
     
     print("\n>>> 1. BOTTLENECK DISTRIBUTION")
     overview_headers = ["Issue", "Count", "% Workload", "Action"]
     overview_widths = [25, 8, 12, 30]
     overview_data = [
-        ["Spilling to Disk", spilled_count, f"{spill_pct:.1f}%", "Increase Mem / Fix Joins"],
-        ["Missing Table Stats", missing_stats_count, f"{stats_pct:.1f}%", "Run COMPUTE STATS"],
-        ["Admission Queueing", high_wait_count, f"{wait_pct:.1f}%", "Check Resource Pools"]
+        ["Spilling to Disk", counts['spilled'], f"{spill_pct:.1f}%", "Increase Mem / Fix Joins"],
+        ["Missing Table Stats", counts['stats_missing'], f"{stats_pct:.1f}%", "Run COMPUTE STATS"],
+        ["Admission Queueing", counts['queued'], f"{wait_pct:.1f}%", "Check Resource Pools"]
     ]
     print_table(overview_headers, overview_data, overview_widths)
 
-    # 2. Top Slow Queries
+    # 2. Top Slow Queries (kept in a bounded heap while streaming)
     print("\n>>> 2. TOP 5 SLOWEST QUERIES")
-    # Sort by duration descending
-    slowest_queries.sort(key=lambda x: x['duration'], reverse=True)
-    
     top_headers = ["User", "Dur(s)", "Spilled?", "Stats?", "Query ID"]
     top_widths = [15, 10, 10, 10, 35]
     top_data = []
-    for q in slowest_queries[:5]:
-        top_data.append([q['user'], f"{q['duration']:.1f}", q['spilled'], q['stats'], q['id']])
+    for q in stats.slowest(5):
+        top_data.append([
+            q['user'],
+            f"{q['duration_s']:.1f}",
+            "YES" if q['spilled'] else "No",
+            "MISSING" if q['stats_missing'] else "Ok",
+            q['query_id'],
+        ])
     
     print_table(top_headers, top_data, top_widths)
 
     # 3. Top Heavy Users
     print("\n>>> 3. TOP USERS (By Resource Time)")
-    # Convert dict to list for sorting
-    user_list = []
-    for u, stats in user_stats.items():
-        user_list.append([u, stats['count'], stats['total_duration']])
-    
-    # Sort by total duration
-    user_list.sort(key=lambda x: x[2], reverse=True)
-    
     user_headers = ["User", "Query Count", "Total Duration(s)"]
     user_widths = [20, 15, 20]
     user_data = []
-    for u in user_list[:5]:
-        user_data.append([u[0], u[1], f"{u[2]:.1f}"])
+    for user, u in stats.group_by('user').rows('total_duration_s', n=5):
+        user_data.append([user, u['count'], f"{u['total_duration_s']:.1f}"])
         
     print_table(user_headers, user_data, user_widths)
+
+    if hotspots is not None and hotspots.queries:
+        report_hotspots(hotspots)
     print("\n")
 
+def report_hotspots(hotspots):
+    # Times are non-child time summed over all instances of an operator
+    print(f"\n>>> 4. OPERATOR HOTSPOTS (Runtime profiles of the {hotspots.queries} slowest queries)")
+    kind_total = sum(hotspots.kind_time_s.values()) or 1
+    kind_headers = ["Operator Type", "Time(s)", "% Time"]
+    kind_widths = [15, 12, 8]
+    kind_data = [[kind, f"{t:.1f}", f"{t / kind_total * 100:.1f}%"]
+                 for kind, t in sorted(hotspots.kind_time_s.items(), key=lambda kv: -kv[1])]
+    print_table(kind_headers, kind_data, kind_widths)
+
+    print("\n    Costliest scans / joins / exchanges")
+    op_headers = ["Query ID", "Operator", "Detail", "Time(s)", "Max Inst(s)", "Rows", "Peak Mem", "Spilled"]
+    op_widths = [35, 22, 30, 8, 11, 12, 10, 10]
+    op_data = []
+    for op in hotspots.top_operators(n=10):
+        op_data.append([
+            op['query_id'],
+            f"{op['id']:02d}:{op['name']}",
+            op['detail'][:30],
+            f"{op['time_s']:.1f}",
+            f"{op['max_time_s']:.1f}",
+            f"{op['rows']:.0f}",
+            fmt_bytes(op['peak_memory']),
+            fmt_bytes(op['spill_bytes']) if op['spill_bytes'] else "No",
+        ])
+    print_table(op_headers, op_data, op_widths)
+
+    print("\n    Scanned tables by scan time")
+    table_headers = ["Table", "Queries", "Scan Time(s)", "Rows Read", "Action"]
+    table_widths = [35, 8, 12, 14, 30]
+    table_data = []
+    for table, t in hotspots.table_rows(n=10):
+        action = "Run COMPUTE STATS" if t['missing_stats'] else "Check partition pruning"
+        table_data.append([table, t['queries'], f"{t['time_s']:.1f}", f"{t['rows']:.0f}", action])
+    print_table(table_headers, table_data, table_widths)
+
 if __name__ == "__main__":
     try:
-        data = fetch_queries()
-        analyze_and_report(data)
+        stats = fetch_workload_stats()
+        hotspots = fetch_hotspots(stats) if PROFILE_TOP_N else None
+        analyze_and_report(stats, hotspots)
     except KeyboardInterrupt:
         print("\nAnalysis cancelled by user.")
     except Exception as e:
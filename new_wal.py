@@ -3,10 +3,14 @@ import os
 import sys
 import logging
 import boto3
+import json
 import shutil
 import time
 from botocore.exceptions import NoCredentialsError, EndpointConnectionError
-from datetime import datetime, timedelta
+from datetime import datetime
+
+from ozone_upload import UploadIntegrityError, abort_stale_uploads, upload_file_verified
+from wal_compression import EXTENSIONS, compress_file, resolve_codec
 
 # Configuration
 OZONE_ENDPOINT = 'http://your-ozone-endpoint:9878'
@@ -17,7 +21,12 @@ OZONE_BASE_FOLDER = 'wal_backups'
 LOCAL_FALLBACK_DIR = '/var/lib/postgresql/wal_archive_fallback'  # Local fallback directory
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
-RETENTION_DAYS = 20  # Number of days to keep
+RETENTION_DAYS = 20  # Date partitions older than now - RETENTION_DAYS are deleted (by wal_retention.py)
+SPOOL_DRAIN_LIMIT = 32  # Spooled segments drained per one-shot call (wal_spool_drain.py drains the rest)
+S3_MAX_POOL_CONNECTIONS = 10  # HTTP connections kept open per client (daemon uploads concurrently)
+WAL_COMPRESSION = 'auto'  # zstd | lz4 | gzip | none; auto = zstd if installed, else gzip
+WAL_COMPRESSION_LEVEL = None  # None = the codec's default (see wal_compression.py)
+COMPRESS_TMP_DIR = '/var/lib/postgresql/wal_compress_tmp'  # Same filesystem as LOCAL_FALLBACK_DIR
 
 # Logging configuration
 logging.basicConfig(
@@ -35,8 +44,11 @@ def ensure_local_fallback_dir():
         os.makedirs(LOCAL_FALLBACK_DIR, mode=0o700)
         os.chown(LOCAL_FALLBACK_DIR, os.getuid(), os.getgid())
         logger.info(f"Created local fallback directory: {LOCAL_FALLBACK_DIR}")
+    os.makedirs(COMPRESS_TMP_DIR, mode=0o700, exist_ok=True)
 
-def initialize_s3_client():
+def initialize_s3_client(max_pool_connections=S3_MAX_POOL_CONNECTIONS):
+    # boto3 clients are thread-safe; one client (and its connection pool)
+    # is shared by every upload thread of the daemon
     return boto3.client(
         's3',
         endpoint_url=OZONE_ENDPOINT,
@@ -45,22 +57,26 @@ def initialize_s3_client():
         config=boto3.session.Config(
             connect_timeout=10,
             read_timeout=30,
-            retries={'max_attempts': 2}
+            retries={'max_attempts': 2},
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True
         )
     )
 
-def upload_to_ozone(file_path, file_name):
-    s3_client = initialize_s3_client()
+def upload_to_ozone(file_path, file_name, s3_client=None, metadata=None):
+    s3_client = s3_client or initialize_s3_client()
     date_folder = datetime.now().strftime('%Y-%m-%d')
     ozone_key = f"{OZONE_BASE_FOLDER}/{date_folder}/{file_name}"
     
     for attempt in range(MAX_RETRIES):
         try:
-            s3_client.upload_file(file_path, OZONE_BUCKET, ozone_key)
+            # Checksummed (and for big files multipart, resumable) upload;
+            # a retry picks up the parts that already made it
+            upload_file_verified(s3_client, file_path, OZONE_BUCKET, ozone_key, metadata)
             logger.info(f"Successfully uploaded {file_name} to Ozone")
             return True
-        except (NoCredentialsError, EndpointConnectionError) as e:
-            logger.warning(f"Ozone connection failed (attempt {attempt + 1}): {e}")
+        except (NoCredentialsError, EndpointConnectionError, UploadIntegrityError) as e:
+            logger.warning(f"Ozone upload failed (attempt {attempt + 1}): {e}")
             if attempt < MAX_RETRIES - 1:
                 time.sleep(RETRY_DELAY)
             continue
@@ -69,70 +85,82 @@ def upload_to_ozone(file_path, file_name):
             return False
     return False
 
-def save_to_local_fallback(file_path, file_name):
+def compress_segment(file_path, file_name):
+    """
+    Compress a segment into COMPRESS_TMP_DIR; returns (path, object name,
+    metadata) to upload. With WAL_COMPRESSION = 'none' the segment itself.
+    """
+    codec = resolve_codec(WAL_COMPRESSION)
+    if codec == 'none':
+        return file_path, file_name, {}
+    upload_name = file_name + EXTENSIONS[codec]
+    upload_path = os.path.join(COMPRESS_TMP_DIR, upload_name)
+    metadata = compress_file(file_path, upload_path, codec, WAL_COMPRESSION_LEVEL)
+    return upload_path, upload_name, metadata
+
+def archive_segment(file_path, file_name, s3_client=None):
+    """
+    Compress and upload one segment, else spool it to the local fallback.
+    Returns where it is durably stored ('ozone' / 'fallback'), or None.
+    """
     try:
-        dest_path = os.path.join(LOCAL_FALLBACK_DIR, file_name)
-        shutil.copy2(file_path, dest_path)
-        logger.info(f"Saved {file_name} to local fallback directory")
-        return True
+        upload_path, upload_name, metadata = compress_segment(file_path, file_name)
     except Exception as e:
-        logger.error(f"Failed to save {file_name} locally: {e}")
-        return False
-
-def retry_fallback_uploads():
-    if not os.path.exists(LOCAL_FALLBACK_DIR):
-        return
-    
-    s3_client = initialize_s3_client()
-    
-    for file_name in os.listdir(LOCAL_FALLBACK_DIR):
-        file_path = os.path.join(LOCAL_FALLBACK_DIR, file_name)
-        date_folder = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d')
-        ozone_key = f"{OZONE_BASE_FOLDER}/{date_folder}/{file_name}"
-        
-        try:
-            s3_client.upload_file(file_path, OZONE_BUCKET, ozone_key)
-            logger.info(f"Successfully uploaded fallback file {file_name}")
-            os.remove(file_path)
-        except Exception as e:
-            logger.warning(f"Failed to upload fallback file {file_name}: {e}")
-            break
+        logger.warning(f"Compressing {file_name} failed, archiving it uncompressed: {e}")
+        upload_path, upload_name, metadata = file_path, file_name, {}
+    try:
+        if upload_to_ozone(upload_path, upload_name, s3_client, metadata):
+            return 'ozone'
+        if save_to_local_fallback(upload_path, upload_name, metadata):
+            return 'fallback'
+        return None
+    finally:
+        if upload_path != file_path and os.path.exists(upload_path):
+            os.remove(upload_path)
 
-def delete_old_folders_from_ozone():
-    """Delete folders older than RETENTION_DAYS from Ozone"""
-    s3_client = initialize_s3_client()
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
     try:
-        response = s3_client.list_objects_v2(Bucket=OZONE_BUCKET, Prefix=OZONE_BASE_FOLDER + '/')
-        folders = {}
-        for obj in response.get('Contents', []):
-            key = obj['Key']
-            parts = key.split('/')
-            if len(parts) >= 3:
-                folder = parts[1]
-                try:
-                    folder_date = datetime.strptime(folder, '%Y-%m-%d')
-                    if folder not in folders:
-                        folders[folder] = folder_date
-                except ValueError:
-                    continue  # Not a date folder
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-        cutoff_date = datetime.now() - timedelta(days=RETENTION_DAYS)
-        for folder, folder_date in folders.items():
-            if folder_date < cutoff_date:
-                logger.info(f"Deleting folder {folder} from Ozone (older than {RETENTION_DAYS} days)")
-                # List and delete all objects in the folder
-                folder_prefix = f"{OZONE_BASE_FOLDER}/{folder}/"
-                delete_response = s3_client.list_objects_v2(Bucket=OZONE_BUCKET, Prefix=folder_prefix)
-                objects_to_delete = [{'Key': obj['Key']} for obj in delete_response.get('Contents', [])]
+def metadata_path(fallback_path):
+    return fallback_path + '.meta'
 
-                if objects_to_delete:
-                    s3_client.delete_objects(
-                        Bucket=OZONE_BUCKET,
-                        Delete={'Objects': objects_to_delete}
-                    )
-                    logger.info(f"Deleted {len(objects_to_delete)} objects from {folder}")
+def save_to_local_fallback(file_path, file_name, metadata=None):
+    # PostgreSQL recycles the segment once we report success, so the copy must
+    # be on disk first: write to a temp name, fsync, rename, fsync the directory.
+    # A compressed segment keeps its codec / original size in a .meta sidecar,
+    # written first so a spooled file is never without it
+    tmp_path = os.path.join(LOCAL_FALLBACK_DIR, f".{file_name}.tmp")
+    dest_path = os.path.join(LOCAL_FALLBACK_DIR, file_name)
+    try:
+        if metadata:
+            with open(tmp_path, 'w') as f:
+                json.dump(metadata, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, metadata_path(dest_path))
+        shutil.copy2(file_path, tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(tmp_path, dest_path)
+        fsync_dir(LOCAL_FALLBACK_DIR)
+        logger.info(f"Saved {file_name} to local fallback directory")
+        return True
     except Exception as e:
-        logger.error(f"Failed to delete old folders from Ozone: {e}")
+        logger.error(f"Failed to save {file_name} locally: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+def load_fallback_metadata(file_path):
+    path = metadata_path(file_path)
+    if not os.path.exists(path):
+        return {}  # Uncompressed segment
+    with open(path) as f:
+        return json.load(f)
 
 def main():
     if len(sys.argv) != 3:
@@ -148,15 +176,16 @@ def main():
     
     ensure_local_fallback_dir()
     
-    if upload_to_ozone(wal_path, wal_file):
-        retry_fallback_uploads()
-        delete_old_folders_from_ozone()  # Clean old backups
-        sys.exit(0)
-    
-    if save_to_local_fallback(wal_path, wal_file):
-        sys.exit(0)
-    else:
-        sys.exit(1)
+    # One-shot mode (archive_command = 'new_wal.py %p %f'); see
+    # wal_archiver_daemon.py / wal_archive_shim.py for the persistent archiver.
+    # Retention is not run here: schedule wal_retention.py (or use the daemon)
+    s3_client = initialize_s3_client()
+    stored = archive_segment(wal_path, wal_file, s3_client)
+    if stored == 'ozone':
+        from wal_spool_drain import drain_spool
+        drain_spool(s3_client, limit=SPOOL_DRAIN_LIMIT)
+        abort_stale_uploads(s3_client)
+    sys.exit(0 if stored else 1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Verified, resumable uploads to Ozone (S3 gateway), shared by the WAL
+archiver (new_wal.py) and the filesystem backup tarballs.
+
+    python3 ozone_upload.py /backups/2024-11-14.tar.gz PVOS/ATB123/file_systembackups/psqld1/2024-11-14.tar.gz
+
+Files below MULTIPART_THRESHOLD go up in one PUT carrying Content-MD5, so
+Ozone rejects a corrupted body, and the returned ETag is compared with the
+local MD5. Larger files are split into MULTIPART_CHUNK_SIZE parts uploaded
+PART_CONCURRENCY at a time. Each part carries its own Content-MD5, its
+ETag is checked, and a failed part is retried on its own. The completed
+object must have the local size and, when Ozone returns an S3-style
+composite ETag, equal MD5(part digests)-N. Progress (upload id) is
+journaled in STATE_DIR, so a later attempt at the same file and key lists
+the parts Ozone already holds, keeps those matching the local chunks and
+uploads only the rest. Memory use is PART_CONCURRENCY chunks.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Configuration
+MULTIPART_THRESHOLD = 64 * 1024 * 1024   # Files at least this big use multipart
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024  # Part size (S3 minimum is 5MB, max 10000 parts)
+PART_CONCURRENCY = 4                     # Parts in flight per file
+PART_RETRIES = 4
+PART_RETRY_DELAY = 1  # seconds, doubled per attempt
+STATE_DIR = '/var/lib/postgresql/ozone_upload_state'  # Resume journals of unfinished uploads
+STATE_MAX_AGE_DAYS = 7  # Unfinished uploads older than this are aborted
+
+COMPOSITE_ETAG_RE = re.compile(r'^[0-9a-f]{32}-\d+$')
+
+logger = logging.getLogger()
+
+class UploadIntegrityError(Exception):
+    """Ozone stored something other than what was sent (ETag / checksum mismatch)."""
+
+def md5_b64(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+def etag_hex(etag):
+    return (etag or '').strip('"').lower()
+
+def read_chunk(file_path, offset, length):
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+def file_md5(file_path, block_size=1024 * 1024):
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.digest()
+
+def state_path(bucket, key):
+    name = hashlib.sha1(f"{bucket}/{key}".encode('utf-8')).hexdigest()
+    return os.path.join(STATE_DIR, f"{name}.json")
+
+def save_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def put_verified(s3_client, file_path, bucket, key, metadata=None):
+    """Single PUT with Content-MD5; the ETag must match the local MD5."""
+    digest = file_md5(file_path)
+    with open(file_path, 'rb') as body:
+        response = s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentMD5=md5_b64(digest),
+                                        Metadata=metadata or {})
+    if etag_hex(response.get('ETag')) != digest.hex():
+        raise UploadIntegrityError(f"ETag {response.get('ETag')} of {key} does not match MD5 {digest.hex()}")
+    return response['ETag']
+
+def upload_part_verified(s3_client, file_path, bucket, key, upload_id, part_number, offset, length):
+    """Upload one part, retrying just this part; returns its ETag."""
+    data = read_chunk(file_path, offset, length)
+    digest = hashlib.md5(data).digest()
+    for attempt in range(PART_RETRIES):
+        try:
+            response = s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                             Body=data, ContentMD5=md5_b64(digest))
+            if etag_hex(response.get('ETag')) != digest.hex():
+                raise UploadIntegrityError(f"Part {part_number} of {key}: ETag {response.get('ETag')} "
+                                           f"does not match MD5 {digest.hex()}")
+            return response['ETag']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                raise  # The upload is gone, retrying the part cannot help
+            error = e
+        except (BotoCoreError, UploadIntegrityError) as e:
+            error = e
+        if attempt < PART_RETRIES - 1:
+            delay = PART_RETRY_DELAY * (2 ** attempt)
+            logger.warning(f"Part {part_number} of {key} failed (attempt {attempt + 1}): {error}; "
+                           f"retrying in {delay}s")
+            time.sleep(delay)
+    raise error
+
+def load_resumable(s3_client, bucket, key, file_path, chunk_size):
+    """(upload_id, {part number: etag}) of a matching unfinished upload, or None."""
+    path = state_path(bucket, key)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    stat = os.stat(file_path)
+    if (state.get('size'), state.get('mtime'), state.get('chunk_size')) != (stat.st_size, stat.st_mtime, chunk_size):
+        logger.info(f"{key}: local file changed since the interrupted upload, starting over")
+        abort_upload(s3_client, bucket, key, state['upload_id'])
+        os.remove(path)
+        return None
+
+    # Trust only parts Ozone still has and whose ETag matches the local chunk
+    parts = {}
+    marker = 0
+    try:
+        while True:
+            response = s3_client.list_parts(Bucket=bucket, Key=key, UploadId=state['upload_id'],
+                                            PartNumberMarker=marker)
+            for part in response.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+            if not response.get('IsTruncated'):
+                break
+            marker = response['NextPartNumberMarker']
+    except ClientError as e:
+        logger.info(f"{key}: cannot resume upload {state['upload_id']} ({e}), starting over")
+        os.remove(path)
+        return None
+    verified = {}
+    for number, etag in parts.items():
+        offset = (number - 1) * chunk_size
+        if etag_hex(etag) == hashlib.md5(read_chunk(file_path, offset, chunk_size)).hexdigest():
+            verified[number] = etag
+    return state['upload_id'], verified
+
+def abort_upload(s3_client, bucket, key, upload_id):
+    try:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f"Could not abort upload {upload_id} of {key}: {e}")
+
+def abort_stale_uploads(s3_client, max_age_days=STATE_MAX_AGE_DAYS):
+    """Abort journaled uploads nobody resumed (e.g. WAL retried under a new date folder)."""
+    if not os.path.isdir(STATE_DIR):
+        return
+    cutoff = time.time() - max_age_days * 86400
+    for name in os.listdir(STATE_DIR):
+        path = os.path.join(STATE_DIR, name)
+        if not name.endswith('.json') or os.path.getmtime(path) >= cutoff:
+            continue
+        with open(path) as f:
+            state = json.load(f)
+        abort_upload(s3_client, state['bucket'], state['key'], state['upload_id'])
+        os.remove(path)
+        logger.info(f"Aborted stale multipart upload of {state['key']}")
+
+def multipart_upload(s3_client, file_path, bucket, key, metadata=None,
+                     chunk_size=MULTIPART_CHUNK_SIZE, concurrency=PART_CONCURRENCY):
+    size = os.path.getsize(file_path)
+    os.makedirs(STATE_DIR, mode=0o700, exist_ok=True)
+    path = state_path(bucket, key)
+
+    resumed = load_resumable(s3_client, bucket, key, file_path, chunk_size)
+    if resumed:
+        upload_id, done = resumed
+        logger.info(f"Resuming upload of {key}: {len(done)} parts already in Ozone")
+    else:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata or {})['UploadId']
+        done = {}
+    stat = os.stat(file_path)
+    state = {'bucket': bucket, 'key': key, 'upload_id': upload_id, 'size': stat.st_size,
+             'mtime': stat.st_mtime, 'chunk_size': chunk_size}
+    save_state(path, state)
+
+    part_count = max(1, -(-size // chunk_size))
+    todo = [n for n in range(1, part_count + 1) if n not in done]
+    lock = threading.Lock()
+
+    def upload(number):
+        offset = (number - 1) * chunk_size
+        etag = upload_part_verified(s3_client, file_path, bucket, key, upload_id, number,
+                                    offset, min(chunk_size, size - offset))
+        with lock:
+            done[number] = etag
+        return etag
+
+    # A failure leaves the journal and the uploaded parts for the next attempt
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(upload, todo))
+
+    parts = [{'PartNumber': n, 'ETag': done[n]} for n in sorted(done)]
+    response = s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                   MultipartUpload={'Parts': parts})
+    # Every part was verified on upload; the assembled object must have the
+    # expected size and, where Ozone reports the S3-style composite ETag, digest
+    expected = hashlib.md5(b''.join(bytes.fromhex(etag_hex(p['ETag'])) for p in parts)).hexdigest()
+    etag = etag_hex(response.get('ETag'))
+    if COMPOSITE_ETAG_RE.match(etag) and etag != f"{expected}-{len(parts)}":
+        raise UploadIntegrityError(f"ETag {response.get('ETag')} of {key} does not match "
+                                   f"{expected}-{len(parts)}")
+    stored = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if stored != size:
+        raise UploadIntegrityError(f"{key} is {stored} bytes in Ozone, {size} locally")
+    os.remove(path)
+    return response['ETag']
+
+def upload_file_verified(s3_client, file_path, bucket, key, metadata=None,
+                         chunk_size=MULTIPART_CHUNK_SIZE, concurrency=PART_CONCURRENCY,
+                         threshold=MULTIPART_THRESHOLD):
+    """Upload file_path to bucket/key and verify what Ozone stored; returns the ETag."""
+    if os.path.getsize(file_path) < threshold:
+        return put_verified(s3_client, file_path, bucket, key, metadata)
+    return multipart_upload(s3_client, file_path, bucket, key, metadata, chunk_size, concurrency)
+
+def main():
+    from new_wal import OZONE_BUCKET, initialize_s3_client
+
+    parser = argparse.ArgumentParser(description="Verified, resumable upload of one file to Ozone")
+    parser.add_argument("file")
+    parser.add_argument("key", help="Object key, e.g. <cluster>/file_systembackups/<instance>/<date>.tar.gz")
+    parser.add_argument("--bucket", default=OZONE_BUCKET)
+    parser.add_argument("--chunk-mb", type=int, default=MULTIPART_CHUNK_SIZE // 1024 // 1024)
+    parser.add_argument("--concurrency", type=int, default=PART_CONCURRENCY)
+    args = parser.parse_args()
+
+    s3_client = initialize_s3_client(max_pool_connections=args.concurrency + 2)
+    abort_stale_uploads(s3_client)
+    started = time.time()
+    try:
+        etag = upload_file_verified(s3_client, args.file, args.bucket, args.key,
+                                    chunk_size=args.chunk_mb * 1024 * 1024, concurrency=args.concurrency)
+    except (BotoCoreError, ClientError, UploadIntegrityError, OSError) as e:
+        logger.error(f"Upload of {args.file} failed (rerun to resume): {e}")
+        sys.exit(1)
+    size_mb = os.path.getsize(args.file) / 1024 / 1024
+    elapsed = time.time() - started
+    logger.info(f"Uploaded {args.file} to {args.bucket}/{args.key} ({size_mb:.0f}MB in {elapsed:.1f}s, "
+                f"ETag {etag})")
+
+if __name__ == "__main__":
+    main()
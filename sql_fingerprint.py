@@ -0,0 +1,32 @@
+"""
+SQL statement fingerprints shared by hs2_anlyzer.py and impala_engine.py,
+so the same statement gets the same fingerprint in both tools.
+
+Literals and IN-lists become "?", comments and whitespace runs collapse, so
+templated BI statements that only differ in their constants share one
+normalised text; the fingerprint is its 8-byte BLAKE2b digest.
+"""
+import hashlib
+import re
+
+SQL_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+SQL_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+SQL_NUMBER_RE = re.compile(r"(?<![\w.])[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+SQL_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+SQL_WHITESPACE_RE = re.compile(r"\s+")
+SQL_PUNCT_SPACE_RE = re.compile(r"\s*([(),=<>!+*/%;|])\s*")
+
+
+def normalize_sql(sql: str) -> str:
+    q = SQL_COMMENT_RE.sub(" ", sql)
+    q = SQL_STRING_RE.sub("?", q)
+    q = SQL_NUMBER_RE.sub("?", q)
+    q = SQL_IN_LIST_RE.sub("IN (?+)", q)
+    q = SQL_WHITESPACE_RE.sub(" ", q)
+    return SQL_PUNCT_SPACE_RE.sub(r"\1", q).strip().lower()
+
+
+def sql_digest(sql: str):
+    """(8-byte digest, normalised text) of a SQL statement."""
+    normalized = normalize_sql(sql)
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), normalized
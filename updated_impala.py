@@ -1,11 +1,11 @@
-import json
-import ssl
 import sys
-import base64
+import csv
 import logging
 from datetime import datetime, timedelta
-import urllib.request
-from urllib.error import URLError, HTTPError
+
+from impala_cm import CMApiError, CMClient
+from impala_cache import CACHE_FILTER, QueryCache, from_epoch
+from impala_engine import ConcurrencyTimeline, analyze_batches
 
 # ==========================================
 # CONFIGURATION
@@ -22,29 +22,21 @@ LOOKBACK_HOURS = 24
 # We lower the duration threshold to 0 because even fast queries 
 # can get stuck in the queue, and we want to see ALL queuing behavior.
 MIN_DURATION_SECONDS = 0.0 
-MAX_QUERIES_TO_FETCH = 5000
+
+# Concurrency Timeline Settings
+TIMELINE_RESOLUTION_SECONDS = 60    # Bucket width of the queued/running time series
+SATURATED_FRACTION = 0.5            # A bucket is "saturated" if the pool queue was non-empty this long
+TIMELINE_CSV = 'impala_queue_timeline.csv'  # Full per-pool / per-coordinator series ('' to skip)
+
+# Fetch Settings
+SLICE_MINUTES = 60
+FETCH_WORKERS = 8
+CACHE_DB = 'impala_query_cache.db'
 
 # ==========================================
 # SETUP (Same as before)
 # ==========================================
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-ctx = ssl.create_default_context()
-ctx.check_hostname = False
-ctx.verify_mode = ssl.CERT_NONE
-
-def get_auth_headers(username, password):
-    auth_str = f'{username}:{password}'
-    b64_auth = base64.b64encode(auth_str.encode()).decode()
-    return {'Authorization': f'Basic {b64_auth}'}
-
-def make_request(url):
-    req = urllib.request.Request(url, headers=get_auth_headers(CM_USER, CM_PASS))
-    try:
-        with urllib.request.urlopen(req, context=ctx) as response:
-            return json.loads(response.read().decode())
-    except Exception as e:
-        logging.error(f"Request failed: {e}")
-        sys.exit(1)
 
 def print_table(headers, rows, col_widths):
     header_str = " | ".join(f"{h:<{w}}" for h, w in zip(headers, col_widths))
@@ -58,79 +50,61 @@ def print_table(headers, rows, col_widths):
 # ==========================================
 # LOGIC
 # ==========================================
-def fetch_queries():
+def fetch_workload_stats():
     end_time = datetime.utcnow()
     start_time = end_time - timedelta(hours=LOOKBACK_HOURS)
-    from_str = start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-    to_str = end_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-    
-    # Fetch queries that waited AT LEAST 100ms or took > 1s
-    # This ensures we catch queuing issues even if execution was fast
-    filter_str = 'admissionWait > 100 OR queryDuration > 1s'
     
-    base_url = f"{CM_HOST}:{CM_PORT}/api/v43/clusters/{CLUSTER_NAME}/services/{SERVICE_NAME}/impalaQueries"
-    
-    all_queries = []
-    offset = 0
     logging.info(f"Fetching traffic data from last {LOOKBACK_HOURS}h...")
-
-    while True:
-        params = urllib.parse.urlencode({
-            'from': from_str, 'to': to_str, 'filter': filter_str,
-            'limit': 1000, 'offset': offset
-        })
-        url = f"{base_url}?{params}"
-        data = make_request(url)
-        queries = data.get('queries', [])
-        
-        if not queries: break
-        all_queries.extend(queries)
-        offset += len(queries)
-        
-        if len(queries) < 1000 or len(all_queries) >= MAX_QUERIES_TO_FETCH: break
-            
-    return all_queries
-
-def analyze_queuing(queries):
-    if not queries:
+    client = CMClient(CM_HOST, CM_PORT, CM_USER, CM_PASS)
+    try:
+        with QueryCache(CACHE_DB) as cache:
+            cache.refresh(
+                client, CLUSTER_NAME, SERVICE_NAME, start_time, end_time,
+                slice_minutes=SLICE_MINUTES, workers=FETCH_WORKERS
+            )
+            # Queries that waited AT LEAST 100ms or took > 1s
+            # This ensures we catch queuing issues even if execution was fast.
+            # The timeline sees the same cached queries (CACHE_FILTER), so fast
+            # queries that never queued are missing from its running counts
+            timeline = ConcurrencyTimeline(TIMELINE_RESOLUTION_SECONDS, SATURATED_FRACTION)
+            stats = analyze_batches(cache.iter_batches(
+                CLUSTER_NAME, SERVICE_NAME, start_time, end_time,
+                min_duration_ms=1000, min_admission_wait_ms=100
+            ), timeline=timeline)
+            return stats, timeline
+    except CMApiError as e:
+        logging.error(f"Request failed: {e}")
+        sys.exit(1)
+    finally:
+        client.close()
+
+def fmt_time(epoch):
+    return f"{from_epoch(epoch):%Y-%m-%d %H:%M}"
+
+def fmt_gb(num_bytes):
+    return f"{num_bytes / 1024**3:.1f}"
+
+def write_timeline_csv(timeline, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['key', 'name', 'bucket_start_utc', 'avg_queued', 'peak_queued',
+                         'avg_running', 'peak_running', 'peak_mem_reserved_bytes', 'query_filter'])
+        for key in timeline.KEYS:
+            for name, start, avg_q, peak_q, avg_r, peak_r, peak_mem in timeline.rows(key):
+                writer.writerow([key, name, fmt_time(start), f"{avg_q:.2f}", peak_q,
+                                 f"{avg_r:.2f}", peak_r, int(peak_mem), CACHE_FILTER])
+    logging.info(f"Wrote concurrency timeline to {path}")
+
+def analyze_queuing(stats, timeline):
+    if not stats.total:
         print("\nNo data found.")
         return
 
-    # Data Structures for Aggregation
-    coord_stats = {} # {hostname: {'total': 0, 'queued': 0, 'wait_time': 0}}
-    pool_stats = {}  # {pool_name: {'total': 0, 'queued': 0}}
-
-    for q in queries:
-        attrs = q.get('attributes', {})
-        
-        # 1. Extract Coordinator Hostname
-        # CM API structure for coordinator can vary, usually nested
-        coord_node = q.get('coordinator', {})
-        coord_host = coord_node.get('hostname') or coord_node.get('hostId') or "Unknown"
-        
-        # 2. Extract Resource Pool
-        pool = attrs.get('request_pool') or attrs.get('pool') or "default"
-        
-        # 3. Extract Wait Time
-        wait_ms = float(attrs.get('admission_wait', 0))
-        is_queued = wait_ms > 1000 # Considered "queued" if waited > 1s
-        
-        # --- Aggregate by Coordinator ---
-        if coord_host not in coord_stats:
-            coord_stats[coord_host] = {'total': 0, 'queued': 0, 'wait_time': 0.0}
-        
-        coord_stats[coord_host]['total'] += 1
-        coord_stats[coord_host]['wait_time'] += wait_ms
-        if is_queued:
-            coord_stats[coord_host]['queued'] += 1
-
-        # --- Aggregate by Pool ---
-        if pool not in pool_stats:
-            pool_stats[pool] = {'total': 0, 'queued': 0}
-        
-        pool_stats[pool]['total'] += 1
-        if is_queued:
-            pool_stats[pool]['queued'] += 1
+    # Aggregated per coordinator hostname and resource pool while streaming;
+    # "queued" means admission wait > 1s
+    coord_stats = stats.group_by('coordinator')
+    pool_stats = stats.group_by('pool')
+    pool_waits = stats.pool_wait_quantiles()
 
     # ================= REPORTING =================
 
@@ -145,31 +119,65 @@ def analyze_queuing(queries):
     coord_widths = [30, 10, 12, 10, 12]
     coord_rows = []
     
-    for host, stats in coord_stats.items():
-        pct_queued = (stats['queued'] / stats['total']) * 100 if stats['total'] > 0 else 0
-        avg_wait = stats['wait_time'] / stats['total'] if stats['total'] > 0 else 0
-        coord_rows.append([host, stats['total'], stats['queued'], f"{pct_queued:.1f}%", f"{avg_wait:.0f}"])
-    
-    # Sort by Total Queries to see where traffic is going
-    coord_rows.sort(key=lambda x: x[1], reverse=True)
+    # Sorted by Total Queries to see where traffic is going
+    for host, c in coord_stats.rows('count'):
+        pct_queued = (c['queued'] / c['count']) * 100 if c['count'] > 0 else 0
+        avg_wait = c['total_wait_ms'] / c['count'] if c['count'] > 0 else 0
+        coord_rows.append([host, c['count'], c['queued'], f"{pct_queued:.1f}%", f"{avg_wait:.0f}"])
     print_table(coord_headers, coord_rows, coord_widths)
 
     # REPORT 2: RESOURCE POOL CONFIGURATION
     # This tells you if a specific pool is under-provisioned
     print("\n>>> 2. RESOURCE POOL PRESSURE (Which pool is hitting limits?)")
-    pool_headers = ["Resource Pool", "Total Qry", "Queued Qry", "% Queued"]
-    pool_widths = [25, 10, 12, 10]
+    pool_headers = ["Resource Pool", "Total Qry", "Queued Qry", "% Queued", "p95 Wait(ms)", "p99 Wait(ms)"]
+    pool_widths = [25, 10, 12, 10, 12, 12]
     pool_rows = []
 
-    for pool, stats in pool_stats.items():
-        pct_queued = (stats['queued'] / stats['total']) * 100 if stats['total'] > 0 else 0
-        pool_rows.append([pool, stats['total'], stats['queued'], f"{pct_queued:.1f}%"])
-    
-    # Sort by Queued Queries descending
-    pool_rows.sort(key=lambda x: x[2], reverse=True)
+    # Sorted by Queued Queries descending
+    for pool, p in pool_stats.rows('queued'):
+        pct_queued = (p['queued'] / p['count']) * 100 if p['count'] > 0 else 0
+        pool_rows.append([pool, p['count'], p['queued'], f"{pct_queued:.1f}%",
+                          f"{pool_waits[pool][0.95]:.0f}", f"{pool_waits[pool][0.99]:.0f}"])
     print_table(pool_headers, pool_rows, pool_widths)
+
+    # REPORT 3: PEAK CONCURRENCY WINDOWS
+    # Reconstructed from start time + admission wait + duration of each query
+    print(f"\n>>> 3. PEAK CONCURRENCY WINDOWS ({TIMELINE_RESOLUTION_SECONDS}s buckets, UTC)")
+    print(f"    Only queries matching '{CACHE_FILTER}' are counted: running and memory")
+    print("    are lower bounds (fast queries that did not queue are missing).")
+    peak_headers = ["Window Start", "Group", "Peak Running", "Avg Running", "Peak Queued", "Peak Mem(GB)"]
+    peak_widths = [17, 30, 12, 11, 11, 12]
+    for key, label in (('pool', 'Pool'), ('coordinator', 'Coordinator')):
+        peak_rows = []
+        for w in timeline.peak_windows(key, n=5):
+            peak_rows.append([fmt_time(w['start']), f"{label}: {w['name']}", w['peak_running'],
+                              f"{w['avg_running']:.1f}", w['peak_queued'], fmt_gb(w['peak_memory'])])
+        print_table(peak_headers, peak_rows, peak_widths)
+
+    # REPORT 4: POOL SATURATION
+    # "Running While Saturated" is how many queries the pool ran while others waited,
+    # i.e. the concurrency limit admission control actually enforced
+    print(f"\n>>> 4. POOL SATURATION (queue non-empty >= {SATURATED_FRACTION:.0%} of a bucket)")
+    print("    Same query set as report 3: 'Running While Saturated' is a lower bound.")
+    sat_headers = ["Resource Pool", "Saturated Min", "Episodes", "Peak Queued", "Running While Saturated", "Longest Episode"]
+    sat_widths = [25, 13, 8, 11, 23, 35]
+    sat_rows = []
+    saturation = timeline.saturation('pool')
+    for pool, sat in sorted(saturation.items(), key=lambda item: -item[1]['seconds']):
+        lo, hi = max(sat['ranges'], key=lambda r: r[1] - r[0])
+        sat_rows.append([pool, f"{sat['seconds'] / 60:.0f}", len(sat['ranges']), sat['peak_queued'],
+                         sat['running_when_saturated'], f"{fmt_time(lo)} -> {fmt_time(hi)[11:]}"])
+    print_table(sat_headers, sat_rows, sat_widths)
+
+    for pool, sat in sorted(saturation.items()):
+        episodes = ", ".join(f"{fmt_time(lo)[5:]}-{fmt_time(hi)[11:]}" for lo, hi in sat['ranges'][:10])
+        more = f" (+{len(sat['ranges']) - 10} more)" if len(sat['ranges']) > 10 else ""
+        print(f"  {pool}: {episodes}{more}")
+
+    if TIMELINE_CSV:
+        write_timeline_csv(timeline, TIMELINE_CSV)
     print("\n")
 
 if __name__ == "__main__":
-    queries = fetch_queries()
-    analyze_queuing(queries)
+    stats, timeline = fetch_workload_stats()
+    analyze_queuing(stats, timeline)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import boto3
 import logging
-from datetime import datetime, timedelta
 from botocore.exceptions import NoCredentialsError, EndpointConnectionError
 
+from wal_retention import purge_expired
+
 # === Configuration ===
 OZONE_ENDPOINT = "http://your-ozone-endpoint:9878"
 OZONE_ACCESS_KEY = "your_ozone_access_key"
@@ -40,42 +41,11 @@ def initialize_s3_client():
     )
 
 def delete_old_wal_folders(cluster_name, psqld_node):
+    # Lists only the YYYY-MM-DD/ partitions instead of enumerating every WAL
+    # object; a partition already purged costs one MaxKeys=1 listing
+    # (see wal_retention.py)
     s3_client = initialize_s3_client()
-    cutoff_date = datetime.now() - timedelta(days=RETENTION_DAYS)
-
-    prefix = f"{cluster_name}/{OZONE_BASE_FOLDER}/{psqld_node}/"
-    paginator = s3_client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(Bucket=OZONE_BUCKET, Prefix=prefix)
-
-    folders = {}
-
-    # Collect all date-based folders
-    for page in page_iterator:
-        for obj in page.get("Contents", []):
-            key = obj["Key"]
-            parts = key.split("/")
-            # Expect cluster/wal_backups/psqld3/YYYY-MM-DD/file
-            if len(parts) >= 4:
-                date_str = parts[3]
-                try:
-                    folder_date = datetime.strptime(date_str, "%Y-%m-%d")
-                    folders[date_str] = folder_date
-                except ValueError:
-                    continue
-
-    # Delete older than cutoff
-    for folder, folder_date in folders.items():
-        if folder_date < cutoff_date:
-            logger.info(f"Deleting WAL folder {folder} under {cluster_name}/{psqld_node} (older than {RETENTION_DAYS} days)")
-            folder_prefix = f"{cluster_name}/{OZONE_BASE_FOLDER}/{psqld_node}/{folder}/"
-
-            del_page_iterator = paginator.paginate(Bucket=OZONE_BUCKET, Prefix=folder_prefix)
-            for del_page in del_page_iterator:
-                objects_to_delete = [{"Key": obj["Key"]} for obj in del_page.get("Contents", [])]
-                for i in range(0, len(objects_to_delete), 1000):
-                    batch = objects_to_delete[i:i + 1000]
-                    s3_client.delete_objects(Bucket=OZONE_BUCKET, Delete={"Objects": batch})
-                    logger.info(f"Deleted {len(batch)} objects from {folder}")
+    purge_expired(s3_client, OZONE_BUCKET, f"{cluster_name}/{OZONE_BASE_FOLDER}/{psqld_node}/", RETENTION_DAYS)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+archive_command shim: hands a WAL segment to wal_archiver_daemon.py and
+exits 0 only once the daemon reports it durably stored.
+
+    archive_command = 'python3 /opt/scripts/wal_archive_shim.py %p %f'
+
+Standard library only, so each call costs one interpreter start and one
+socket round trip. If the daemon is not running the segment is archived
+in-process by new_wal.py instead (the old one-shot path).
+"""
+import os
+import socket
+import sys
+
+SOCKET_PATH = '/var/run/postgresql/wal_archiver.sock'  # Must match wal_archiver_daemon.py
+TIMEOUT = 600  # Seconds to wait for the daemon's answer
+ONE_SHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'new_wal.py')
+
+def main():
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage: wal_archive_shim.py <path> <filename>\n")
+        sys.exit(1)
+    # %p is relative to the data directory, which is the archiver's cwd
+    wal_path = os.path.abspath(sys.argv[1])
+    wal_file = sys.argv[2]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except OSError:
+        sock.close()
+        os.execv(sys.executable, [sys.executable, ONE_SHOT, wal_path, wal_file])
+
+    with sock:
+        sock.settimeout(TIMEOUT)
+        try:
+            sock.sendall(f"ARCHIVE\t{wal_path}\t{wal_file}\n".encode('utf-8'))
+            reply = sock.makefile('rb').readline().decode('utf-8', 'replace').strip()
+        except OSError as e:
+            reply = f"ERR {e}"
+    if reply != 'OK':
+        # Non-zero makes PostgreSQL keep the segment and retry later
+        sys.stderr.write(f"wal_archive_shim: {wal_file}: {reply or 'no reply from daemon'}\n")
+        sys.exit(1)
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Persistent WAL archiver: keeps one warm, pooled S3 client and archives the
+segments handed over by wal_archive_shim.py through a Unix socket.
+
+    postgresql.conf:  archive_command = 'python3 /opt/scripts/wal_archive_shim.py %p %f'
+    systemd / cron:   python3 /opt/scripts/wal_archiver_daemon.py
+
+PostgreSQL archives one segment at a time, so the daemon does not wait for
+it: whenever a segment is requested it also queues the next segments that
+are already marked ready (pg_wal/archive_status/*.ready) on a pool of
+UPLOAD_WORKERS threads. When PostgreSQL asks for them they are usually
+stored already. A segment is acknowledged only once it is in Ozone, or
+fsync'ed to the local fallback directory when Ozone is unavailable. The
+fallback spool is drained (wal_spool_drain.py) in the background, right
+after the first successful upload following a spooled one and otherwise on
+a timer; retention (wal_retention.py) runs on its own timer.
+"""
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from new_wal import (ensure_local_fallback_dir, initialize_s3_client, logger,
+                     archive_segment, OZONE_BUCKET, OZONE_BASE_FOLDER, RETENTION_DAYS)
+from ozone_upload import abort_stale_uploads
+from wal_retention import purge_expired
+from wal_spool_drain import DRAIN_WORKERS, SpoolDrain
+
+# Configuration
+SOCKET_PATH = '/var/run/postgresql/wal_archiver.sock'  # Must match wal_archive_shim.py
+UPLOAD_WORKERS = 4          # Segments uploaded concurrently
+READ_AHEAD_SEGMENTS = 16    # Ready segments queued ahead of PostgreSQL's request
+MAINTENANCE_INTERVAL = 300  # Seconds between fallback spool drains / stale upload cleanups
+RETENTION_INTERVAL = 3600   # Seconds between retention runs (wal_retention.py)
+
+class WalArchiver:
+    def __init__(self, workers=UPLOAD_WORKERS, read_ahead=READ_AHEAD_SEGMENTS):
+        self.s3_client = initialize_s3_client(max_pool_connections=workers + DRAIN_WORKERS + 2)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wal-upload')
+        self.read_ahead = read_ahead
+        self.lock = threading.Lock()
+        self.inflight = {}      # file name -> Future of store()
+        self.spool = SpoolDrain(self.s3_client)
+        self.spool_dirty = True  # The spool may hold segments of a previous run
+        self.drain_wakeup = threading.Event()
+
+    def store(self, file_path, file_name):
+        """Durably store one (compressed) segment: Ozone, else the local fallback directory."""
+        stored = archive_segment(file_path, file_name, self.s3_client)
+        if stored == 'fallback':
+            self.spool_dirty = True
+        elif stored == 'ozone' and self.spool_dirty:
+            self.drain_wakeup.set()  # Ozone is back: drain the spool now, not at the next tick
+        return stored is not None
+
+    def submit(self, file_path, file_name):
+        # Called with self.lock held; a failed attempt is not reused
+        future = self.inflight.get(file_name)
+        if future is None or (future.done() and (future.exception() or not future.result())):
+            future = self.pool.submit(self.store, file_path, file_name)
+            self.inflight[file_name] = future
+        return future
+
+    def read_ahead_ready(self, file_path):
+        """Queue uploads of the next ready segments in the same pg_wal."""
+        status_dir = os.path.join(os.path.dirname(file_path), 'archive_status')
+        try:
+            ready = sorted(name[:-len('.ready')] for name in os.listdir(status_dir)
+                           if name.endswith('.ready'))
+        except OSError:
+            return
+        ready_set = set(ready)
+        with self.lock:
+            # Forget finished read-aheads PostgreSQL will not ask for any more
+            for name in [n for n, f in self.inflight.items() if f.done() and n not in ready_set]:
+                del self.inflight[name]
+            for name in ready[:self.read_ahead]:
+                self.submit(os.path.join(os.path.dirname(file_path), name), name)
+
+    def archive(self, file_path, file_name):
+        """Store a segment PostgreSQL asked for; True once it is durable."""
+        if not os.path.exists(file_path):
+            logger.error(f"WAL file not found: {file_path}")
+            return False
+        with self.lock:
+            future = self.submit(file_path, file_name)
+        self.read_ahead_ready(file_path)
+        ok = future.result()
+        with self.lock:
+            if self.inflight.get(file_name) is future:
+                del self.inflight[file_name]
+        return ok
+
+    def drain_loop(self, stop, interval=MAINTENANCE_INTERVAL):
+        while True:
+            self.drain_wakeup.wait(interval)
+            self.drain_wakeup.clear()
+            if stop.is_set():
+                return
+            try:
+                stats = self.spool.drain(stop)
+                if stats and stats['depth_files'] == 0:
+                    self.spool_dirty = False
+            except Exception as e:
+                logger.error(f"Spool drain failed: {e}")
+
+    def maintenance_loop(self, stop, interval=MAINTENANCE_INTERVAL, retention_interval=RETENTION_INTERVAL):
+        last_retention = 0
+        while not stop.wait(interval):
+            try:
+                abort_stale_uploads(self.s3_client)
+            except Exception as e:
+                logger.error(f"Maintenance run failed: {e}")
+            if time.time() - last_retention < retention_interval:
+                continue
+            last_retention = time.time()
+            try:
+                purge_expired(self.s3_client, OZONE_BUCKET, OZONE_BASE_FOLDER, RETENTION_DAYS)
+            except Exception as e:
+                logger.error(f"Retention run failed: {e}")
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+class ShimHandler(socketserver.StreamRequestHandler):
+    # Request:  "ARCHIVE\t<absolute path>\t<file name>\n"  or  "PING\n"
+    # Reply:    "OK\n" once durable, else "ERR <reason>\n"
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8', 'replace').rstrip('\n')
+        parts = line.split('\t')
+        if parts == ['PING']:
+            self.wfile.write(b"OK\n")
+            return
+        if len(parts) != 3 or parts[0] != 'ARCHIVE' or not os.path.isabs(parts[1]):
+            self.wfile.write(b"ERR bad request\n")
+            return
+        started = time.time()
+        try:
+            ok = self.server.archiver.archive(parts[1], parts[2])
+        except Exception as e:
+            logger.error(f"Archiving {parts[2]} failed: {e}")
+            ok = False
+        logger.debug(f"{parts[2]} handled in {time.time() - started:.2f}s")
+        self.wfile.write(b"OK\n" if ok else b"ERR not stored\n")
+
+class ArchiverServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def main():
+    ensure_local_fallback_dir()
+    if os.path.exists(SOCKET_PATH):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(SOCKET_PATH)
+            logger.error(f"Another archiver is already listening on {SOCKET_PATH}")
+            sys.exit(1)
+        except OSError:
+            os.remove(SOCKET_PATH)  # Stale socket of a previous run
+        finally:
+            probe.close()
+    archiver = WalArchiver()
+    old_umask = os.umask(0o177)  # Socket only usable by the postgres user
+    try:
+        server = ArchiverServer(SOCKET_PATH, ShimHandler)
+    finally:
+        os.umask(old_umask)
+    server.archiver = archiver
+
+    stop = threading.Event()
+    threading.Thread(target=archiver.maintenance_loop, args=(stop, MAINTENANCE_INTERVAL, RETENTION_INTERVAL), daemon=True).start()
+    threading.Thread(target=archiver.drain_loop, args=(stop, MAINTENANCE_INTERVAL), daemon=True).start()
+
+    def shutdown(signum, frame):
+        logger.info(f"Signal {signum} received, finishing in-flight uploads...")
+        stop.set()
+        archiver.drain_wakeup.set()
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info(f"WAL archiver listening on {SOCKET_PATH} ({UPLOAD_WORKERS} upload workers)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(SOCKET_PATH)
+        archiver.close()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
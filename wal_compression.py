@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Streaming compression of WAL segments for the archiver (new_wal.py) and
+transparent decompression for the download / restore tools.
+
+Codecs: zstd (python-zstandard), lz4 (python-lz4) and gzip (stdlib zlib),
+plus none. zstd and lz4 are optional imports; "auto" picks zstd if it is
+installed, else gzip. Data is processed in BLOCK_SIZE blocks, so a segment
+is never held in memory whole. The compressed object gets the codec's
+extension (000000010000000A0000002F.zst) and S3 user metadata:
+
+    wal-codec          zstd | lz4 | gzip
+    wal-original-size  bytes before compression
+    wal-original-md5   hex MD5 before compression (checked on restore)
+
+    python3 wal_compression.py decompress 000000010000000A0000002F.zst [dest]
+"""
+import hashlib
+import os
+import sys
+import zlib
+
+# Configuration
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_LEVELS = {'zstd': 3, 'lz4': 0, 'gzip': 6}
+EXTENSIONS = {'zstd': '.zst', 'lz4': '.lz4', 'gzip': '.gz', 'none': ''}
+CODECS = ('auto', 'zstd', 'lz4', 'gzip', 'none')
+
+META_CODEC = 'wal-codec'
+META_SIZE = 'wal-original-size'
+META_MD5 = 'wal-original-md5'
+
+def resolve_codec(codec):
+    if codec != 'auto':
+        return codec
+    try:
+        import zstandard  # noqa: F401
+        return 'zstd'
+    except ImportError:
+        return 'gzip'
+
+def codec_from_name(file_name):
+    """Codec implied by a file name's extension ('none' if not compressed)."""
+    for codec, ext in EXTENSIONS.items():
+        if ext and file_name.endswith(ext):
+            return codec
+    return 'none'
+
+def strip_extension(file_name):
+    ext = EXTENSIONS[codec_from_name(file_name)]
+    return file_name[:-len(ext)] if ext else file_name
+
+class _ZlibWriter:
+    # gzip container (wbits=31) so the objects also open with gunzip / zcat
+    def __init__(self, dst, level):
+        self.dst = dst
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        self.dst.write(self.compressor.compress(data))
+
+    def close(self):
+        self.dst.write(self.compressor.flush())
+
+def _writer(codec, dst, level):
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).stream_writer(dst, closefd=False)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameCompressor(compression_level=level)
+    if codec == 'gzip':
+        return _ZlibWriter(dst, level)
+    raise ValueError(f"Unknown codec {codec!r} (expected one of {', '.join(CODECS)})")
+
+def compress_stream(src, dst, codec, level=None):
+    """Compress file object src into dst; returns (original size, original MD5 hex)."""
+    level = DEFAULT_LEVELS.get(codec, 0) if level is None else level
+    writer = _writer(codec, dst, level)
+    digest = hashlib.md5()
+    size = 0
+    if codec == 'lz4':
+        dst.write(writer.begin())
+    for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+        digest.update(block)
+        size += len(block)
+        if codec == 'lz4':
+            dst.write(writer.compress(block))
+        else:
+            writer.write(block)
+    if codec == 'lz4':
+        dst.write(writer.flush())
+    else:
+        writer.close()
+    return size, digest.hexdigest()
+
+def decompress_stream(src, dst, codec):
+    """Decompress file object src into dst; returns (size, MD5 hex) of the output."""
+    if codec == 'zstd':
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(src, closefd=False)
+        read = reader.read
+    elif codec == 'lz4':
+        import lz4.frame
+        reader = lz4.frame.LZ4FrameFile(src, 'rb')
+        read = reader.read
+    elif codec == 'gzip':
+        decompressor = zlib.decompressobj(47)  # gzip or zlib header
+
+        def read(n):
+            while True:
+                block = src.read(n)
+                if not block:
+                    return decompressor.flush()
+                out = decompressor.decompress(block)
+                if out:
+                    return out
+    elif codec == 'none':
+        read = src.read
+    else:
+        raise ValueError(f"Unknown codec {codec!r}")
+    digest = hashlib.md5()
+    size = 0
+    for block in iter(lambda: read(BLOCK_SIZE), b''):
+        digest.update(block)
+        size += len(block)
+        dst.write(block)
+    return size, digest.hexdigest()
+
+def compress_file(src_path, dst_path, codec, level=None):
+    """Compress src_path into dst_path (fsync'ed); returns the S3 user metadata."""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size, md5 = compress_stream(src, dst, codec, level)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return {META_CODEC: codec, META_SIZE: str(size), META_MD5: md5}
+
+def decompress_file(src_path, dst_path=None, metadata=None):
+    """
+    Restore src_path (codec from metadata, else from its extension) to
+    dst_path, by default the name without the extension. The size and MD5
+    are checked against the metadata when it is known. Returns dst_path.
+    """
+    metadata = metadata or {}
+    codec = metadata.get(META_CODEC) or codec_from_name(src_path)
+    dst_path = dst_path or strip_extension(src_path)
+    tmp_path = dst_path + '.partial'
+    with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        size, md5 = decompress_stream(src, dst, codec)
+    if (metadata.get(META_SIZE) and int(metadata[META_SIZE]) != size) or \
+            (metadata.get(META_MD5) and metadata[META_MD5] != md5):
+        os.remove(tmp_path)
+        raise ValueError(f"{src_path}: restored {size} bytes / MD5 {md5}, expected "
+                         f"{metadata.get(META_SIZE)} bytes / MD5 {metadata.get(META_MD5)}")
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+def main():
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != 'decompress':
+        sys.stderr.write("Usage: wal_compression.py decompress <file.zst|.lz4|.gz> [dest]\n")
+        sys.exit(1)
+    print(decompress_file(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None))
+
+if __name__ == "__main__":
+    main()
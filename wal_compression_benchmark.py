@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Compression ratio vs. throughput benchmark for wal_compression.py.
+
+Builds 16MB segments shaped like PostgreSQL WAL (8KB pages with page
+headers, XLogRecord headers with CRCs and LSNs, heap-insert tuples, commit
+records, full-page images after a checkpoint) in three profiles:
+
+  busy    the segment is full of OLTP records
+  fpi     busy, plus full-page images (the first writes after a checkpoint)
+  idle    archive_timeout forced a switch after a few hundred KB of records;
+          PostgreSQL zero-fills the rest of the segment
+
+and reports, per codec and level, the compression ratio and the
+compression / decompression throughput of the streaming code path used by
+the archiver (in memory, so disk speed does not count). Real segments can
+be measured instead with --wal-dir.
+
+Example:
+    python3 wal_compression_benchmark.py
+    python3 wal_compression_benchmark.py --wal-dir /data/pg_wal --segments 8 --codecs zstd,lz4
+"""
+import argparse
+import io
+import os
+import random
+import re
+import struct
+import time
+
+from wal_compression import compress_stream, decompress_stream
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+PAGE_SIZE = 8192
+PAGE_HEADER = 24
+XLOG_PAGE_MAGIC = 0xD113  # PostgreSQL 15
+WAL_NAME_RE = re.compile(r'^[0-9A-F]{24}$')
+
+LEVELS = {'zstd': [1, 3, 9, 19], 'lz4': [0, 9], 'gzip': [1, 6, 9]}
+PROFILES = ('busy', 'fpi', 'idle')
+
+WORDS = ["pending", "shipped", "delivered", "cancelled", "returned", "north", "south", "east", "west",
+         "retail", "wholesale", "online", "store", "priority", "standard", "express"]
+
+# ----------------------------
+# Synthetic WAL generation
+# ----------------------------
+
+def heap_tuple(rnd, row_id, ts):
+    # Tuple header (23 bytes, mostly constant) + int4 id, int8 timestamp, int4, text
+    text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).encode()
+    header = struct.pack('<IIIHHHB', rnd.randint(1000, 900000), 0, 0, 0, 4, 0x0802, 24)
+    body = struct.pack('<iqi', row_id, ts, rnd.randint(0, 500)) + bytes([len(text) * 2 + 1]) + text
+    return header + body
+
+def xlog_record(rnd, lsn, xid, rmid, payload):
+    total = 24 + len(payload)
+    header = struct.pack('<IIQBBxxI', total, xid, lsn - rnd.randint(60, 200), 0x00, rmid,
+                         rnd.getrandbits(32))  # CRC: incompressible
+    record = header + payload
+    return record + b'\0' * (-len(record) % 8)  # MAXALIGN
+
+def record_stream(rnd, profile):
+    """Yield WAL records (bytes) like a steady OLTP insert workload."""
+    lsn, xid, row_id, ts = 0x2F000000, 748000, 1, 783000000000000
+    block = 120000
+    while True:
+        xid += 1
+        for _ in range(rnd.randint(1, 6)):
+            row_id += 1
+            ts += rnd.randint(100, 50000)
+            if row_id % 60 == 0:
+                block += 1
+            # Block reference: tablespace / db / relfilenode / fork / block number
+            ref = struct.pack('<BBHIIII', 0, 0x20, 40, 1663, 16384, 24611, block)
+            if profile == 'fpi' and rnd.random() < 0.08:
+                # Full-page image with its hole (free space) removed
+                image = b''.join(heap_tuple(rnd, row_id - i, ts) for i in range(rnd.randint(20, 60)))
+                payload = ref + struct.pack('<HH', len(image), 0) + image
+            else:
+                payload = ref + heap_tuple(rnd, row_id, ts)
+            record = xlog_record(rnd, lsn, xid, 10, payload)  # RM_HEAP_ID
+            lsn += len(record)
+            yield record
+        record = xlog_record(rnd, lsn, xid, 1, struct.pack('<q', ts))  # RM_XACT_ID commit
+        lsn += len(record)
+        yield record
+
+def generate_segment(profile, seed):
+    """One SEGMENT_SIZE segment of the given profile."""
+    rnd = random.Random(seed)
+    used = SEGMENT_SIZE if profile != 'idle' else rnd.randint(64, 512) * 1024
+    records = record_stream(rnd, profile)
+    data = bytearray()
+    pending = b''
+    for page_no in range(SEGMENT_SIZE // PAGE_SIZE):
+        page = bytearray(PAGE_SIZE)
+        if page_no * PAGE_SIZE < used:
+            struct.pack_into('<HHIQI', page, 0, XLOG_PAGE_MAGIC, 0x0001 if pending else 0, 1,
+                             0x2F000000 + page_no * PAGE_SIZE, len(pending))
+            pos = PAGE_HEADER
+            while pos < PAGE_SIZE:
+                if not pending:
+                    pending = next(records)
+                take = min(len(pending), PAGE_SIZE - pos)
+                page[pos:pos + take] = pending[:take]
+                pending = pending[take:]
+                pos += take
+        data += page
+    return bytes(data)
+
+def load_segments(args):
+    if args.wal_dir:
+        names = sorted(n for n in os.listdir(args.wal_dir) if WAL_NAME_RE.match(n))[:args.segments]
+        if not names:
+            raise SystemExit(f"No WAL segments in {args.wal_dir}")
+        segments = []
+        for name in names:
+            with open(os.path.join(args.wal_dir, name), 'rb') as f:
+                segments.append(f.read())
+        return {'real': segments}
+    print(f"Generating {args.segments} synthetic segment(s) per profile ...")
+    return {profile: [generate_segment(profile, seed) for seed in range(args.segments)]
+            for profile in PROFILES}
+
+# ----------------------------
+# Measurement
+# ----------------------------
+
+def available_codecs(requested):
+    codecs = []
+    for codec in requested:
+        try:
+            compress_stream(io.BytesIO(b'x'), io.BytesIO(), codec)
+        except ImportError:
+            print(f"Skipping {codec}: module not installed")
+            continue
+        codecs.append(codec)
+    return codecs
+
+def measure(segments, codec, level):
+    raw = compressed = 0
+    compress_time = decompress_time = 0.0
+    for segment in segments:
+        out = io.BytesIO()
+        t0 = time.perf_counter()
+        _, md5 = compress_stream(io.BytesIO(segment), out, codec, level)
+        compress_time += time.perf_counter() - t0
+        blob = out.getvalue()
+
+        t0 = time.perf_counter()
+        size, restored_md5 = decompress_stream(io.BytesIO(blob), io.BytesIO(), codec)
+        decompress_time += time.perf_counter() - t0
+        if (size, restored_md5) != (len(segment), md5):
+            raise SystemExit(f"{codec} level {level}: round trip mismatch")
+        raw += len(segment)
+        compressed += len(blob)
+    mb = raw / 1024 / 1024
+    return raw / compressed, mb / compress_time, mb / decompress_time, compressed / len(segments)
+
+# ----------------------------
+# CLI
+# ----------------------------
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark WAL compression codecs (ratio vs. throughput)")
+    p.add_argument("--segments", type=int, default=3, help="Segments per profile (or read from --wal-dir)")
+    p.add_argument("--wal-dir", help="Measure real segments from this directory (e.g. a copy of pg_wal)")
+    p.add_argument("--codecs", default="zstd,lz4,gzip", help="Comma-separated codecs to compare")
+    p.add_argument("--quick", action="store_true", help="Only each codec's default level")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    codecs = available_codecs(args.codecs.split(','))
+    segment_sets = load_segments(args)
+
+    print(f"{'profile':<8} {'codec':<6} {'level':>5} {'ratio':>8} {'avg size':>10} "
+          f"{'compress':>12} {'decompress':>12}")
+    for profile, segments in segment_sets.items():
+        for codec in codecs:
+            for level in ([None] if args.quick else LEVELS[codec]):
+                ratio, c_rate, d_rate, avg = measure(segments, codec, level)
+                print(f"{profile:<8} {codec:<6} {level if level is not None else 'def':>5} {ratio:>7.1f}x "
+                      f"{avg / 1024:>8.0f}Ki {c_rate:>8.0f}MB/s {d_rate:>8.0f}MB/s")
+        print()
+
+if __name__ == "__main__":
+    main()
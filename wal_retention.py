@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Incremental retention for the WAL archive in Ozone, run off the archive
+path (cron, or the archiver daemon's maintenance thread):
+
+    python3 wal_retention.py                                # new_wal.py layout: wal_backups/<date>/
+    python3 wal_retention.py --prefix clusterA/wal_backups/psqld3/ --days 15
+
+Only the date partitions are listed (Delimiter='/', CommonPrefixes), never
+every object of the archive. A partition past the retention is emptied
+with delete_objects batches of DELETE_BATCH keys, DELETE_CONCURRENCY in
+flight, and then recorded in STATE_FILE. A recorded partition Ozone still
+lists (e.g. an empty FSO directory) costs one MaxKeys=1 listing per run;
+if anything was written into it since (a late fallback upload), it is
+purged again. The daemon's maintenance thread and cron runs can share
+STATE_FILE: a run holding its flock (STATE_FILE.lock) makes the others skip.
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Configuration
+STATE_FILE = '/var/lib/postgresql/wal_retention_state.json'  # Partitions already purged
+DELETE_BATCH = 1000        # Keys per delete_objects call (S3 maximum)
+DELETE_CONCURRENCY = 4     # delete_objects calls in flight per partition
+
+logger = logging.getLogger()
+
+def load_state(path=STATE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(state, path=STATE_FILE):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def list_date_partitions(s3_client, bucket, prefix):
+    """{date string: partition prefix} of the <prefix><YYYY-MM-DD>/ partitions."""
+    partitions = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            folder = common['Prefix'][len(prefix):].rstrip('/')
+            try:
+                datetime.strptime(folder, '%Y-%m-%d')
+            except ValueError:
+                continue  # Not a date partition
+            partitions[folder] = common['Prefix']
+    return partitions
+
+def purge_partition(s3_client, bucket, partition_prefix, concurrency=DELETE_CONCURRENCY):
+    """Delete every object under partition_prefix; returns (deleted, failed) key counts."""
+    counts = {'deleted': 0, 'failed': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def delete(keys):
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+            errors = response.get('Errors', [])
+            for error in errors[:3]:
+                logger.warning(f"Could not delete {error.get('Key')}: {error.get('Code')} {error.get('Message')}")
+        except Exception as e:
+            logger.warning(f"delete_objects of {len(keys)} keys under {partition_prefix} failed: {e}")
+            errors = keys
+        finally:
+            slots.release()
+        with lock:
+            counts['deleted'] += len(keys) - len(errors)
+            counts['failed'] += len(errors)
+
+    # Listing continues from the last key returned, so deleting behind it is safe;
+    # the semaphore keeps at most `concurrency` batches listed but not yet deleted
+    paginator = s3_client.get_paginator('list_objects_v2')
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for page in paginator.paginate(Bucket=bucket, Prefix=partition_prefix):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            for i in range(0, len(keys), DELETE_BATCH):
+                slots.acquire()
+                pool.submit(delete, keys[i:i + DELETE_BATCH])
+    return counts['deleted'], counts['failed']
+
+def partition_empty(s3_client, bucket, partition_prefix):
+    response = s3_client.list_objects_v2(Bucket=bucket, Prefix=partition_prefix, MaxKeys=1)
+    return not response.get('Contents')
+
+def retention_cutoff(retention_days):
+    """Date partitions up to and including this YYYY-MM-DD are past the retention."""
+    return (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+
+def purge_expired(s3_client, bucket, prefix, retention_days,
+                  state_file=STATE_FILE, concurrency=DELETE_CONCURRENCY):
+    """
+    Purge the date partitions under prefix older than retention_days; returns
+    the dates purged, or None if another run holds the state file's lock.
+    """
+    with open(state_file + '.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Another retention run holds {state_file}.lock, skipping")
+            return None
+        return _purge_expired(s3_client, bucket, prefix, retention_days, state_file, concurrency)
+
+def _purge_expired(s3_client, bucket, prefix, retention_days, state_file, concurrency):
+    prefix = prefix.rstrip('/') + '/'
+    state = load_state(state_file)
+    scope = f"{bucket}/{prefix}"
+    done = set(state.get(scope, []))
+
+    cutoff = retention_cutoff(retention_days)
+    partitions = list_date_partitions(s3_client, bucket, prefix)
+    purged = []
+    for folder in sorted(partitions):
+        if folder > cutoff:
+            continue
+        if folder in done:
+            if partition_empty(s3_client, bucket, partitions[folder]):
+                continue
+            logger.info(f"Partition {partitions[folder]} was purged before but has new objects, purging again")
+            done.discard(folder)
+        deleted, failed = purge_partition(s3_client, bucket, partitions[folder], concurrency)
+        if failed:
+            logger.error(f"Partition {partitions[folder]}: deleted {deleted} objects, {failed} failed "
+                         f"(retried next run)")
+            continue
+        logger.info(f"Purged partition {partitions[folder]} ({deleted} objects, older than {retention_days} days)")
+        done.add(folder)
+        purged.append(folder)
+
+    # Forget partitions Ozone no longer lists, so the state stays small
+    state[scope] = sorted(done & set(partitions))
+    save_state(state, state_file)
+    return purged
+
+def main():
+    from new_wal import OZONE_BASE_FOLDER, OZONE_BUCKET, RETENTION_DAYS, initialize_s3_client
+
+    parser = argparse.ArgumentParser(description="Delete WAL date partitions past the retention from Ozone")
+    parser.add_argument("--bucket", default=OZONE_BUCKET)
+    parser.add_argument("--prefix", default=OZONE_BASE_FOLDER + '/',
+                        help="Parent of the YYYY-MM-DD/ partitions, e.g. <cluster>/wal_backups/<instance>/")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--concurrency", type=int, default=DELETE_CONCURRENCY)
+    parser.add_argument("--state-file", default=STATE_FILE)
+    args = parser.parse_args()
+
+    s3_client = initialize_s3_client(max_pool_connections=args.concurrency + 2)
+    purged = purge_expired(s3_client, args.bucket, args.prefix, args.days,
+                           state_file=args.state_file, concurrency=args.concurrency)
+    if purged is None:
+        return
+    logger.info(f"Retention run done: {len(purged)} partition(s) purged under {args.bucket}/{args.prefix}")
+
+if __name__ == "__main__":
+    main()
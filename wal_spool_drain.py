@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Drains the WAL archiver's local fallback spool (LOCAL_FALLBACK_DIR) back
+into Ozone after an outage.
+
+    python3 wal_spool_drain.py            # one pass (cron / systemd timer)
+    python3 wal_spool_drain.py --loop 60  # keep draining every 60s
+
+Spooled segments are uploaded in WAL order (timeline, log, segment) by
+DRAIN_WORKERS threads. A failed file is retried with exponential backoff
+and jitter. When it keeps failing it is deferred, and its backoff carries
+over to later runs; a run that gets other files through retries the
+deferred ones at its end. After CIRCUIT_BREAK_FAILURES files fail in a
+row, the run stops, since Ozone is most likely down.
+
+Progress is appended to a journal in the spool directory (.drain_journal,
+JSON lines): the object key given to each file, uploads that finished and
+failed attempts. After a crash or restart, a segment whose upload was
+confirmed is only removed, not sent again. A partly uploaded one goes to
+the same key, so its multipart upload resumes. Only one drain runs per
+spool at a time (flock).
+
+Each run logs and writes, for the node_exporter textfile collector:
+
+    wal_spool_depth_files / _bytes          segments still spooled
+    wal_spool_oldest_segment_age_seconds
+    wal_spool_drain_files / _bytes          drained by the last run
+    wal_spool_drain_rate_bytes_per_second
+    wal_spool_drain_failed_files            deferred by the last run
+    wal_spool_drain_last_run_timestamp_seconds
+"""
+import argparse
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from new_wal import (LOCAL_FALLBACK_DIR, OZONE_BASE_FOLDER, OZONE_BUCKET, RETENTION_DAYS,
+                     initialize_s3_client, load_fallback_metadata, logger, metadata_path)
+from ozone_upload import UploadIntegrityError, upload_file_verified
+from wal_compression import strip_extension
+from wal_retention import retention_cutoff
+
+# Configuration
+DRAIN_WORKERS = 4             # Spooled files uploaded concurrently
+DRAIN_RETRIES = 4             # Attempts per file within one run
+DRAIN_BACKOFF = 1             # Seconds before the first retry, doubled per attempt
+DRAIN_DEFER_MAX = 900         # Upper bound (seconds) a failing file is deferred across runs
+CIRCUIT_BREAK_FAILURES = DRAIN_WORKERS  # Consecutive failed files that end the run
+JOURNAL_NAME = '.drain_journal'
+LOCK_NAME = '.drain.lock'
+METRICS_FILE = '/var/lib/node_exporter/textfile_collector/wal_spool.prom'  # None to disable
+
+class SpoolDrain:
+    def __init__(self, s3_client, spool_dir=LOCAL_FALLBACK_DIR, workers=DRAIN_WORKERS,
+                 retries=DRAIN_RETRIES, metrics_file=METRICS_FILE):
+        self.s3_client = s3_client
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.retries = retries
+        self.metrics_file = metrics_file
+        self.journal_path = os.path.join(spool_dir, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def spooled(self):
+        """Spooled file names in WAL order (skips partial copies, sidecars, the journal)."""
+        names = [n for n in os.listdir(self.spool_dir) if not n.startswith('.') and not n.endswith('.meta')]
+        return sorted(names, key=lambda n: (strip_extension(n), n))
+
+    def depth(self):
+        files = size = 0
+        oldest = None
+        for name in self.spooled():
+            try:
+                stat = os.stat(os.path.join(self.spool_dir, name))
+            except FileNotFoundError:
+                continue  # Drained meanwhile
+            files += 1
+            size += stat.st_size
+            oldest = stat.st_mtime if oldest is None else min(oldest, stat.st_mtime)
+        return files, size, (time.time() - oldest) if oldest is not None else 0
+
+    def load_journal(self, names):
+        """Replay the journal, keeping entries of files still spooled, and rewrite it compacted."""
+        entries = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line of a crashed run
+                    if event.get('done'):
+                        entries.pop(event['name'], None)  # Removed; a re-spooled file starts afresh
+                    else:
+                        entries.setdefault(event['name'], {}).update(event)
+        present = set(names)
+        self.entries = {name: e for name, e in entries.items() if name in present}
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.journal_path)
+
+    def record(self, name, **event):
+        # Not fsync'ed: a lost line only costs a (verified, idempotent) re-upload
+        with self.lock:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(dict(event, name=name)) + '\n')
+            if event.get('done'):
+                self.entries.pop(name, None)
+                return {}
+            entry = self.entries.setdefault(name, {'name': name})
+            entry.update(event)
+            return dict(entry)
+
+    def object_key(self, name, file_path):
+        entry = self.entries.get(name, {})
+        if 'key' in entry:
+            return entry['key']  # Same key as before, so a multipart upload resumes
+        date_folder = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d')
+        if date_folder <= retention_cutoff(RETENTION_DAYS):
+            # wal_retention.py re-checks partitions it already purged, so this one goes on its next run
+            logger.warning(f"Spooled {name} is dated {date_folder}, past the {RETENTION_DAYS}-day retention; "
+                           f"the next retention run will delete it from Ozone")
+        return self.record(name, key=f"{OZONE_BASE_FOLDER}/{date_folder}/{name}")['key']
+
+    def remove(self, name, file_path):
+        for path in (file_path, metadata_path(file_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.record(name, done=True)
+
+    def upload(self, name, stop=None):
+        """Upload one spooled file with retries; returns its size, or None if it was deferred."""
+        file_path = os.path.join(self.spool_dir, name)
+        size = os.path.getsize(file_path)
+        if self.entries.get(name, {}).get('uploaded'):
+            self.remove(name, file_path)  # Uploaded before a restart, only the cleanup was lost
+            return size
+        key = self.object_key(name, file_path)
+        for attempt in range(self.retries):
+            try:
+                upload_file_verified(self.s3_client, file_path, OZONE_BUCKET, key,
+                                     load_fallback_metadata(file_path))
+                self.record(name, uploaded=True)
+                self.remove(name, file_path)
+                return size
+            except (BotoCoreError, ClientError, UploadIntegrityError, OSError) as e:
+                error = e
+            if stop and stop.is_set():
+                break
+            if attempt < self.retries - 1:
+                time.sleep(DRAIN_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1))
+        failures = self.entries.get(name, {}).get('failures', 0) + 1
+        defer = min(DRAIN_BACKOFF * (2 ** (self.retries + failures)), DRAIN_DEFER_MAX)
+        self.record(name, failures=failures, next_try=time.time() + defer)
+        logger.warning(f"Spooled {name} failed ({error}); deferred {defer:.0f}s")
+        return None
+
+    def drain(self, stop=None, limit=None):
+        """One pass over the spool; returns its stats, or None if another drain holds the lock."""
+        with open(os.path.join(self.spool_dir, LOCK_NAME), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return self._drain(stop, limit)
+
+    def _drain(self, stop, limit):
+        started = time.time()
+        names = self.spooled()
+        self.load_journal(names)
+        todo = [n for n in names if self.entries.get(n, {}).get('next_try', 0) <= started]
+        deferred = [n for n in names if n not in set(todo)]
+        if limit is not None:
+            todo = todo[:limit]
+        stats = {'drained_files': 0, 'drained_bytes': 0, 'failed_files': 0}
+        state = {'consecutive_failures': 0}
+        slots = threading.BoundedSemaphore(self.workers)
+
+        def run(name):
+            try:
+                size = self.upload(name, stop)
+            except Exception as e:
+                logger.error(f"Draining {name} failed: {e}")
+                size = None
+            finally:
+                slots.release()
+            with self.lock:
+                if size is None:
+                    stats['failed_files'] += 1
+                    state['consecutive_failures'] += 1
+                else:
+                    stats['drained_files'] += 1
+                    stats['drained_bytes'] += size
+                    state['consecutive_failures'] = 0
+
+        def upload_in_order(batch):
+            # Submission waits for a free worker, so uploads start in WAL order
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='spool-drain') as pool:
+                for name in batch:
+                    slots.acquire()
+                    if (stop and stop.is_set()) or state['consecutive_failures'] >= CIRCUIT_BREAK_FAILURES:
+                        slots.release()
+                        return False
+                    pool.submit(run, name)
+            return state['consecutive_failures'] < CIRCUIT_BREAK_FAILURES
+
+        completed = upload_in_order(todo)
+        if completed and deferred and stats['drained_files'] and limit is None:
+            # Ozone takes uploads again, so files deferred during an outage need not wait out their backoff
+            completed = upload_in_order(deferred)
+        if state['consecutive_failures'] >= CIRCUIT_BREAK_FAILURES:
+            logger.warning(f"{state['consecutive_failures']} spooled files failed in a row, "
+                           f"stopping this drain (Ozone unavailable?)")
+
+        elapsed = time.time() - started
+        stats['elapsed'] = elapsed
+        stats['rate'] = stats['drained_bytes'] / elapsed if elapsed > 0 else 0
+        stats['depth_files'], stats['depth_bytes'], stats['oldest_age'] = self.depth()
+        if todo or stats['depth_files']:
+            logger.info(f"Spool drain: {stats['drained_files']} files ({stats['drained_bytes'] / 1024 / 1024:.1f}MB) "
+                        f"in {elapsed:.1f}s ({stats['rate'] / 1024 / 1024:.1f}MB/s), "
+                        f"{stats['failed_files']} failed; {stats['depth_files']} still spooled, "
+                        f"oldest {stats['oldest_age'] / 60:.0f}min")
+        self.write_metrics(stats)
+        return stats
+
+    def write_metrics(self, stats):
+        if not self.metrics_file or not os.path.isdir(os.path.dirname(self.metrics_file)):
+            return  # No textfile collector on this host
+        lines = []
+        for name, kind, help_text, value in (
+                ('wal_spool_depth_files', 'gauge', 'WAL segments in the local fallback spool',
+                 stats['depth_files']),
+                ('wal_spool_depth_bytes', 'gauge', 'Bytes in the local fallback spool', stats['depth_bytes']),
+                ('wal_spool_oldest_segment_age_seconds', 'gauge', 'Age of the oldest spooled segment',
+                 stats['oldest_age']),
+                ('wal_spool_drain_files', 'gauge', 'Segments uploaded by the last drain', stats['drained_files']),
+                ('wal_spool_drain_bytes', 'gauge', 'Bytes uploaded by the last drain', stats['drained_bytes']),
+                ('wal_spool_drain_rate_bytes_per_second', 'gauge', 'Upload rate of the last drain', stats['rate']),
+                ('wal_spool_drain_failed_files', 'gauge', 'Segments the last drain deferred after retries',
+                 stats['failed_files']),
+                ('wal_spool_drain_last_run_timestamp_seconds', 'gauge', 'End of the last drain', time.time())):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {float(value)}"]
+        try:
+            tmp_path = self.metrics_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.metrics_file)
+        except OSError as e:
+            logger.warning(f"Could not write spool metrics to {self.metrics_file}: {e}")
+
+def drain_spool(s3_client=None, stop=None, limit=None):
+    """Drain LOCAL_FALLBACK_DIR once; returns the run's stats (None: no spool, or a drain is running)."""
+    if not os.path.isdir(LOCAL_FALLBACK_DIR):
+        return None
+    return SpoolDrain(s3_client or initialize_s3_client()).drain(stop, limit)
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload the WAL archiver's fallback spool to Ozone")
+    parser.add_argument("--loop", type=float, metavar="SECONDS", help="Keep draining at this interval")
+    parser.add_argument("--workers", type=int, default=DRAIN_WORKERS)
+    args = parser.parse_args()
+
+    if not os.path.isdir(LOCAL_FALLBACK_DIR):
+        logger.info(f"No spool at {LOCAL_FALLBACK_DIR}")
+        return
+    s3_client = initialize_s3_client(max_pool_connections=args.workers + 2)
+    drain = SpoolDrain(s3_client, workers=args.workers)
+    while True:
+        if drain.drain() is None:
+            logger.info("Another drain is running on this spool")
+        if not args.loop:
+            break
+        time.sleep(args.loop)
+
+if __name__ == "__main__":
+    main()